@@ -0,0 +1,323 @@
+"""Likes and follows: the writes behind the like and follow buttons.
+
+Routes go through `set_like()` and `set_follow()` rather than touching
+Likes and Follows themselves, so the same rules apply whether a change is
+written right away or later, in a batch, by the write buffer (see
+writebuffer.py):
+
+- a change is a desired state per (user, target): liked or not,
+  following or not. Writing a state the database already has does
+  nothing, so replays and duplicate clicks are harmless,
+- counters move by what actually changed, one UPDATE per distinct delta,
+- follows and unfollows backfill or purge fanned-out timelines,
+  recompute the follower's recommendations (see recommend.py) and, once
+  committed, update this process's follow graph (see graph.py).
+
+With the write buffer on, the user's own recent actions are also kept in
+their session, and `liked_ids()`, `like_counts()`, `following_ids()` and
+`following_users()` lay them over what the database says. That way the
+next page shows the click even if it has not been flushed yet, whichever
+worker serves it.
+
+With the follow graph on, `following_ids()` answers from it, and the
+session records when the user last followed or unfollowed anyone
+(FOLLOWS_CHANGED_KEY), so a worker whose copy of them is older reads
+their follows again.
+"""
+
+import time
+from collections import Counter, defaultdict
+
+from flask import current_app, has_request_context, session
+from sqlalchemy import tuple_
+
+from graph import follow_graph, note_follows
+from models import db, Follows, Likes, Message, User
+from recommend import refresh_recommendations
+from routing import note_write
+from timeline import backfill, purge
+
+LIKE = 'like'
+FOLLOW = 'follow'
+
+PENDING_KEY = "pending_actions"
+FOLLOWS_CHANGED_KEY = "follows_changed"
+DEFAULT_PENDING_SECONDS = 10
+MAX_PENDING = 50
+
+
+def adjust(model, column, added, removed, side):
+    """Move `column` of `model` rows by the changes in `added`/`removed`.
+
+    `side` picks the id out of each (user, target) key.
+    """
+
+    deltas = Counter()
+    for key in added:
+        deltas[key[side]] += 1
+    for key in removed:
+        deltas[key[side]] -= 1
+
+    by_delta = defaultdict(list)
+    for row_id, delta in deltas.items():
+        if delta:
+            by_delta[delta].append(row_id)
+
+    counter = getattr(model, column)
+    for delta, row_ids in by_delta.items():
+        (model.query
+         .filter(model.id.in_(row_ids))
+         .update({counter: counter + delta}, synchronize_session=False))
+
+
+def live(states, target):
+    """`states` without keys whose user or `target` row is gone."""
+
+    user_ids = {user_id for user_id, _ in states}
+    target_ids = {target_id for _, target_id in states}
+
+    users = {row_id for row_id, in
+             db.session.query(User.id).filter(User.id.in_(user_ids))}
+    targets = {row_id for row_id, in
+               db.session.query(target.id).filter(target.id.in_(target_ids))}
+
+    return {key: state for key, state in states.items()
+            if key[0] in users and key[1] in targets}
+
+
+def diff(states, user_col, target_col):
+    """(added, removed) keys: where `states` differs from the table."""
+
+    pairs = tuple_(user_col, target_col)
+    stored = set(db.session.query(user_col, target_col)
+                 .filter(pairs.in_(list(states))))
+
+    added = [key for key, state in states.items() if state and key not in stored]
+    removed = [key for key, state in states.items() if not state and key in stored]
+    return added, removed
+
+
+def apply_likes(states):
+    """Write {(user_id, message_id): liked} and move like counters."""
+
+    added, removed = diff(states, Likes.user_id, Likes.message_id)
+
+    if added:
+        db.session.execute(Likes.__table__.insert(), [
+            dict(user_id=user_id, message_id=message_id)
+            for user_id, message_id in added])
+    if removed:
+        (Likes.query
+         .filter(tuple_(Likes.user_id, Likes.message_id).in_(removed))
+         .delete(synchronize_session=False))
+
+    adjust(User, 'likes_count', added, removed, side=0)
+    adjust(Message, 'likes_count', added, removed, side=1)
+
+
+def apply_follows(states):
+    """Write {(follower_id, followed_id): following}, counters, timelines
+    and the followers' recommendations."""
+
+    added, removed = diff(states, Follows.user_following_id,
+                          Follows.user_being_followed_id)
+
+    if added:
+        db.session.execute(Follows.__table__.insert(), [
+            dict(user_following_id=follower, user_being_followed_id=followed)
+            for follower, followed in added])
+    if removed:
+        (Follows.query
+         .filter(tuple_(Follows.user_following_id,
+                        Follows.user_being_followed_id).in_(removed))
+         .delete(synchronize_session=False))
+
+    adjust(User, 'following_count', added, removed, side=0)
+    adjust(User, 'followers_count', added, removed, side=1)
+
+    for follower, followed in added:
+        backfill(follower, followed)
+    for follower, followed in removed:
+        purge(follower, followed)
+
+    refresh_recommendations({follower for follower, _ in added + removed})
+    note_follows(added, removed)
+
+
+APPLY = {
+    LIKE: (apply_likes, Message),
+    FOLLOW: (apply_follows, User),
+}
+
+
+def apply_actions(actions, verified=False):
+    """Write {(kind, user_id, target_id): state} in the current transaction.
+
+    Unless `verified`, actions on users or targets deleted in the
+    meantime are dropped first.
+    """
+
+    by_kind = defaultdict(dict)
+    for (kind, user_id, target_id), state in actions.items():
+        by_kind[kind][user_id, target_id] = state
+
+    for kind, states in by_kind.items():
+        apply, target = APPLY[kind]
+        if not verified:
+            states = live(states, target)
+        if states:
+            apply(states)
+
+
+def record(kind, user_id, target_id, state):
+    """Write one action now, or hand it to the write buffer."""
+
+    buffer = current_app.extensions.get('write_buffer')
+    if kind == FOLLOW:
+        note_follows_changed(buffered=buffer is not None)
+
+    if buffer is None:
+        apply_actions({(kind, user_id, target_id): state}, verified=True)
+        db.session.commit()
+        return
+
+    buffer.add(kind, user_id, target_id, state)
+    remember_pending(kind, target_id, state)
+    note_write()
+
+
+def set_like(user_id, message_id, liked):
+    record(LIKE, user_id, message_id, liked)
+
+
+def set_follow(user_id, followed_id, following):
+    record(FOLLOW, user_id, followed_id, following)
+
+
+def note_follows_changed(buffered):
+    """Stamp the session so follow graphs older than now (or, for a
+    buffered follow, than its pending window) re-read the user's
+    follows."""
+
+    if follow_graph() is None or not has_request_context():
+        return
+
+    changed = time.time()
+    if buffered:
+        changed += current_app.config.get('WRITE_BUFFER_PENDING_SECONDS',
+                                          DEFAULT_PENDING_SECONDS)
+    session[FOLLOWS_CHANGED_KEY] = changed
+
+
+def remember_pending(kind, target_id, state):
+    """Keep the current user's buffered action in their session."""
+
+    entries = [entry for entry in current_pending()
+               if entry[:2] != [kind, target_id]]
+    entries.append([kind, target_id, state, time.time()])
+    session[PENDING_KEY] = entries[-MAX_PENDING:]
+
+
+def current_pending():
+    """The current user's buffered actions that may not be flushed yet."""
+
+    if not has_request_context() or PENDING_KEY not in session:
+        return []
+
+    window = current_app.config.get('WRITE_BUFFER_PENDING_SECONDS',
+                                    DEFAULT_PENDING_SECONDS)
+    cutoff = time.time() - window
+    entries = [entry for entry in session[PENDING_KEY] if entry[3] > cutoff]
+
+    if len(entries) < len(session[PENDING_KEY]):
+        session[PENDING_KEY] = entries
+    return entries
+
+
+def pending(kind):
+    """{target_id: state} of the current user's buffered `kind` actions."""
+
+    return {target_id: state
+            for entry_kind, target_id, state, _ in current_pending()
+            if entry_kind == kind}
+
+
+def liked_ids(user_id, message_ids):
+    """Likes.liked_ids, with the user's buffered likes applied."""
+
+    liked = Likes.liked_ids(user_id, message_ids)
+    for message_id, state in pending(LIKE).items():
+        if message_id in message_ids:
+            (liked.add if state else liked.discard)(message_id)
+    return liked
+
+
+def like_counts(user_id, messages):
+    """(liked ids, {message id: like count}) for a page of messages.
+
+    Counts include the user's own buffered likes; other users' show up
+    once flushed.
+    """
+
+    message_ids = [msg.id for msg in messages]
+    stored = Likes.liked_ids(user_id, message_ids)
+    liked = set(stored)
+    counts = {msg.id: msg.likes_count for msg in messages}
+
+    for message_id, state in pending(LIKE).items():
+        if message_id in counts and state != (message_id in stored):
+            counts[message_id] += 1 if state else -1
+            (liked.add if state else liked.discard)(message_id)
+
+    return liked, counts
+
+
+def following_ids(user):
+    """Ids `user` follows, with the user's buffered follows applied.
+
+    From the follow graph when there is one, else user.following_ids().
+    """
+
+    graph = follow_graph()
+    if graph is None:
+        ids = user.following_ids()
+    else:
+        since = 0
+        if has_request_context():
+            since = session.get(FOLLOWS_CHANGED_KEY, 0)
+        ids = graph.following_ids(user.id, since=since)
+
+    changes = pending(FOLLOW)
+    if not changes:
+        return ids
+
+    ids = set(ids)
+    for followed_id, state in changes.items():
+        (ids.add if state else ids.discard)(followed_id)
+    return ids
+
+
+def following_users(user):
+    """(users, count): who `user` follows and their following_count, with
+    the user's buffered follows applied.
+
+    `user` must be the current user; the buffered follows are theirs.
+    """
+
+    users, count = user.following, user.following_count
+
+    changes = pending(FOLLOW)
+    if not changes:
+        return users, count
+
+    shown = {followed.id for followed in users}
+    added = [followed_id for followed_id, state in changes.items()
+             if state and followed_id not in shown]
+    removed = {followed_id for followed_id, state in changes.items()
+               if not state and followed_id in shown}
+
+    users = [followed for followed in users if followed.id not in removed]
+    if added:
+        users += User.query.filter(User.id.in_(added)).order_by(User.id).all()
+
+    return users, count + len(users) - len(shown)
@@ -0,0 +1,283 @@
+"""JSON API for feeds and user lists.
+
+Read-only endpoints for clients that would otherwise scrape the HTML
+pages:
+
+    GET /api/timeline                   the logged-in user's home feed
+    GET /api/users?q=...                users, or a user search
+    GET /api/users/<id>/messages        a user's messages
+    GET /api/users/<id>/following       who a user follows
+    GET /api/users/<id>/followers       who follows a user
+
+They read through the same query functions as the pages (timeline.py,
+search.py) and use the same login session; like the pages, the follow
+lists and the home feed need a logged-in user.
+
+Every endpoint returns one page. `?limit=` sets its size (up to
+MAX_PAGE_SIZE) and the next page is `?cursor=` with the cursor of the
+previous one. Cursors are opaque; a bad one is a 400. `?fields=id,text`
+picks the fields to send (see MESSAGE_FIELDS and USER_FIELDS).
+
+Formats, by Accept header or `?format=`:
+
+- application/json (default): {"data": [...], "next": cursor or null}
+- application/x-ndjson: one object per line; the next cursor is only in
+  the headers
+
+Both carry the next cursor in X-Next-Cursor and a `Link: <...>;
+rel="next"` header. The body is generated row by row as the response is
+sent, never built up as one string, and gzipped on the fly for clients
+that send `Accept-Encoding: gzip`.
+"""
+
+import json
+import zlib
+from functools import partial
+
+from flask import (Blueprint, abort, g, jsonify, request, Response,
+                   stream_with_context, url_for)
+
+from actions import liked_ids
+from models import Follows, User
+from search import search_users, list_all_users, USER_SEARCH_PAGE_SIZE
+from timeline import (paginate, home_timeline, user_messages,
+                      HOME_TIMELINE_SIZE)
+
+MAX_PAGE_SIZE = 500
+
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+FORMATS = {'json': JSON, 'ndjson': NDJSON}
+
+# rows between gzip flushes, so NDJSON readers get rows as they come
+GZIP_FLUSH_ROWS = 50
+
+MESSAGE_FIELDS = {
+    'id': lambda msg: msg.id,
+    'text': lambda msg: msg.text,
+    'timestamp': lambda msg: msg.timestamp.isoformat(),
+    'user_id': lambda msg: msg.user_id,
+    'likes_count': lambda msg: msg.likes_count,
+}
+
+# only for a logged-in viewer; costs one query per page
+VIEWER_MESSAGE_FIELDS = {'liked'}
+
+USER_FIELDS = {
+    'id': lambda user: user.id,
+    'username': lambda user: user.username,
+    'image_url': lambda user: user.image_url,
+    'header_image_url': lambda user: user.header_image_url,
+    'bio': lambda user: user.bio,
+    'location': lambda user: user.location,
+    'messages_count': lambda user: user.messages_count,
+    'following_count': lambda user: user.following_count,
+    'followers_count': lambda user: user.followers_count,
+    'likes_count': lambda user: user.likes_count,
+}
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+
+def error(status, message):
+    abort(Response(json.dumps({'error': message}), status, mimetype=JSON))
+
+
+@api.errorhandler(404)
+def not_found(exc):
+    return jsonify(error="Not found."), 404
+
+
+def login_required():
+    if not g.user:
+        error(401, "Log in first.")
+
+
+def page_size(default):
+    limit = request.args.get('limit', default, type=int)
+    if not 1 <= limit <= MAX_PAGE_SIZE:
+        error(400, f"limit must be between 1 and {MAX_PAGE_SIZE}.")
+    return limit
+
+
+def selected_fields(available, extra=()):
+    """Names of the fields asked for with ?fields=, all by default."""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return list(available)
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = set(names) - set(available) - set(extra)
+    if unknown:
+        error(400, f"Unknown fields: {', '.join(sorted(unknown))}.")
+    return names
+
+
+def message_page(fetch):
+    """One page of messages from a timeline.py `fetch(before, limit)`."""
+
+    try:
+        messages, next_cursor = paginate(
+            fetch, request.args.get('cursor'), page_size(HOME_TIMELINE_SIZE))
+    except ValueError:
+        error(400, "Invalid cursor.")
+
+    fields = selected_fields(MESSAGE_FIELDS, VIEWER_MESSAGE_FIELDS)
+
+    serializers = {name: MESSAGE_FIELDS[name]
+                   for name in fields if name in MESSAGE_FIELDS}
+    if 'liked' in fields:
+        if not g.user:
+            error(400, "Field 'liked' needs a logged-in user.")
+        liked = liked_ids(g.user.id, [msg.id for msg in messages])
+        serializers['liked'] = lambda msg: msg.id in liked
+
+    return stream_page(messages, serializers, next_cursor)
+
+
+def user_page(users, next_cursor):
+    fields = selected_fields(USER_FIELDS)
+    return stream_page(users, {name: USER_FIELDS[name] for name in fields},
+                       next_cursor)
+
+
+def stream_page(rows, serializers, next_cursor):
+    """Streamed response with `rows` in the negotiated format."""
+
+    mimetype = FORMATS.get(request.args.get('format'))
+    if mimetype is None:
+        mimetype = request.accept_mimetypes.best_match([JSON, NDJSON], JSON)
+
+    def objects():
+        for row in rows:
+            yield json.dumps({name: serialize(row)
+                              for name, serialize in serializers.items()})
+
+    if mimetype == NDJSON:
+        chunks = (obj + "\n" for obj in objects())
+    else:
+        chunks = json_envelope(objects(), next_cursor)
+
+    headers = {}
+    if next_cursor:
+        args = dict(request.view_args, **request.args.to_dict())
+        args['cursor'] = next_cursor
+        headers['X-Next-Cursor'] = next_cursor
+        headers['Link'] = f'<{url_for(request.endpoint, **args)}>; rel="next"'
+
+    chunks = (chunk.encode() for chunk in chunks)
+    if request.accept_encodings['gzip']:
+        chunks = gzipped(chunks)
+        headers['Content-Encoding'] = 'gzip'
+
+    response = Response(stream_with_context(chunks), mimetype=mimetype,
+                        headers=headers)
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def json_envelope(objects, next_cursor):
+    yield '{"data": ['
+    for n, obj in enumerate(objects):
+        yield obj if n == 0 else ", " + obj
+    yield f'], "next": {json.dumps(next_cursor)}}}'
+
+
+def gzipped(chunks):
+    compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS)
+    for n, chunk in enumerate(chunks, 1):
+        data = compressor.compress(chunk)
+        if n % GZIP_FLUSH_ROWS == 0:
+            data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def follow_page(user_id, user_column, other_column):
+    """Users on the other side of `user_id`'s follows, by id.
+
+    The cursor is the id of the last user on the previous page.
+    """
+
+    try:
+        after = int(request.args.get('cursor', 0))
+    except ValueError:
+        error(400, "Invalid cursor.")
+
+    limit = page_size(USER_SEARCH_PAGE_SIZE)
+    users = (User
+             .query
+             .join(Follows, other_column == User.id)
+             .filter(user_column == user_id, User.id > after)
+             .order_by(User.id)
+             .limit(limit + 1)
+             .all())
+
+    if len(users) > limit:
+        users = users[:limit]
+        return user_page(users, str(users[-1].id))
+    return user_page(users, None)
+
+
+##############################################################################
+# Endpoints
+
+
+@api.route('/timeline')
+def timeline():
+    """The logged-in user's home feed, newest first."""
+
+    login_required()
+    return message_page(partial(home_timeline, g.user.id))
+
+
+@api.route('/users')
+def users():
+    """All users, or users matching ?q= (best matches first)."""
+
+    try:
+        page = int(request.args.get('cursor', 1))
+    except ValueError:
+        error(400, "Invalid cursor.")
+    if page < 1:
+        error(400, "Invalid cursor.")
+
+    search = request.args.get('q', '').strip()
+    limit = page_size(USER_SEARCH_PAGE_SIZE)
+    if search:
+        users, has_next = search_users(search, page, limit)
+    else:
+        users, has_next = list_all_users(page, limit)
+
+    return user_page(users, str(page + 1) if has_next else None)
+
+
+@api.route('/users/<int:user_id>/messages')
+def messages(user_id):
+    """A user's messages, newest first."""
+
+    User.query.get_or_404(user_id)
+    return message_page(partial(user_messages, user_id))
+
+
+@api.route('/users/<int:user_id>/following')
+def following(user_id):
+    """Users `user_id` follows."""
+
+    login_required()
+    User.query.get_or_404(user_id)
+    return follow_page(user_id, Follows.user_following_id,
+                       Follows.user_being_followed_id)
+
+
+@api.route('/users/<int:user_id>/followers')
+def followers(user_id):
+    """Users following `user_id`."""
+
+    login_required()
+    User.query.get_or_404(user_id)
+    return follow_page(user_id, Follows.user_being_followed_id,
+                       Follows.user_following_id)
@@ -1,59 +1,144 @@
 import os
+from functools import partial
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+import click
+from flask import (Blueprint, Flask, render_template, request, flash, redirect,
+                   session, g, abort, current_app)
+from flask.cli import with_appcontext
 from flask_debugtoolbar import DebugToolbarExtension
-from flask_bootstrap import Bootstrap
 from sqlalchemy.exc import IntegrityError
+from werkzeug.local import LocalProxy
 
 from forms import UserAddForm, LoginForm, MessageForm
     # UserAddFormRestricted
-from models import db, connect_db, User, Message, authenticateCurrent, Follows, Likes
+from models import db, connect_db, User, Message, authenticateCurrent
+from api import api
+from config import CONFIGS
+from actions import (FOLLOW, set_follow, set_like, following_ids,
+                     following_users, liked_ids, like_counts, pending)
+from caching import init_caching, not_modified, cards_validators, newest
+from forksafe import init_fork_safety
+from fragments import render_message, forget_message
+from graph import init_follow_graph, note_user_deleted
+from identity import (load_identity, invalidate_identity, forget_identity,
+                      IdentityGone)
+from loader import DEFAULT_CHUNK_SIZE, describe_progress
+from passwords import init_passwords, PasswordBusy
+from querystats import init_query_stats
+from recommend import compute_recommendations, forget_user, recommended_users
+from routing import init_routing
+from search import (search_users, list_all_users, search_messages,
+                    index_message, unindex_message, build_message_index)
 from seed import seed_database
+from snapshot import restore_or_seed
+from timeline import (paginate, home_timeline, user_messages, recent_messages,
+                      follows_anyone, deliver_message, retract_message,
+                      retract_user, rebuild_timelines)
+from writebuffer import init_write_buffer
 
 CURR_USER_KEY = "curr_user"
-# TODO: set to False before deploying in production
-DEBUG=True
-app = Flask(__name__)
-# Bootstrap(app)
-# login_manager = LoginManager()
-    
-# Get DB_URI from environ variable (useful for production/testing) or,
-# if not set there, use development local db.
-app.config['SQLALCHEMY_DATABASE_URI'] = (
-    os.environ.get('DATABASE_URL', 'postgres:///warbler'))
-
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.config['SQLALCHEMY_ECHO'] = False
-app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
-app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
-toolbar = DebugToolbarExtension(app)
-
-connect_db(app)
-
-if DEBUG:
-    seed_database()
-else:
-    db.create_all()
+
+views = Blueprint('views', __name__)
+toolbar = DebugToolbarExtension()
+
+
+def create_app(config=None):
+    """Create a Warbler app.
+
+    `config` is a class from config.py or its name; by default the one
+    named by WARBLER_CONFIG, else 'development'. Creating an app doesn't
+    touch the database: `flask init-db` creates the tables and
+    `flask seed` loads the sample data.
+
+    Preforking servers can create the app once and fork workers from it
+    (see forksafe.py), e.g.
+
+        gunicorn --preload --workers 4 'app:create_app("production")'
+
+    Raises RuntimeError if the config has no SECRET_KEY (production reads
+    it from the environment).
+    """
+
+    if config is None:
+        config = os.environ.get('WARBLER_CONFIG', 'development')
+    if isinstance(config, str):
+        config = CONFIGS[config]
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+    if not app.config.get('SECRET_KEY'):
+        # sessions would fail on first use; fail here instead
+        raise RuntimeError(f"{config.__name__} needs SECRET_KEY to be set")
+    # Bootstrap(app)
+    # login_manager = LoginManager()
+
+    if app.debug:
+        toolbar.init_app(app)
+
+    connect_db(app)
+    init_fork_safety(app)
+    init_query_stats(app)
+    init_routing(app)
+    init_caching(app)
+    init_passwords(app)
+    init_write_buffer(app)
+    init_follow_graph(app)
+    app.add_template_global(render_message)
+    app.register_blueprint(views)
+    app.register_blueprint(api)
+
+    for command in COMMANDS:
+        app.cli.add_command(command)
+
+    return app
+
 
 ##############################################################################
 # User signup/login/logout
 
 
-@app.before_request
+@views.before_app_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
+
+    g.user is an identity.CurrentUser: a cached snapshot of the user that
+    loads the full row only when a route needs more than the snapshot.
+    """
 
     if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+        g.user = load_identity(session[CURR_USER_KEY])
+        if g.user is None:
+            do_logout()
 
     else:
         g.user = None
 
 
+@views.app_errorhandler(IdentityGone)
+def identity_gone(error):
+    """The user was deleted while this session still had them cached."""
+
+    do_logout()
+    flash("Access unauthorized.", "danger")
+    return redirect("/")
+
+
+@views.app_context_processor
+def add_following_ids():
+    """Ids the current user follows, for Follow/Unfollow buttons.
+
+    Loaded lazily with one query the first time a template checks it.
+    """
+
+    return dict(following_ids=LocalProxy(
+        lambda: following_ids(g.user) if g.user else set()))
+
+
 def do_login(user):
     """Log in user."""
 
     session[CURR_USER_KEY] = user.id
+    invalidate_identity(user.id)
 
 
 def do_logout():
@@ -63,7 +148,15 @@ def do_logout():
         del session[CURR_USER_KEY]
 
 
-@app.route('/signup', methods=["GET", "POST"])
+def password_busy(template, form):
+    """Re-show `form` when the password pool is too busy to check it."""
+
+    flash("We're handling a lot of sign-ins right now. Please try again.",
+          'danger')
+    return render_template(template, form=form), 503, {'Retry-After': '1'}
+
+
+@views.route('/signup', methods=["GET", "POST"])
 def signup():
     """Handle user signup.
 
@@ -98,21 +191,29 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except PasswordBusy:
+            return password_busy('users/signup.html', form)
+
     else:
         return render_template('users/signup.html', form=form)
 
 
-@app.route('/login', methods=["GET", "POST"])
+@views.route('/login', methods=["GET", "POST"])
 def login():
     """Handle user login."""
 
     form = LoginForm()
 
     if form.validate_on_submit():
-        user = User.authenticate(form.username.data,
-                                 form.password.data)
+        try:
+            user = User.authenticate(form.username.data,
+                                     form.password.data)
+        except PasswordBusy:
+            return password_busy('users/login.html', form)
 
         if user:
+            # keeps a hash upgraded to the current cost
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -122,7 +223,7 @@ def login():
     return render_template('users/login.html', form=form)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
     """Handle logout of user."""
     print("called")
@@ -135,39 +236,60 @@ def logout():
 ##############################################################################
 # General user routes:
 
-@app.route('/users')
+def message_page(fetch):
+    """Page of messages for the ?before= cursor in the querystring."""
+
+    try:
+        return paginate(fetch, request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+
+@views.route('/users')
 def list_users():
     """Page with listing of users.
-    Can take a 'q' param in querystring to search by that username."""
+    Can take a 'q' param in querystring to search by username, bio and
+    location, and a 'page' param for later pages of results."""
 
     search = request.args.get('q')
+    page = max(request.args.get('page', 1, type=int), 1)
 
-    if not search:
-        users = User.query.all()
+    if not search or not search.strip():
+        users, has_next = list_all_users(page)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        users, has_next = search_users(search, page)
 
-    return render_template('users/index.html', users=users)
+    cards, last_modified = cards_validators(users)
+    cached = not_modified('list_users', cards, has_next,
+                          last_modified=last_modified)
+    if cached:
+        return cached
 
+    return render_template('users/index.html', users=users, search=search,
+                           page=page, has_next=has_next)
 
-@app.route('/users/<int:user_id>')
+
+@views.route('/users/<int:user_id>')
 def users_show(user_id):
     """Show user profile."""
 
     user = User.query.get_or_404(user_id)
 
+    # new and deleted messages move the author's counters, and with them
+    # updated_at
+    cached = not_modified('users_show', user.id, user.version,
+                          user.updated_at, last_modified=user.updated_at)
+    if cached:
+        return cached
+
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    messages, next_cursor = message_page(partial(user_messages, user_id))
+    return render_template('users/show.html', user=user, messages=messages,
+                           next_cursor=next_cursor)
 
 
-@app.route('/users/<int:user_id>/following')
+@views.route('/users/<int:user_id>/following')
 def show_following(user_id):
     """Show list of people this user is following."""
 
@@ -177,13 +299,26 @@ def show_following(user_id):
  
     # get the current user
     user = User.query.get_or_404(user_id)
-    
-    #
-    # follows = Follows.query
-    return render_template('users/following.html', user=user)
 
+    if user.id == g.user.id:
+        # include follows still in the write buffer
+        following, following_count = following_users(user)
+    else:
+        following, following_count = user.following, user.following_count
 
-@app.route('/users/<int:user_id>/followers')
+    cards, last_modified = cards_validators(following)
+    cached = not_modified('show_following', user.id, user.version,
+                          user.updated_at, cards, following_count,
+                          last_modified=newest(user.updated_at, last_modified))
+    if cached:
+        return cached
+
+    return render_template('users/following.html', user=user,
+                           following=following,
+                           following_count=following_count)
+
+
+@views.route('/users/<int:user_id>/followers')
 def users_followers(user_id):
     """Show list of followers of this user."""
 
@@ -192,10 +327,18 @@ def users_followers(user_id):
         return redirect("/")
 
     user = User.query.get_or_404(user_id)
+
+    cards, last_modified = cards_validators(user.followers)
+    cached = not_modified('users_followers', user.id, user.version,
+                          user.updated_at, cards,
+                          last_modified=newest(user.updated_at, last_modified))
+    if cached:
+        return cached
+
     return render_template('users/followers.html', user=user)
 
 
-@app.route('/users/follow/<int:follow_id>', methods=['POST'])
+@views.route('/users/follow/<int:follow_id>', methods=['POST'])
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -204,13 +347,15 @@ def add_follow(follow_id):
         return redirect("/")
 
     followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
-    db.session.commit()
+
+    if followed_user.id not in following_ids(g.user):
+        set_follow(g.user.id, followed_user.id, True)
+        invalidate_identity(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/stop-following/<int:follow_id>', methods=['POST'])
+@views.route('/users/stop-following/<int:follow_id>', methods=['POST'])
 def stop_following(follow_id):
     """Have currently-logged-in-user stop following this user."""
 
@@ -218,14 +363,16 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
-    db.session.commit()
+    followed_user = User.query.get_or_404(follow_id)
+
+    if followed_user.id in following_ids(g.user):
+        set_follow(g.user.id, followed_user.id, False)
+        invalidate_identity(g.user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
 
-@app.route('/users/profile', methods=["GET", "POST"])
+@views.route('/users/profile', methods=["GET", "POST"])
 def profile():
     """Update profile for current user."""
 
@@ -252,7 +399,9 @@ def profile():
         authenticateCurrent(check_pw, current_password)
 
         if True:
+            user.version = User.version + 1
             db.session.commit()
+            invalidate_identity(user.id)
             flash('Profile updated', 'success')
             return redirect('/')
 
@@ -261,7 +410,7 @@ def profile():
     return render_template('users/edit.html', form=form, id=id)
 
 
-@app.route('/users/delete', methods=["POST"])
+@views.route('/users/delete', methods=["POST"])
 def delete_user():
     """Delete user."""
 
@@ -271,8 +420,13 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    retract_user(g.user.id)
+    forget_user(g.user.id)
+    note_user_deleted(g.user.id)
+    User.release_counters(g.user.id)
+    db.session.delete(g.user.model)
     db.session.commit()
+    forget_identity(g.user.id)
 
     return redirect("/signup")
 
@@ -280,7 +434,7 @@ def delete_user():
 ##############################################################################
 # Messages routes:
 
-@app.route('/messages/new', methods=["GET", "POST"])
+@views.route('/messages/new', methods=["GET", "POST"])
 def messages_add():
     """Add a message - show form if GET. 
     If valid, update message and redirect to user page."""
@@ -294,22 +448,53 @@ def messages_add():
     if form.validate_on_submit():
         msg = Message(text=form.text.data)
         g.user.messages.append(msg)
+        db.session.flush()
+        User.adjust_counters(g.user.id, messages_count=1)
+        deliver_message(msg)
+        index_message(msg)
         db.session.commit()
+        invalidate_identity(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
     return render_template('messages/new.html', form=form)
 
 
-@app.route('/messages/<int:message_id>', methods=["GET"])
+@views.route('/messages/search')
+def messages_search():
+    """Search messages by text.
+    Takes a 'q' param, and a 'before' cursor for later pages."""
+
+    search = request.args.get('q', '')
+
+    try:
+        messages, next_cursor = search_messages(search,
+                                                request.args.get('before'))
+    except ValueError:
+        abort(400)
+
+    return render_template('messages/search.html', messages=messages,
+                           search=search, next_cursor=next_cursor)
+
+
+@views.route('/messages/<int:message_id>', methods=["GET"])
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = Message.query.options(db.joinedload(Message.user)).get_or_404(message_id)
+
+    # a message never changes, but its author's profile can
+    author = msg.user
+    cached = not_modified('messages_show', msg.id, msg.timestamp, author.id,
+                          author.version,
+                          last_modified=max(msg.timestamp, author.updated_at))
+    if cached:
+        return cached
+
     return render_template('messages/show.html', message=msg)
 
 
-@app.route('/messages/<int:message_id>/delete', methods=["POST"])
+@views.route('/messages/<int:message_id>/delete', methods=["POST"])
 def messages_destroy(message_id):
     """Delete a message."""
 
@@ -318,111 +503,160 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    retract_message(msg.id)
+    unindex_message(msg.id)
+    User.release_message_counters(msg)
     db.session.delete(msg)
     db.session.commit()
+    forget_message(message_id)
+    invalidate_identity(g.user.id)
 
     return redirect(f"/users/{g.user.id}")
 
 
-@app.route('/users/add_like/<int:msg_id>', methods=['POST'])
+@views.route('/users/add_like/<int:msg_id>', methods=['POST'])
+@views.route('/messages/<int:msg_id>/like', methods=['POST'])
 def add_like(msg_id):
+    """Like a message, or unlike it if the current user already does."""
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    message = Message.query.get_or_404(msg_id)   
-    like = Likes.add_like(g.user.id, msg_id)
+    message = Message.query.get_or_404(msg_id)
+    liked = message.id in liked_ids(g.user.id, [message.id])
 
-    db.session.add(like)
-    db.session.commit()
+    set_like(g.user.id, message.id, not liked)
+    invalidate_identity(g.user.id)
 
     return redirect('/')
 ##############################################################################
 # Homepage and error pages
 
 
-@app.route('/')
+@views.route('/')
 def homepage():
     """Show homepage:
     - users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users,
+      older pages through ?before=<cursor>, and who to follow
     """
-    # SELECT 
-    # f.user_being_followed_id,
-    # f.user_following_id, 
-    # m.text, 
-    # m.timestamp,
-    # m.id,
-    # m.user_id, 
-    # m.image_url,
-    # FROM follows f
-    # LEFT JOIN messages m
-    # ON f.user_being_followed_id = m.user_id
-    # WHERE f.user_being_followed_id = 223;
+    if g.user:
+        messages, next_cursor = message_page(partial(home_timeline, g.user.id))
 
+        if not messages and not follows_anyone(g.user.id):
+            if 'before' not in request.args:
+                flash('Start following users to create a custom feed')
+            messages, next_cursor = message_page(recent_messages)
 
-    if g.user:
+        likes, counts = like_counts(g.user.id, messages)
 
-        user_follows = (Follows
-                        .query
-                        .filter_by(user_following_id=g.user.id)
-                        .all())
+        # leave out follows still in the write buffer
+        followed = {user_id for user_id, state in pending(FOLLOW).items() if state}
+        recommended = recommended_users(g.user.id, exclude=followed)
 
-        user_follows = [row.user_being_followed_id for row in user_follows]
-        
-        # same as previous line
-        # new_follows_rows = []
-        # for row in follow_rows:
-        #     new_follows_rows.append(row.user_being_followed_id)
-        
-        messages = Message.query.all()
-        # create message list
-        user_follows_message_ids = []
-        # check if the user currently is following another user - if false return last 100 messages
-        if len(user_follows) > 0:
-            for row in messages:
-                if row.user_id in user_follows:
-                    user_follows_message_ids.append(row.id)
-                    
-            
-            messages = (Message
-                        .query
-                        .filter(Message.id.in_(user_follows_message_ids))
-                        .order_by(Message.timestamp.desc())
-                        .limit(100)
-                        .all())  
-        else:
-            # TODO: ask mentor if we should leave this if they haven't followed anyone yet?
-            flash('Start following users to create a custom feed')
-            messages = (Message
-                        .query
-                        .order_by(Message.timestamp.desc())
-                        .limit(100)
-                        .all())
-        print()
-        return render_template('home.html', messages=messages)
+        return render_template('home.html', messages=messages, likes=likes,
+                               like_counts=counts, recommended=recommended,
+                               next_cursor=next_cursor)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
-
-@app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+# Maintenance commands
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create any missing tables and indexes."""
+
+    db.create_all()
+    click.echo("Tables created.")
+
+
+@click.command('seed')
+@click.option('--chunk-size', default=DEFAULT_CHUNK_SIZE, show_default=True,
+              help="Rows per transaction.")
+@click.option('--resume', is_flag=True,
+              help="Continue an interrupted seed instead of starting over.")
+@click.option('--no-snapshot', is_flag=True,
+              help="Load the CSVs even if a snapshot of them exists.")
+@with_appcontext
+def seed_command(chunk_size, resume, no_snapshot):
+    """Drop and reload the database from the seed CSVs.
+
+    Restores a snapshot of the seeded database instead when the CSVs and
+    schema haven't changed since it was taken (see snapshot.py).
+    """
+
+    def progress(table, rows, seconds):
+        click.echo(describe_progress(table, rows, seconds))
+
+    if resume or no_snapshot:
+        seed_database(chunk_size=chunk_size, resume=resume, progress=progress)
+    else:
+        outcome = restore_or_seed(current_app, chunk_size=chunk_size,
+                                  progress=progress)
+        snapshot = (f" snapshot {outcome.fingerprint}" if outcome.fingerprint
+                    else "")
+        click.echo(f"Seed{snapshot}: {outcome.how} "
+                   f"({outcome.seconds * 1000:,.0f} ms)")
+    click.echo("Database seeded.")
+
+
+@click.command('rebuild-timelines')
+@click.argument('user_ids', nargs=-1, type=int)
+@with_appcontext
+def rebuild_timelines_command(user_ids):
+    """Rebuild fan-out-on-write inboxes (all of them, or USER_IDS)."""
+
+    written = rebuild_timelines(list(user_ids) or None)
+    db.session.commit()
+    click.echo(f"Wrote {written} timeline entries.")
+
+
+@click.command('index-messages')
+@with_appcontext
+def index_messages_command():
+    """Rebuild the message search index from the messages table."""
+
+    indexed = build_message_index()
+    db.session.commit()
+    click.echo(f"Indexed {indexed} messages.")
+
+
+@click.command('reconcile-counters')
+@with_appcontext
+def reconcile_counters_command():
+    """Recompute user message/follow/like and message like counters."""
+
+    User.reconcile_counters()
+    Message.reconcile_counters()
+    db.session.commit()
+    click.echo("Counters reconciled.")
+
+
+@click.command('recommend')
+@with_appcontext
+def recommend_command():
+    """Recompute every user's who-to-follow list."""
+
+    written = compute_recommendations()
+    db.session.commit()
+    click.echo(f"Wrote {written} recommendations.")
+
+
+COMMANDS = [
+    init_db_command,
+    seed_command,
+    rebuild_timelines_command,
+    index_messages_command,
+    reconcile_counters_command,
+    recommend_command,
+]
+
 
 if __name__ == "__main__":
-    app.run(debug=DEBUG)
+    create_app().run()
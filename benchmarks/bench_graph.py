@@ -0,0 +1,157 @@
+"""Benchmark the in-process follow graph against queries and Python sets.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_graph
+    python -m benchmarks.bench_graph --edges 100000 1000000 10000000
+
+Each size gets a fresh SQLite database of random follows, FOLLOWS_PER_USER
+per user on average. "load s" is load_follow_graph() reading them back;
+"MB" is the CSR arrays (graph.nbytes) and "sets MB" what the same follows
+take as {user: set of ids} in both directions, measured with tracemalloc.
+Query times are medians over `--queries` random users, in microseconds:
+"sql" is the old path, User.following_ids() on a freshly loaded user,
+then membership in the set it returns.
+
+Sample run (SQLite, 1 core, 10,000 queries per size, 1,000 for sql).
+The arrays take 9.6 MB per million follows whatever the size, a
+sixteenth of the sets, and answers come about a thousand times faster
+than the query:
+
+      edges    users  load s     MB  MB/M edges  sets MB  sql us  member us  degree us  mutual us
+     100000    10000    0.23   0.96        9.60     15.1  1189.8       1.60       1.55       6.91
+    1000000   100000    3.35   9.60        9.60    155.3  1342.3       1.60       1.48       6.83
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+import tracemalloc
+
+from flask import Flask
+
+from graph import load_follow_graph
+from models import db, connect_db, Follows, User
+
+FOLLOWS_PER_USER = 10
+CHUNK = 50000
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    connect_db(app)
+    return app
+
+
+def random_edges(num_edges, num_users, rng):
+    edges = set()
+    while len(edges) < num_edges:
+        follower = rng.randrange(1, num_users + 1)
+        followed = rng.randrange(1, num_users + 1)
+        if follower != followed:
+            edges.add((follower, followed))
+    return edges
+
+
+def populate(num_users, edges):
+    for start in range(1, num_users + 1, CHUNK):
+        db.session.execute(User.__table__.insert(), [
+            dict(id=n, email=f"u{n}@example.com", username=f"u{n}",
+                 password="x")
+            for n in range(start, min(start + CHUNK, num_users + 1))])
+
+    edges = list(edges)
+    for start in range(0, len(edges), CHUNK):
+        db.session.execute(Follows.__table__.insert(), [
+            dict(user_following_id=follower, user_being_followed_id=followed)
+            for follower, followed in edges[start:start + CHUNK]])
+    db.session.commit()
+
+
+def sets_megabytes(edges):
+    """Size of the follows as dicts of sets, both directions."""
+
+    tracemalloc.start()
+    following, followers = {}, {}
+    for follower, followed in edges:
+        following.setdefault(follower, set()).add(followed)
+        followers.setdefault(followed, set()).add(follower)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size / 1e6
+
+
+def median_us(query, args_list):
+    timings = []
+    for args in args_list:
+        started = time.perf_counter()
+        query(*args)
+        timings.append((time.perf_counter() - started) * 1e6)
+    return statistics.median(timings)
+
+
+def sql_is_following(follower_id, followed_id):
+    db.session.expire_all()
+    return followed_id in User.query.get(follower_id).following_ids()
+
+
+def run(app, num_edges, args):
+    rng = random.Random(num_edges)
+    num_users = max(2, num_edges // FOLLOWS_PER_USER)
+    edges = random_edges(num_edges, num_users, rng)
+
+    with app.app_context():
+        db.create_all()
+        populate(num_users, edges)
+
+        started = time.perf_counter()
+        graph = load_follow_graph()
+        load = time.perf_counter() - started
+
+        pairs = [(rng.randrange(1, num_users + 1),
+                  rng.randrange(1, num_users + 1))
+                 for _ in range(args.queries)]
+        users = [(user,) for user, _ in pairs]
+
+        result = dict(
+            edges=num_edges, users=num_users, load=load,
+            mb=graph.nbytes / 1e6,
+            per_million=graph.nbytes / 1e6 / (num_edges / 1e6),
+            sets=sets_megabytes(edges),
+            sql=median_us(sql_is_following, pairs[:args.sql_queries]),
+            member=median_us(graph.is_following, pairs),
+            degree=median_us(graph.followers_count, users),
+            mutual=median_us(graph.mutual_ids, users))
+        db.session.remove()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--edges', type=int, nargs='+',
+                        default=[100000, 1000000])
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('--sql-queries', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'edges':>11} {'users':>8} {'load s':>7} {'MB':>6} "
+          f"{'MB/M edges':>11} {'sets MB':>8} {'sql us':>7} "
+          f"{'member us':>10} {'degree us':>10} {'mutual us':>10}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for num_edges in args.edges:
+            app = make_app(os.path.join(tmp, f"g{num_edges}.db"))
+            r = run(app, num_edges, args)
+            print(f"{r['edges']:>11} {r['users']:>8} {r['load']:>7.2f} "
+                  f"{r['mb']:>6.2f} {r['per_million']:>11.2f} "
+                  f"{r['sets']:>8.1f} {r['sql']:>7.1f} {r['member']:>10.2f} "
+                  f"{r['degree']:>10.2f} {r['mutual']:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Benchmark login throughput with bcrypt inline vs. in the password pool.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_login
+    python -m benchmarks.bench_login --rounds 12 --workers 0 1 2 4 --threads 16
+
+Each configuration logs in `--logins` times with User.authenticate() from
+`--threads` request threads against a temp SQLite database. "per core"
+divides throughput by the cores bcrypt can use: all of them inline,
+min(workers, cores) with a pool. "busy" counts logins refused with
+PasswordBusy because the queue was full.
+
+Sample run (1 core, cost 12, 8 threads, 64 logins). Throughput per core
+is the same either way; what the pool adds is a bound. bcrypt never
+takes more than `workers` cores away from serving pages, and logins past
+the queue depth are refused at once instead of queueing for seconds:
+
+    workers  logins/s  per core   p50 ms   p99 ms  busy
+          0       3.2       3.2   2467.4   2550.2     0
+          1       3.3       3.3   1214.8   1259.2    32
+"""
+
+import argparse
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from flask import Flask
+
+import passwords
+from models import db, connect_db, User
+from passwords import PasswordBusy, init_passwords
+
+PASSWORD = "password"
+
+
+def make_app(path, workers, rounds, queue_depth):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['BCRYPT_LOG_ROUNDS'] = rounds
+    app.config['PASSWORD_POOL_WORKERS'] = workers
+    app.config['PASSWORD_TIMEOUT'] = 600
+    if queue_depth:
+        app.config['PASSWORD_QUEUE_DEPTH'] = queue_depth
+    connect_db(app)
+    init_passwords(app)
+    return app
+
+
+def populate(num_users):
+    pw_hash = passwords.hash_password(PASSWORD)
+    db.session.execute(User.__table__.insert(), [
+        dict(email=f"u{i}@example.com", username=f"u{i}", password=pw_hash)
+        for i in range(num_users)])
+    db.session.commit()
+
+
+def run(app, args):
+    latencies = []
+    busy = [0]
+    lock = threading.Lock()
+    per_thread = args.logins // args.threads
+
+    def login_loop(offset):
+        with app.app_context():
+            for i in range(per_thread):
+                username = f"u{(offset + i) % args.users}"
+                started = time.perf_counter()
+                try:
+                    if not User.authenticate(username, PASSWORD):
+                        raise RuntimeError(f"login failed for {username}")
+                except PasswordBusy:
+                    with lock:
+                        busy[0] += 1
+                    continue
+                finally:
+                    db.session.remove()
+                with lock:
+                    latencies.append((time.perf_counter() - started) * 1000)
+
+    threads = [threading.Thread(target=login_loop, args=(n * per_thread,))
+               for n in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - started
+
+    latencies.sort()
+    return dict(rate=len(latencies) / seconds,
+                p50=statistics.median(latencies) if latencies else 0,
+                p99=latencies[int(len(latencies) * .99) - 1] if latencies else 0,
+                busy=busy[0])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=sorted({0, 1, os.cpu_count()}))
+    parser.add_argument('--rounds', type=int, default=12)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--logins', type=int, default=64)
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--queue-depth', type=int, default=0,
+                        help="PASSWORD_QUEUE_DEPTH (default: 4 per worker)")
+    args = parser.parse_args()
+
+    cores = os.cpu_count()
+    print(f"{'workers':>7} {'logins/s':>9} {'per core':>9} {'p50 ms':>8} "
+          f"{'p99 ms':>8} {'busy':>5}")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for workers in args.workers:
+            app = make_app(os.path.join(tmp, f"w{workers}.db"), workers,
+                           args.rounds, args.queue_depth)
+            with app.app_context():
+                db.create_all()
+                populate(args.users)
+
+            result = run(app, args)
+            passwords.shutdown_pool()
+
+            used = min(workers, cores) if workers else cores
+            print(f"{workers:>7} {result['rate']:>9.1f} "
+                  f"{result['rate'] / used:>9.1f} {result['p50']:>8.1f} "
+                  f"{result['p99']:>8.1f} {result['busy']:>5}")
+
+
+if __name__ == '__main__':
+    main()
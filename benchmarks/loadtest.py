@@ -0,0 +1,257 @@
+"""Route-level load test for a running Warbler.
+
+Seed a database, start the app, then run from the repo root:
+
+    flask seed
+    flask run --with-threads &
+    python -m benchmarks.loadtest --base-url http://localhost:5000 \
+        --users 50 --concurrency 10 --duration 60 --output before.json
+
+Each virtual user logs in as one of the seeded users (generator/users.csv,
+whose password is "password") and replays a weighted mix of routes:
+
+    homepage          GET  /
+    users_show        GET  /users/<id>
+    follow/unfollow   POST /users/follow/<id>, /users/stop-following/<id>
+    messages_add      POST /messages/new
+    add_like          POST /users/add_like/<id>
+
+Redirects are not followed, so every sample times one route. The report
+gives throughput and p50/p95/p99 latency per route, and --output saves it
+as JSON. Compare two runs with:
+
+    python -m benchmarks.loadtest --compare before.json after.json
+"""
+
+import argparse
+import csv
+import http.cookiejar
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import datetime
+
+DEFAULT_MIX = {
+    'homepage': 50,
+    'users_show': 20,
+    'follow': 5,
+    'unfollow': 5,
+    'messages_add': 5,
+    'add_like': 15,
+}
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class VirtualUser:
+    """One logged-in browser session."""
+
+    def __init__(self, base_url, username, password):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            NoRedirect)
+        self.username = username
+        self.password = password
+        self.csrf_token = None
+
+    def request(self, path, data=None):
+        """(status, body) for one request; 3xx counts as a response."""
+
+        body = urllib.parse.urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(self.base_url + path, body) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as exc:
+            return exc.code, exc.read()
+
+    def login(self):
+        _, page = self.request('/login')
+        self.csrf_token = CSRF_RE.search(page.decode()).group(1)
+        status, _ = self.request('/login', dict(csrf_token=self.csrf_token,
+                                                username=self.username,
+                                                password=self.password))
+        if status != 302:
+            raise RuntimeError(f"could not log in as {self.username}")
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+        with open(args.users_csv) as f:
+            self.usernames = [row['username'] for row in csv.DictReader(f)]
+        with open(args.messages_csv) as f:
+            self.num_messages = sum(1 for _ in f) - 1
+
+        self.routes = list(DEFAULT_MIX)
+        self.weights = [DEFAULT_MIX[route] for route in self.routes]
+
+    def action(self, route, user, rng):
+        """(path, form data) for one request of `route`."""
+
+        user_id = rng.randint(1, len(self.usernames))
+        message_id = rng.randint(1, self.num_messages)
+
+        if route == 'homepage':
+            return '/', None
+        if route == 'users_show':
+            return f'/users/{user_id}', None
+        if route == 'follow':
+            return f'/users/follow/{user_id}', {}
+        if route == 'unfollow':
+            return f'/users/stop-following/{user_id}', {}
+        if route == 'messages_add':
+            return '/messages/new', dict(csrf_token=user.csrf_token,
+                                         text=f"load test {rng.random():.6f}")
+        if route == 'add_like':
+            return f'/users/add_like/{message_id}', {}
+        raise ValueError(route)
+
+    def worker(self, users, deadline, seed):
+        rng = random.Random(seed)
+        while time.monotonic() < deadline:
+            user = rng.choice(users)
+            route = rng.choices(self.routes, self.weights)[0]
+            path, data = self.action(route, user, rng)
+
+            started = time.perf_counter()
+            try:
+                status, _ = user.request(path, data)
+            except OSError:
+                status = None
+            elapsed = (time.perf_counter() - started) * 1000
+
+            with self.lock:
+                self.samples[route].append(elapsed)
+                if status is None or status >= 400:
+                    self.errors[route] += 1
+
+    def run(self):
+        args = self.args
+        rng = random.Random(args.seed)
+        names = rng.sample(self.usernames, min(args.users, len(self.usernames)))
+
+        users = [VirtualUser(args.base_url, name, args.password) for name in names]
+        for user in users:
+            user.login()
+
+        started = time.monotonic()
+        deadline = started + args.duration
+        threads = [threading.Thread(target=self.worker,
+                                    args=(users[i::args.concurrency] or users,
+                                          deadline, args.seed + i))
+                   for i in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return self.report(time.monotonic() - started)
+
+    def report(self, seconds):
+        routes = {}
+        for route, samples in sorted(self.samples.items()):
+            samples.sort()
+            routes[route] = dict(
+                requests=len(samples),
+                errors=self.errors[route],
+                rps=len(samples) / seconds,
+                p50_ms=percentile(samples, 50),
+                p95_ms=percentile(samples, 95),
+                p99_ms=percentile(samples, 99),
+            )
+
+        total = sum(route['requests'] for route in routes.values())
+        return dict(
+            started_at=datetime.utcnow().isoformat(),
+            base_url=self.args.base_url,
+            users=self.args.users,
+            concurrency=self.args.concurrency,
+            duration_s=seconds,
+            requests=total,
+            rps=total / seconds,
+            routes=routes,
+        )
+
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of sorted `samples`."""
+
+    if not samples:
+        return None
+    rank = max(int(round(pct / 100 * len(samples))), 1)
+    return samples[rank - 1]
+
+
+def print_report(result):
+    print(f"{result['requests']} requests in {result['duration_s']:.1f}s "
+          f"({result['rps']:.1f} req/s)")
+    print(f"{'route':<14} {'reqs':>7} {'errors':>7} {'req/s':>8} "
+          f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}")
+    for route, stats in result['routes'].items():
+        print(f"{route:<14} {stats['requests']:>7} {stats['errors']:>7} "
+              f"{stats['rps']:>8.1f} {stats['p50_ms']:>8.1f} "
+              f"{stats['p95_ms']:>8.1f} {stats['p99_ms']:>8.1f}")
+
+
+def print_comparison(before, after):
+    print(f"{'route':<14} {'req/s':>17} {'p50 ms':>17} {'p95 ms':>17} "
+          f"{'p99 ms':>17}")
+    for route in sorted(set(before['routes']) | set(after['routes'])):
+        old = before['routes'].get(route)
+        new = after['routes'].get(route)
+        if not old or not new:
+            continue
+        cells = [f"{old[key]:>7.1f} ->{new[key]:>7.1f}"
+                 for key in ('rps', 'p50_ms', 'p95_ms', 'p99_ms')]
+        print(f"{route:<14} " + " ".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--users', type=int, default=50,
+                        help="virtual users (seeded accounts) to log in")
+    parser.add_argument('--concurrency', type=int, default=10,
+                        help="client threads")
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds to run")
+    parser.add_argument('--password', default='password')
+    parser.add_argument('--users-csv', default='generator/users.csv')
+    parser.add_argument('--messages-csv', default='generator/messages.csv')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write results as JSON here")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'),
+                        help="compare two saved runs instead of running")
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            print_comparison(json.load(before), json.load(after))
+        return
+
+    result = LoadTest(args).run()
+    print_report(result)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,144 @@
+"""HTTP caching policy: conditional GETs and long-lived static files.
+
+Pages that can tell cheaply whether they changed call `not_modified()`
+with whatever their HTML is built from (row ids, versions, counters)
+before rendering:
+
+    cached = not_modified(user.id, user.version, ..., last_modified=...)
+    if cached:
+        return cached
+
+That returns a 304 when the browser's copy is current, and otherwise
+remembers a strong ETag (and Last-Modified) for the response. The
+viewer is always part of the ETag: who is logged in, their profile
+version and their identity stamp, which is bumped whenever they follow,
+like or post. Pages with a pending flash message are always rendered.
+
+Dynamic responses are `private, no-cache` with `Vary: Cookie`: browsers
+may keep them but must revalidate. Static files are served for a year
+when requested through `static_url()`, which adds the file's mtime as a
+cache buster.
+
+CACHE_NO_STORE brings back the development behaviour: no validators and
+`no-cache, no-store, must-revalidate` on every response.
+"""
+
+import hashlib
+import os
+
+from flask import current_app, g, request, session, url_for
+from werkzeug.http import is_resource_modified
+
+from identity import IDENTITY_STAMP_KEY
+
+STATIC_MAX_AGE = 365 * 24 * 60 * 60
+
+NO_STORE = "no-cache, no-store, must-revalidate"
+REVALIDATE = "private, no-cache"
+
+
+def templates_version(app):
+    """Latest template mtime, so a deploy with new templates gets new ETags."""
+
+    mtimes = [os.path.getmtime(os.path.join(root, name))
+              for root, _, names in os.walk(os.path.join(app.root_path,
+                                                          app.template_folder))
+              for name in names]
+    return int(max(mtimes, default=0))
+
+
+def viewer_validators():
+    """What every page's HTML depends on about the logged-in user."""
+
+    if not g.user:
+        return None, None
+
+    # The stamp only moves in the session that acted; updated_at moves
+    # with the user's counters, so their other browsers see follows and
+    # likes made elsewhere.
+    stamp = session.get(IDENTITY_STAMP_KEY, 0)
+    return ((g.user.id, g.user.version, g.user.updated_at, stamp),
+            g.user.updated_at)
+
+
+def not_modified(*parts, last_modified=None):
+    """304 response if the client has this page already, else None.
+
+    `parts` is everything besides the viewer that the page renders from;
+    `last_modified` the newest timestamp among it.
+    """
+
+    config = current_app.config
+    if config.get('CACHE_NO_STORE') or session.get('_flashes'):
+        return None
+
+    viewer, viewer_modified = viewer_validators()
+    etag = hashlib.sha1(
+        repr((config['CACHE_VERSION'], viewer, parts)).encode()).hexdigest()
+
+    if last_modified:
+        last_modified = newest(last_modified, viewer_modified)
+
+    g.cache_validators = etag, last_modified
+    if request.method in ('GET', 'HEAD') and not is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified):
+        return current_app.response_class(status=304)
+
+    return None
+
+
+def newest(*timestamps):
+    """Latest of `timestamps`, ignoring None."""
+
+    return max((ts for ts in timestamps if ts is not None), default=None)
+
+
+def cards_validators(users):
+    """ETag parts and Last-Modified for a page of user cards."""
+
+    return (tuple((user.id, user.version) for user in users),
+            newest(*(user.updated_at for user in users)))
+
+
+def static_url(filename):
+    """URL for a static file that stays valid until the file changes."""
+
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        version = int(os.path.getmtime(path))
+    except OSError:
+        return url_for('static', filename=filename)
+    return url_for('static', filename=filename, v=version)
+
+
+def init_caching(app):
+    """Install the caching policy on `app`."""
+
+    app.config.setdefault('CACHE_VERSION', templates_version(app))
+    app.add_template_global(static_url)
+
+    @app.after_request
+    def apply_cache_policy(response):
+        if app.config.get('CACHE_NO_STORE'):
+            response.headers['Cache-Control'] = NO_STORE
+            response.headers['Pragma'] = 'no-cache'
+            response.headers['Expires'] = '0'
+            return response
+
+        if request.endpoint == 'static':
+            if 'v' in request.args:
+                response.cache_control.public = True
+                response.cache_control.max_age = STATIC_MAX_AGE
+                response.cache_control.immutable = True
+            return response
+
+        response.headers['Cache-Control'] = REVALIDATE
+        response.vary.add('Cookie')
+
+        etag, last_modified = g.pop('cache_validators', (None, None))
+        if etag and response.status_code in (200, 304):
+            response.set_etag(etag)
+            if last_modified:
+                response.last_modified = last_modified
+
+        return response
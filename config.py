@@ -0,0 +1,135 @@
+"""Configuration for each environment Warbler runs in.
+
+`create_app()` (app.py) takes one of these classes, or its name:
+
+    create_app('production')
+    create_app(TestingConfig)
+
+and otherwise picks the class named by WARBLER_CONFIG, falling back to
+'development'. Values are read from the environment when this module is
+imported, so set environment variables before that.
+"""
+
+import os
+
+from sqlalchemy.engine.url import make_url
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS for a comma-separated list of replica URLs."""
+
+    return {f'replica_{n}': url
+            for n, url in enumerate(filter(None, urls.split(',')), 1)}
+
+
+def worker_database_url(url, worker=None):
+    """`url` with a database of its own for parallel test worker `worker`.
+
+    pytest-xdist names its workers gw0, gw1, ...: worker gw1 of
+    postgresql:///warbler-test gets postgresql:///warbler-test_gw1, and of
+    sqlite:///test.db gets sqlite:///test_gw1.db.
+    """
+
+    url = make_url(url)
+    if not worker or not url.database or url.database == ':memory:':
+        return str(url)
+
+    if url.get_backend_name() == 'sqlite':
+        root, ext = os.path.splitext(url.database)
+        url.database = f"{root}_{worker}{ext}"
+    else:
+        url.database = f"{url.database}_{worker}"
+    return str(url)
+
+
+class Config:
+    """Settings shared by every environment."""
+
+    DEBUG = False
+    TESTING = False
+
+    # Get DB_URI from environ variable (useful for production/testing) or,
+    # if not set there, use development local db.
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'postgres:///warbler')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ECHO = False
+
+    # Read replicas for GET requests: DATABASE_REPLICA_URLS is a
+    # comma-separated list of database URLs (see routing.py)
+    SQLALCHEMY_BINDS = replica_binds(os.environ.get('DATABASE_REPLICA_URLS', ''))
+    REPLICA_BINDS = list(SQLALCHEMY_BINDS)
+    REPLICA_STICKY_SECONDS = 5
+
+    # Materialize home timelines on write (see timeline.py)
+    TIMELINE_FANOUT = os.environ.get('TIMELINE_FANOUT') == '1'
+    TIMELINE_FANOUT_MAX_FOLLOWERS = int(
+        os.environ.get('TIMELINE_FANOUT_MAX_FOLLOWERS', 1000))
+    # Messages a follow copies into the follower's inbox, newest first
+    TIMELINE_BACKFILL_SIZE = 1000
+    # Log a possible N+1 when this many statements repeat in one request
+    QUERY_STATS_DUPLICATE_WARNING = 5
+    # Send no-store everywhere instead of validators (see caching.py)
+    CACHE_NO_STORE = os.environ.get('CACHE_NO_STORE') == '1'
+    # Rendered message <li>s kept per process (see fragments.py)
+    FRAGMENT_CACHE_SIZE = 10000
+    # bcrypt cost of new hashes, and the pool that computes them (see
+    # passwords.py; 0 workers hashes inline)
+    BCRYPT_LOG_ROUNDS = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+    PASSWORD_POOL_WORKERS = int(
+        os.environ.get('PASSWORD_POOL_WORKERS', os.cpu_count()))
+    PASSWORD_TIMEOUT = 5
+    # Batch like/follow writes in the background (see writebuffer.py for
+    # what a crash can lose)
+    WRITE_BUFFER_ENABLED = os.environ.get('WRITE_BUFFER_ENABLED') == '1'
+    WRITE_BUFFER_INTERVAL = 0.5
+    WRITE_BUFFER_MAX_ACTIONS = 500
+    # Answer follow checks from an in-process copy of the follow graph,
+    # reloaded in the background (see graph.py)
+    FOLLOW_GRAPH_ENABLED = os.environ.get('FOLLOW_GRAPH_ENABLED') == '1'
+    FOLLOW_GRAPH_RELOAD_SECONDS = 60
+    FOLLOW_GRAPH_MAX_DELTAS = 100000
+    # `flask seed` restores a snapshot of the seeded database when the
+    # seed CSVs haven't changed (see snapshot.py)
+    SEED_SNAPSHOTS = os.environ.get('SEED_SNAPSHOTS', '1') == '1'
+
+    DEBUG_TB_INTERCEPT_REDIRECTS = False
+    SECRET_KEY = os.environ.get('SECRET_KEY', "it's a secret")
+
+
+class DevelopmentConfig(Config):
+    """Local runs: debugger and debug toolbar on."""
+
+    DEBUG = True
+
+
+class TestingConfig(Config):
+    """The test suite, against its own database (one per pytest-xdist
+    worker, see fixtures.py)."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = worker_database_url(
+        os.environ.get('TEST_DATABASE_URL', 'postgresql:///warbler-test'),
+        os.environ.get('PYTEST_XDIST_WORKER'))
+    SQLALCHEMY_BINDS = {}
+    REPLICA_BINDS = []
+    # Cheap bcrypt, inline: a process pool per test worker buys nothing.
+    # Not the minimum cost, 4: test_user_model uses that as an outdated one
+    BCRYPT_LOG_ROUNDS = 5
+    PASSWORD_POOL_WORKERS = 0
+
+    # Don't have WTForms use CSRF at all, since it's a pain to test
+    WTF_CSRF_ENABLED = False
+    DEBUG_TB_ENABLED = False
+
+
+class ProductionConfig(Config):
+    """Deployed servers. SECRET_KEY must come from the environment."""
+
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'testing': TestingConfig,
+    'production': ProductionConfig,
+}
@@ -0,0 +1,313 @@
+"""Test database fixtures: one schema per process, one transaction per test.
+
+Test cases that subclass TransactionalTestCase share a schema that is
+created once per process, the first time a test needs it. Each test then
+runs inside a transaction that is rolled back when the test ends, so
+tests start from empty tables without any DDL:
+
+    app = create_app('testing')
+
+    class FeedTestCase(TransactionalTestCase):
+        app = app
+
+        def setUp(self):
+            super().setUp()
+            self.user = make_user()
+            db.session.commit()
+
+Inside a test, db.session works on that transaction's connection and
+its commits and rollbacks stop at a SAVEPOINT, so code under test
+behaves as usual: a commit makes data visible to the next request, a
+rollback undoes only what came after the last commit.
+
+Every pytest-xdist worker (`pytest -n 4`) gets a database of its own,
+named after the worker (see config.worker_database_url); a missing
+Postgres database is created.
+
+The make_* factories add users, messages, follows and likes the way the
+app does -- counters, search postings and fanned-out timelines included
+-- and make_users()/make_messages() insert many rows at once, for tests
+that need realistic numbers. Factories flush but don't commit.
+"""
+
+import functools
+import itertools
+from contextlib import contextmanager
+from unittest import TestCase
+
+from flask import has_app_context, has_request_context
+from sqlalchemy import Integer, create_engine, event, func, orm, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+from sqlalchemy.sql.dml import UpdateBase
+
+from actions import apply_follows, apply_likes
+from models import db, Message, User
+from passwords import hash_password
+from routing import RoutingSession
+from search import index_message
+from timeline import deliver_message
+
+PASSWORD = "password"
+
+_prepared = set()
+_sequence = itertools.count(1)
+
+
+##############################################################################
+# Schema and transactions
+
+
+def prepare_database(app):
+    """Create `app`'s database if need be and a fresh schema, once per
+    process."""
+
+    engine = db.get_engine(app)
+    url = str(engine.url)
+    if url in _prepared:
+        return
+
+    if engine.dialect.name == 'postgresql':
+        create_database(engine.url)
+
+    db.drop_all(app=app)
+    db.create_all(app=app)
+    _prepared.add(url)
+
+
+def create_database(url):
+    """Create the Postgres database of `url` unless it exists."""
+
+    admin_url = make_url(str(url))
+    admin_url.database = 'postgres'
+    admin = create_engine(admin_url, poolclass=NullPool,
+                          isolation_level='AUTOCOMMIT')
+
+    try:
+        with admin.connect() as conn:
+            found = conn.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                name=url.database).first()
+            if found is None:
+                quote = admin.dialect.identifier_preparer.quote
+                conn.execute(f"CREATE DATABASE {quote(url.database)}")
+    finally:
+        admin.dispose()
+
+
+def serial_columns():
+    """(table, column) names of the primary keys the database numbers."""
+
+    for table in db.metadata.sorted_tables:
+        key = list(table.primary_key)
+        if (len(key) == 1 and key[0].autoincrement in (True, 'auto')
+                and isinstance(key[0].type, Integer) and not key[0].foreign_keys):
+            yield table.name, key[0].name
+
+
+def restart_sequences(conn):
+    """Number new rows from 1 again, as after create_all().
+
+    Rolling back doesn't rewind Postgres sequences; SQLite reuses ids by
+    itself.
+    """
+
+    conn.execute(
+        text("SELECT setval(pg_get_serial_sequence(:table, :column), 1, false)"),
+        [dict(table=table, column=column) for table, column in serial_columns()])
+
+
+class SavepointSession(RoutingSession):
+    """Session whose commits and rollbacks end at a SAVEPOINT.
+
+    It runs on a connection whose transaction the test case rolls back,
+    and opens a new SAVEPOINT as soon as the last one ends.
+    """
+
+    def __init__(self, db, **options):
+        super().__init__(db, **options)
+        self.wrote = False
+        event.listen(self, 'after_transaction_end', self.restart_savepoint)
+        self.begin_savepoint()
+
+    def begin_savepoint(self):
+        self.begin_nested()
+        self.connection()
+
+    def restart_savepoint(self, session, transaction):
+        if transaction.nested and not transaction._parent.nested:
+            self.wrote = False
+            # what commit() at the top level would do
+            self.expire_all()
+            self.begin_savepoint()
+
+    def get_bind(self, mapper=None, clause=None):
+        if has_request_context() and (self._flushing
+                                      or isinstance(clause, UpdateBase)):
+            self.wrote = True
+        return super().get_bind(mapper, clause)
+
+    def close(self):
+        """End of an app context (db.session.remove()): drop what a
+        request wrote but didn't commit, and keep the test's transaction.
+
+        Loaded objects stay in the session, so a test can keep using
+        the ones it made after the client's requests.
+        """
+
+        if self.wrote:
+            self.rollback()
+
+    def end(self):
+        """Roll back to the last SAVEPOINT, and don't start another."""
+
+        event.remove(self, 'after_transaction_end', self.restart_savepoint)
+        self.rollback()
+
+
+class OuterTransaction:
+    """A connection in a transaction, with db.session moved onto it."""
+
+    def __init__(self, app):
+        self.conn = db.get_engine(app).connect()
+        self.sqlite = self.conn.dialect.name == 'sqlite'
+
+        if self.sqlite:
+            # pysqlite begins transactions by itself, but not before a
+            # SAVEPOINT, and then the first RELEASE would commit: take
+            # over and BEGIN explicitly
+            dbapi_conn = self.conn.connection.connection
+            self.isolation_level = dbapi_conn.isolation_level
+            dbapi_conn.isolation_level = None
+
+        self.transaction = self.conn.begin()
+        if self.sqlite:
+            self.conn.execute("BEGIN")
+        elif self.conn.dialect.name == 'postgresql':
+            restart_sequences(self.conn)
+
+        self.session = SavepointSession(db, bind=self.conn, binds={})
+        self.saved_session = db.session
+        db.session = orm.scoped_session(lambda: self.session)
+
+    def rollback(self):
+        db.session = self.saved_session
+        self.session.end()
+        self.transaction.rollback()
+        if self.sqlite:
+            self.conn.connection.connection.isolation_level = self.isolation_level
+        self.conn.close()
+
+
+class TransactionalTestCase(TestCase):
+    """TestCase whose tests each run in a transaction that is rolled back.
+
+    Subclasses set `app`; their setUp() calls super().setUp() first.
+    """
+
+    app = None
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        prepare_database(cls.app)
+
+    def setUp(self):
+        super().setUp()
+        transaction = OuterTransaction(self.app)
+        self.addCleanup(transaction.rollback)
+        self.client = self.app.test_client()
+
+
+##############################################################################
+# Factories
+
+
+@contextmanager
+def app_context():
+    """Some of the app's write helpers read current_app.config."""
+
+    if has_app_context():
+        yield
+    else:
+        with db.get_app().app_context():
+            yield
+
+
+@functools.lru_cache()
+def password_hash():
+    """Hash of PASSWORD, shared by all factory users."""
+
+    return hash_password(PASSWORD)
+
+
+def user_fields(**fields):
+    n = next(_sequence)
+    return {'username': f"user{n}",
+            'email': f"user{n}@test.com",
+            'password': password_hash(),
+            **fields}
+
+
+def make_user(**fields):
+    """A new user, whose password is PASSWORD unless `fields` say otherwise."""
+
+    user = User(**user_fields(**fields))
+    db.session.add(user)
+    db.session.flush()
+    return user
+
+
+def make_users(count, **fields):
+    """`count` new users with one multi-row INSERT, in id order."""
+
+    last_id = db.session.query(func.max(User.id)).scalar() or 0
+    db.session.execute(User.__table__.insert(),
+                       [user_fields(**fields) for _ in range(count)])
+    return User.query.filter(User.id > last_id).order_by(User.id).all()
+
+
+def make_message(user, text=None, **fields):
+    """A new message by `user`, counted, indexed and delivered."""
+
+    msg = Message(user_id=user.id,
+                  text=f"warble {next(_sequence)}" if text is None else text,
+                  **fields)
+    db.session.add(msg)
+    db.session.flush()
+    User.adjust_counters(user.id, messages_count=1)
+    with app_context():
+        deliver_message(msg)
+    index_message(msg)
+    return msg
+
+
+def make_messages(users, per_user=1):
+    """`per_user` new messages by each of `users`, flushed together."""
+
+    messages = [Message(user_id=user.id, text=f"warble {next(_sequence)}")
+                for user in users for _ in range(per_user)]
+    db.session.add_all(messages)
+    db.session.flush()
+
+    for user in users:
+        User.adjust_counters(user.id, messages_count=per_user)
+    with app_context():
+        for msg in messages:
+            deliver_message(msg)
+            index_message(msg)
+    return messages
+
+
+def make_follows(pairs):
+    """Make each (follower, followed) pair of users follow."""
+
+    with app_context():
+        apply_follows({(follower.id, followed.id): True
+                       for follower, followed in pairs})
+
+
+def make_likes(pairs):
+    """Make each (user, message) pair a like."""
+
+    apply_likes({(user.id, msg.id): True for user, msg in pairs})
@@ -0,0 +1,88 @@
+"""Keep database connections out of forked workers.
+
+Preforking servers (gunicorn --preload, uwsgi without lazy-apps) create
+the app once in a master process and fork workers from it. Anything the
+master has open is then shared by every worker: two processes talking on
+one database socket corrupt each other's results, and a worker that
+closes its copy closes the master's too.
+
+Two guards, for every engine of the app (primary and replicas):
+
+- just before each fork, the app's connection pools are emptied, so
+  children start with no pooled connections to share,
+- a connection checked out in a process other than the one that opened
+  it (one that was checked out across the fork) is dropped without
+  being closed, and the pool opens a fresh one.
+
+Other per-process state restarts on its own after a fork: the password
+pool and the write buffer thread check os.getpid(), and the write buffer
+drops actions queued before the fork (the parent flushes those).
+Services with state like that register with `reset_after_fork`.
+
+os.register_at_fork hooks can never be removed, so there is one pair
+for the whole process, registered at import. They go through weak sets
+of apps and services: creating many apps (as the tests do) adds no
+hooks, and an app that is gone is no longer visited.
+"""
+
+import os
+import weakref
+
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+from models import db
+
+
+@event.listens_for(Pool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    pid = os.getpid()
+    owner = connection_record.info.get('pid', pid)
+    if owner != pid:
+        # forget it without closing: closing would end the owner's session
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            f"Connection belongs to pid {owner}, not {pid}")
+
+
+def dispose_engines(app):
+    """Close the pooled connections of all of `app`'s engines."""
+
+    for bind in [None, *(app.config.get('SQLALCHEMY_BINDS') or ())]:
+        db.get_engine(app, bind=bind).dispose()
+
+
+_apps = weakref.WeakSet()
+_services = weakref.WeakSet()
+
+
+def _before_fork():
+    for app in list(_apps):
+        dispose_engines(app)
+
+
+def _after_fork_in_child():
+    for service in list(_services):
+        service.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_before_fork,
+                        after_in_child=_after_fork_in_child)
+
+
+def init_fork_safety(app):
+    """Empty `app`'s connection pools whenever this process forks."""
+
+    _apps.add(app)
+
+
+def reset_after_fork(service):
+    """Call `service.reset_after_fork()` in every child this process forks."""
+
+    _services.add(service)
@@ -0,0 +1,71 @@
+"""Cache of rendered message list items.
+
+The `<li>` for a message (avatar, username, date, text) looks the same to
+every viewer, so feeds render it once per process and reuse the HTML.
+Entries are keyed by (variant, message id, timestamp, author id, author
+version):
+
+- a message's text never changes after it is posted,
+- editing a profile bumps `User.version`, so the author's items get new
+  keys and the stale ones age out of the LRU, and
+- deleting a message drops its items with `forget_message()`.
+
+Anything that depends on the viewer (like, follow and delete buttons) is
+rendered per request and dropped into the cached HTML at ACTIONS_SLOT.
+Fragment templates get only the message and its author, never `g` or
+the session, so viewer state can't leak into the cache.
+
+FRAGMENT_CACHE_SIZE bounds the number of entries (0 disables caching).
+"""
+
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app
+from markupsafe import Markup
+
+ACTIONS_SLOT = "<!-- actions -->"
+
+DEFAULT_CACHE_SIZE = 10000
+
+_fragments = OrderedDict()
+_lock = Lock()
+
+
+def render_message(msg, variant='timeline', actions='', author=None):
+    """HTML for `msg` from messages/_<variant>_item.html.
+
+    `actions` is per-request HTML for the slot; `author` saves loading
+    `msg.user` when the caller already has it.
+    """
+
+    author = author or msg.user
+    key = (variant, msg.id, msg.timestamp, author.id, author.version)
+    size = current_app.config.get('FRAGMENT_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+
+    with _lock:
+        html = _fragments.get(key)
+        if html is not None:
+            _fragments.move_to_end(key)
+
+    if html is None:
+        template = current_app.jinja_env.get_template(
+            f'messages/_{variant}_item.html')
+        html = template.render(msg=msg, author=author,
+                               actions=Markup(ACTIONS_SLOT))
+
+        if size:
+            with _lock:
+                _fragments[key] = html
+                while len(_fragments) > size:
+                    _fragments.popitem(last=False)
+
+    return Markup(html.replace(ACTIONS_SLOT, str(actions), 1))
+
+
+def forget_message(message_id):
+    """Drop every cached item of `message_id` in this process."""
+
+    with _lock:
+        for key in [key for key in _fragments if key[1] == message_id]:
+            del _fragments[key]
@@ -2,13 +2,31 @@
 
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
-tweak the CSV formats or generate fewer/more rows.
+tweak the CSV formats or generate fewer/more rows, e.g. for capacity testing:
+
+    python generator/create_csvs.py --users 500000 --messages 10000000 \\
+        --follows 20000000 --likes 5000000 --workers 8 --out /tmp/warbler-10m
+
+Output is the same for the same sizes and --seed, whatever --workers is:
+rows are generated in fixed-size shards, each with its own seeded RNG,
+written to part files in parallel and concatenated in order. Nothing is
+fetched over the network.
+
+Who follows whom (and which messages get liked) follows a power law: a
+few accounts get most of the followers. Follows are drawn edge by edge,
+so memory stays proportional to one shard, never to users squared.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import math
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from multiprocessing import Pool
+from random import Random
+
 from faker import Faker
 from helpers import get_random_datetime
 
@@ -17,61 +35,192 @@ MAX_WARBLER_LENGTH = 140
 USERS_CSV_HEADERS = ['email', 'username', 'image_url', 'password', 'bio', 'header_image_url', 'location']
 MESSAGES_CSV_HEADERS = ['text', 'timestamp', 'user_id']
 FOLLOWS_CSV_HEADERS = ['user_being_followed_id', 'user_following_id']
+LIKES_CSV_HEADERS = ['user_id', 'message_id']
 
 NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
+NUM_LIKES = 0
+
+SHARD_SIZE = 50000
 
-fake = Faker()
+# messages are dated in the two years before this, so reruns match
+END_DATE = datetime(2021, 1, 1)
 
-# Generate random profile image URLs to use for users
+# bcrypt hash of "password"
+PASSWORD_HASH = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
 
-image_urls = [
+IMAGE_URLS = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
     for kind, count in [("lego", 10), ("men", 100), ("women", 100)]
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
-
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
+HEADER_IMAGE_URLS = [
+    "/static/images/warbler-hero.jpg",
+    "/static/images/signed-out-home.jpg",
 ]
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
+class PowerLaw:
+    """Draws ids 1..n with P(id) roughly proportional to 1 / popularity rank.
+
+    Sampling is O(1) time and memory: invert the CDF of a 1/x density to
+    get a rank, then scatter ranks over ids with a fixed permutation so
+    the most popular ids are not simply 1, 2, 3...
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self.log_n = math.log(n + 1)
+        self.step = next((p for p in (7919, 104729, 1299709, 15485863)
+                          if math.gcd(p, n) == 1), 1)
+
+    def draw(self, rng):
+        rank = min(int(math.exp(rng.random() * self.log_n)), self.n)
+        return (rank - 1) * self.step % self.n + 1
+
+
+def shards(total):
+    """(index, start, stop) ranges covering 0..total in SHARD_SIZE pieces."""
+
+    return [(i, start, min(start + SHARD_SIZE, total))
+            for i, start in enumerate(range(0, total, SHARD_SIZE))]
+
+
+def share(total, start, stop, population):
+    """How many of `total` rows belong to ids start..stop of `population`."""
+
+    return (total * stop // population) - (total * start // population)
+
+
+def seeded(args, kind, index):
+    seed = f"{args.seed}:{kind}:{index}"
+    fake = Faker()
+    fake.seed_instance(seed)
+    return Random(seed), fake
+
+
+def write_users(args, index, start, stop, writer):
+    rng, fake = seeded(args, 'users', index)
+
+    for user_id in range(start + 1, stop + 1):
+        username = f"{fake.user_name()}{user_id}"
+        writer.writerow(dict(
+            email=f"{username}@{fake.free_email_domain()}",
+            username=username,
+            image_url=rng.choice(IMAGE_URLS),
+            password=PASSWORD_HASH,
             bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
+            header_image_url=rng.choice(HEADER_IMAGE_URLS),
             location=fake.city()
         ))
 
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
 
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
+def write_messages(args, index, start, stop, writer):
+    rng, fake = seeded(args, 'messages', index)
+    authors = PowerLaw(args.users)
+
+    for _ in range(start, stop):
+        writer.writerow(dict(
             text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
+            timestamp=get_random_datetime(now=END_DATE, rng=rng),
+            user_id=authors.draw(rng)
         ))
 
-# Generate follows.csv from random pairings of users
 
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
+def write_pairs(rng, count, start, stop, targets, writer, row, no_self=False):
+    """`count` distinct (source, target) pairs with sources in start+1..stop.
+
+    Sources are disjoint between shards, so pairs are distinct overall.
+    """
+
+    count = min(count, (stop - start) * (targets.n - no_self))
+    seen = set()
+
+    while len(seen) < count:
+        source = rng.randrange(start + 1, stop + 1)
+        target = targets.draw(rng)
+        if (source, target) not in seen and not (no_self and source == target):
+            seen.add((source, target))
+            writer.writerow(row(source, target))
+
+
+def write_follows(args, index, start, stop, writer):
+    rng, _ = seeded(args, 'follows', index)
+    count = share(args.follows, start, stop, args.users)
+
+    write_pairs(rng, count, start, stop, PowerLaw(args.users), writer,
+                lambda follower, followed: dict(user_being_followed_id=followed,
+                                                user_following_id=follower),
+                no_self=True)
+
+
+def write_likes(args, index, start, stop, writer):
+    rng, _ = seeded(args, 'likes', index)
+    count = share(args.likes, start, stop, args.users)
+
+    write_pairs(rng, count, start, stop, PowerLaw(args.messages), writer,
+                lambda user_id, message_id: dict(user_id=user_id,
+                                                 message_id=message_id))
+
+
+TABLES = {
+    'users': (USERS_CSV_HEADERS, write_users, 'users'),
+    'messages': (MESSAGES_CSV_HEADERS, write_messages, 'messages'),
+    'follows': (FOLLOWS_CSV_HEADERS, write_follows, 'users'),
+    'likes': (LIKES_CSV_HEADERS, write_likes, 'users'),
+}
+
+
+def write_part(task):
+    args, table, index, start, stop, path = task
+    headers, write, _ = TABLES[table]
+
+    with open(path, 'w', newline='') as part:
+        write(args, index, start, stop, csv.DictWriter(part, fieldnames=headers))
+
+    return path
+
+
+def generate(args):
+    os.makedirs(args.out, exist_ok=True)
+    parts_dir = tempfile.mkdtemp(prefix='.parts-', dir=args.out)
+    tables = ['users', 'messages', 'follows'] + (['likes'] if args.likes else [])
+
+    tasks = []
+    for table in tables:
+        sharded_over = getattr(args, TABLES[table][2])
+        for index, start, stop in shards(sharded_over):
+            path = os.path.join(parts_dir, f"{table}.{index:06d}.csv")
+            tasks.append((args, table, index, start, stop, path))
+
+    try:
+        with Pool(args.workers) as pool:
+            parts = list(pool.imap(write_part, tasks))
+
+        for table in tables:
+            with open(os.path.join(args.out, f"{table}.csv"), 'w', newline='') as out:
+                csv.DictWriter(out, fieldnames=TABLES[table][0]).writeheader()
+                for path in parts:
+                    if os.path.basename(path).startswith(f"{table}."):
+                        with open(path) as part:
+                            shutil.copyfileobj(part, out)
+    finally:
+        shutil.rmtree(parts_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate Warbler seed CSVs.")
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--likes', type=int, default=NUM_LIKES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--out', default='generator')
+    generate(parser.parse_args())
 
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
 
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,14 @@
 """Support functions for CSV generation."""
 
-from datetime import datetime
-from random import uniform
+import random
+from datetime import datetime, timedelta
 
 
-def get_random_datetime(year_gap=2):
-    """Get a random datetime within the last few years."""
+def get_random_datetime(year_gap=2, now=None, rng=random):
+    """Get a random datetime within the few years before `now`."""
 
-    now = datetime.now()
+    now = now or datetime.now()
     then = now.replace(year=now.year - year_gap)
-    random_timestamp = uniform(then.timestamp(), now.timestamp())
+    seconds = rng.uniform(0, (now - then).total_seconds())
 
-    return datetime.fromtimestamp(random_timestamp)
+    return then + timedelta(seconds=seconds)
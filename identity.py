@@ -0,0 +1,167 @@
+"""Cheap loading of the logged-in user for every request.
+
+`add_user_to_g` used to load the full `User` row on every request. Most
+requests only need a handful of columns (the nav bar avatar, the home
+page card), so we keep a small per-process cache of those columns and
+only load the ORM object when a route actually touches something else.
+
+A cached snapshot is used while:
+
+- the request is a GET or HEAD. Writes always read the user again, so
+  they never act for a user who was deleted or changed elsewhere,
+- its stamp matches the stamp in the user's session. Routes that change
+  what the snapshot shows call `invalidate_identity()`, which bumps the
+  stamp in *this* browser's session, so whichever worker serves its next
+  request reloads, and
+- it is younger than IDENTITY_CACHE_TTL seconds. That bounds how long
+  other sessions see a stale snapshot: the same user's other browsers
+  after a profile edit, and anyone's changes to the counters (someone
+  following you).
+
+Whenever a route loads the full row (`CurrentUser.model`) the snapshot
+is checked against it: a newer `version` replaces the cached snapshot,
+and a user deleted in the meantime raises IdentityGone, which the app
+handles by logging the session out.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from flask import current_app, has_request_context, request, session
+
+from models import db, User
+from routing import READ_METHODS
+
+IDENTITY_STAMP_KEY = "curr_user_stamp"
+
+SNAPSHOT_FIELDS = (
+    'id',
+    'username',
+    'image_url',
+    'header_image_url',
+    'bio',
+    'location',
+    'messages_count',
+    'following_count',
+    'followers_count',
+    'likes_count',
+    'version',
+    'updated_at',
+)
+
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_CACHE_TTL = 60
+
+_snapshots = OrderedDict()
+_lock = Lock()
+
+
+class IdentityGone(Exception):
+    """The logged-in user was deleted after their snapshot was cached."""
+
+
+class CurrentUser:
+    """The logged-in user, as seen by routes and templates.
+
+    Attributes in SNAPSHOT_FIELDS come from the cached snapshot. Anything
+    else (relationships, password, ...) loads the full `User` row on first
+    use; routes that need the ORM object itself use `.model`.
+    """
+
+    def __init__(self, snapshot):
+        self._snapshot = snapshot
+        self._model = None
+
+    def __getattr__(self, name):
+        snapshot = self.__dict__['_snapshot']
+        if name in snapshot:
+            return snapshot[name]
+        return getattr(self.model, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.model, name, value)
+
+    def __repr__(self):
+        return f"<CurrentUser #{self.id}: {self.username}>"
+
+    @property
+    def model(self):
+        """The full `User` row, loaded on first use."""
+
+        if self._model is None:
+            model = User.query.get(self.id)
+            if model is None:
+                forget_identity(self.id)
+                raise IdentityGone(self.id)
+            if model.version != self._snapshot['version']:
+                self._snapshot = refresh_identity(model)
+            self._model = model
+        return self._model
+
+    following_ids = User.following_ids
+    follower_ids = User.follower_ids
+    is_following = User.is_following
+    is_followed_by = User.is_followed_by
+
+
+def load_identity(user_id):
+    """CurrentUser for `user_id`, or None if that user no longer exists."""
+
+    stamp = session.get(IDENTITY_STAMP_KEY, 0)
+    now = time.monotonic()
+    ttl = current_app.config.get('IDENTITY_CACHE_TTL', DEFAULT_CACHE_TTL)
+
+    if has_request_context() and request.method in READ_METHODS:
+        with _lock:
+            cached = _snapshots.get(user_id)
+            if cached and cached[0] == stamp and now - cached[1] < ttl:
+                _snapshots.move_to_end(user_id)
+                return CurrentUser(cached[2])
+
+    columns = [getattr(User, field) for field in SNAPSHOT_FIELDS]
+    row = db.session.query(*columns).filter(User.id == user_id).first()
+    if row is None:
+        forget_identity(user_id)
+        return None
+
+    snapshot = dict(zip(SNAPSHOT_FIELDS, row))
+    remember(user_id, stamp, now, snapshot)
+    return CurrentUser(snapshot)
+
+
+def refresh_identity(model):
+    """Replace the cached snapshot of `model`'s user with its columns."""
+
+    snapshot = {field: getattr(model, field) for field in SNAPSHOT_FIELDS}
+    remember(model.id, session.get(IDENTITY_STAMP_KEY, 0), time.monotonic(),
+             snapshot)
+    return snapshot
+
+
+def remember(user_id, stamp, now, snapshot):
+    size = current_app.config.get('IDENTITY_CACHE_SIZE', DEFAULT_CACHE_SIZE)
+
+    with _lock:
+        _snapshots[user_id] = (stamp, now, snapshot)
+        _snapshots.move_to_end(user_id)
+        while len(_snapshots) > size:
+            _snapshots.popitem(last=False)
+
+
+def forget_identity(user_id):
+    """Drop this process's cached snapshot of `user_id`."""
+
+    with _lock:
+        _snapshots.pop(user_id, None)
+
+
+def invalidate_identity(user_id):
+    """Make whichever worker serves this session's next request reload
+    `user_id`'s snapshot."""
+
+    forget_identity(user_id)
+    session[IDENTITY_STAMP_KEY] = session.get(IDENTITY_STAMP_KEY, 0) + 1
@@ -0,0 +1,218 @@
+"""Streaming bulk loader for CSV dumps (seed data and imports).
+
+Rows are read from each CSV a chunk at a time and written with the
+fastest path the database has:
+
+- Postgres: COPY ... FROM STDIN, one COPY per chunk
+- anything else (SQLite): executemany of one INSERT per chunk
+
+Each chunk is its own transaction, which also records how many rows of
+the file have been loaded in the load_checkpoints table. A chunk that
+fails because the connection dropped or the database is briefly
+unavailable (OperationalError, or an invalidated connection) is tried
+again, up to `retries` times; any other error stops the load at once.
+Running it again with resume=True skips exactly the rows that were
+committed.
+
+Secondary indexes on the tables being loaded (and, on Postgres, their
+foreign keys) are dropped before the first chunk and recreated after the
+last one, so the database builds each index once instead of updating it
+row by row. A load that fails leaves them dropped until a resumed load
+finishes.
+"""
+
+import csv
+import io
+import time
+from datetime import datetime
+from itertools import islice
+
+from flask import current_app
+from sqlalchemy import Column, DateTime, Integer, MetaData, Table, Text, inspect
+from sqlalchemy.exc import DBAPIError, OperationalError
+from sqlalchemy.schema import AddConstraint
+
+from models import db
+
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_RETRIES = 3
+
+# Not part of db.metadata: it only exists while a load is in progress.
+checkpoints = Table(
+    'load_checkpoints', MetaData(),
+    Column('table_name', Text, primary_key=True),
+    Column('rows', Integer, nullable=False),
+)
+
+
+def describe_progress(table, rows, seconds):
+    return f"{table}: {rows:,} rows ({rows / max(seconds, 1e-9):,.0f} rows/s)"
+
+
+def report_progress(table, rows, seconds):
+    """Default `progress` callback: log to the app's logger."""
+
+    current_app.logger.info(describe_progress(table, rows, seconds))
+
+
+def is_transient(error):
+    """Is `error` worth retrying the chunk for?"""
+
+    return (isinstance(error, OperationalError)
+            or error.connection_invalidated)
+
+
+def converters(table, fieldnames):
+    """Per-column functions turning CSV strings into Python values."""
+
+    def convert(column):
+        if isinstance(column.type, DateTime):
+            return lambda value: datetime.fromisoformat(value) if value else None
+        if isinstance(column.type, Integer):
+            return lambda value: int(value) if value else None
+        return lambda value: value
+
+    return {name: convert(table.c[name]) for name in fieldnames}
+
+
+def copy_chunk(connection, table, fieldnames, rows):
+    """Write one chunk with Postgres COPY."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow(row[name] for name in fieldnames)
+    buffer.seek(0)
+
+    columns = ", ".join(fieldnames)
+    statement = f"COPY {table.name} ({columns}) FROM STDIN WITH (FORMAT csv)"
+    cursor = connection.connection.cursor()
+    dbapi = connection.dialect.dbapi
+    try:
+        cursor.copy_expert(statement, buffer)
+    except dbapi.Error as exc:
+        # a raw cursor's errors aren't wrapped; wrap them like execute() does
+        raise DBAPIError.instance(statement, None, exc, dbapi.Error,
+                                  dialect=connection.dialect) from exc
+
+
+def insert_chunk(connection, table, fieldnames, rows):
+    """Write one chunk with executemany."""
+
+    convert = converters(table, fieldnames)
+    connection.execute(table.insert(), [
+        {name: convert[name](row[name]) for name in fieldnames}
+        for row in rows])
+
+
+def loaded_rows(table):
+    """Rows of `table`'s CSV committed by an earlier, unfinished load."""
+
+    rows = db.engine.execute(
+        checkpoints.select().where(checkpoints.c.table_name == table.name)
+    ).first()
+    return rows.rows if rows else 0
+
+
+def save_checkpoint(connection, table, rows):
+    connection.execute(
+        checkpoints.delete().where(checkpoints.c.table_name == table.name))
+    connection.execute(checkpoints.insert(), table_name=table.name, rows=rows)
+
+
+def load_csv(path, table, chunk_size=DEFAULT_CHUNK_SIZE,
+             retries=DEFAULT_RETRIES, progress=report_progress):
+    """Stream one CSV file into `table`, after any rows already loaded."""
+
+    engine = db.engine
+    write_chunk = (copy_chunk if engine.dialect.name == 'postgresql'
+                   else insert_chunk)
+
+    loaded = loaded_rows(table)
+    started = time.perf_counter()
+    resumed_at = loaded
+
+    with open(path, newline='') as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        rows = islice(reader, loaded, None)
+
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                return loaded
+
+            for attempt in range(1, retries + 1):
+                try:
+                    with engine.begin() as connection:
+                        write_chunk(connection, table, fieldnames, chunk)
+                        save_checkpoint(connection, table,
+                                        loaded + len(chunk))
+                    break
+                except DBAPIError as exc:
+                    if attempt == retries or not is_transient(exc):
+                        raise
+
+            loaded += len(chunk)
+            progress(table.name, loaded - resumed_at,
+                     time.perf_counter() - started)
+
+
+def drop_deferred(tables):
+    """Drop secondary indexes (and Postgres foreign keys) on `tables`.
+
+    Returns the schema items to recreate with `restore_deferred`.
+    """
+
+    engine = db.engine
+    inspector = inspect(engine)
+    deferred = []
+
+    for table in tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in existing:
+                index.drop(engine)
+            deferred.append(index)
+
+        if engine.dialect.name == 'postgresql':
+            for fk in inspector.get_foreign_keys(table.name):
+                engine.execute(f'ALTER TABLE {table.name} '
+                               f'DROP CONSTRAINT "{fk["name"]}"')
+            deferred.extend(table.foreign_key_constraints)
+
+    return deferred
+
+
+def restore_deferred(deferred):
+    """Recreate what `drop_deferred` dropped."""
+
+    engine = db.engine
+    for item in deferred:
+        if isinstance(item, db.Index):
+            item.create(engine)
+        else:
+            engine.execute(AddConstraint(item))
+
+
+def load_all(sources, chunk_size=DEFAULT_CHUNK_SIZE, resume=False,
+             retries=DEFAULT_RETRIES, progress=report_progress):
+    """Load (csv_path, model) pairs in order.
+
+    With resume=False any old checkpoints are discarded and every file is
+    loaded from the top; the tables are expected to be empty.
+    """
+
+    engine = db.engine
+    if not resume:
+        checkpoints.drop(engine, checkfirst=True)
+    checkpoints.create(engine, checkfirst=True)
+
+    tables = [model.__table__ for _, model in sources]
+    deferred = drop_deferred(tables)
+
+    for path, model in sources:
+        load_csv(path, model.__table__, chunk_size, retries, progress)
+
+    restore_deferred(deferred)
+    checkpoints.drop(engine)
@@ -1,19 +1,27 @@
 """SQLAlchemy models for Warbler."""
 
 # from app import profile
+import sqlite3
 from datetime import datetime
 
-from flask_bcrypt import Bcrypt, check_password_hash, generate_password_hash
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.engine import Engine
 
-bcrypt = Bcrypt()
-db = SQLAlchemy()
+from passwords import hash_password, check_password, needs_rehash
+from routing import RoutingSQLAlchemy
+
+db = RoutingSQLAlchemy()
 
 
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
     __tablename__ = 'follows'
+    __table_args__ = (
+        # the primary key leads with the followed user; timelines look
+        # follows up by follower, so they need this one
+        db.Index('ix_follows_user_following_id',
+                 'user_following_id', 'user_being_followed_id'),
+    )
 
     user_being_followed_id = db.Column(
         db.Integer,
@@ -31,7 +39,12 @@ class Follows(db.Model):
 class Likes(db.Model):
     """Mapping user likes to warbles."""
 
-    __tablename__ = 'likes' 
+    __tablename__ = 'likes'
+    __table_args__ = (
+        # also the index for "which of these did I like" lookups
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_id_message_id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -49,7 +62,7 @@ class Likes(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -63,8 +76,7 @@ class Likes(db.Model):
 
     message_id = db.Column(
         db.Integer,
-        db.ForeignKey('messages.id', ondelete='cascade'),
-        unique=True
+        db.ForeignKey('messages.id', ondelete='cascade')
     )
 
     @classmethod
@@ -75,6 +87,22 @@ class Likes(db.Model):
         )
         return like
 
+    @classmethod
+    def liked_ids(cls, user_id, message_ids):
+        """Which of `message_ids` user `user_id` has liked, as a set.
+
+        One query on the (user_id, message_id) unique index, however many
+        messages the user has liked overall.
+        """
+
+        if not message_ids:
+            return set()
+
+        return {message_id for message_id, in (
+            db.session
+            .query(cls.message_id)
+            .filter(cls.user_id == user_id, cls.message_id.in_(message_ids)))}
+
 
 class User(db.Model):
     """User in the system."""
@@ -123,7 +151,60 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message')
+    # Bumped whenever the profile is edited; caches of anything rendered
+    # from the profile key on it.
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # When anything shown on the profile last changed: edits and counter
+    # updates (including bulk ones) set it through onupdate.
+    updated_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow,
+        server_default=db.func.now(),
+    )
+
+    # Denormalized counts, kept in step by the routes that change them.
+    # `flask reconcile-counters` recomputes them from the source tables.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+        index=True,
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # messages.user_id cascades in the database; nulling it first, as the
+    # ORM would, breaks its NOT NULL
+    messages = db.relationship('Message', passive_deletes=True)
 
     followers = db.relationship(
         "User",
@@ -147,17 +228,39 @@ class User(db.Model):
     def __repr__(self):
         return f"<User #{self.id}: {self.username}, {self.email}>"
 
+    def following_ids(self):
+        """Set of ids of the users this user follows.
+
+        Loaded with one query the first time it is asked for and kept on
+        the instance (dropped again when `following` changes).
+        """
+
+        if self.__dict__.get('_following_ids') is None:
+            rows = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == self.id))
+            self._following_ids = {user_id for user_id, in rows}
+        return self._following_ids
+
+    def follower_ids(self):
+        """Set of ids of the users following this user (see following_ids)."""
+
+        if self.__dict__.get('_follower_ids') is None:
+            rows = (db.session
+                    .query(Follows.user_following_id)
+                    .filter(Follows.user_being_followed_id == self.id))
+            self._follower_ids = {user_id for user_id, in rows}
+        return self._follower_ids
+
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.follower_ids()
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids()
 
 
     @classmethod
@@ -167,7 +270,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hash_password(password)
 
         user = User(
             username=username,
@@ -191,22 +294,155 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A hash made at an outdated cost is replaced (in the session; the
+        caller commits). Raises passwords.PasswordBusy when the password
+        pool is saturated.
         """
 
         user = cls.query.filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = check_password(user.password, password)
             if is_auth:
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
                 return user
 
         return False
 
+    @classmethod
+    def adjust_counters(cls, user_id, **deltas):
+        """Add `deltas` to counter columns of user `user_id`.
+
+        Runs as a single UPDATE in the current transaction, e.g.
+        User.adjust_counters(5, followers_count=1).
+        """
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        (cls.query
+         .filter(cls.id == user_id)
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def release_counters(cls, user_id):
+        """Decrement other users' counters before user `user_id` is deleted."""
+
+        followed = (db.session
+                    .query(Follows.user_being_followed_id)
+                    .filter(Follows.user_following_id == user_id))
+        followers = (db.session
+                     .query(Follows.user_following_id)
+                     .filter(Follows.user_being_followed_id == user_id))
+        for ids, column in ((followed, cls.followers_count),
+                            (followers, cls.following_count)):
+            (cls.query
+             .filter(cls.id.in_(ids.subquery()))
+             .update({column: column - 1}, synchronize_session=False))
+
+        # a user may have liked several of this user's messages
+        liked = (db.session
+                 .query(db.func.count(Likes.id))
+                 .join(Message, Message.id == Likes.message_id)
+                 .filter(Message.user_id == user_id)
+                 .filter(Likes.user_id == cls.id)
+                 .correlate(cls)
+                 .as_scalar())
+        likers = (db.session
+                  .query(Likes.user_id)
+                  .join(Message, Message.id == Likes.message_id)
+                  .filter(Message.user_id == user_id))
+        (cls.query
+         .filter(cls.id.in_(likers.subquery()))
+         .update({cls.likes_count: cls.likes_count - liked},
+                 synchronize_session=False))
+
+        # and the messages this user liked lose a like each
+        liked_messages = (db.session
+                          .query(Likes.message_id)
+                          .filter(Likes.user_id == user_id))
+        (Message.query
+         .filter(Message.id.in_(liked_messages.subquery()))
+         .update({Message.likes_count: Message.likes_count - 1},
+                 synchronize_session=False))
+
+    @classmethod
+    def release_message_counters(cls, msg):
+        """Decrement counters that include `msg` before it is deleted."""
+
+        cls.adjust_counters(msg.user_id, messages_count=-1)
+
+        likers = (db.session
+                  .query(Likes.user_id)
+                  .filter(Likes.message_id == msg.id))
+        (cls.query
+         .filter(cls.id.in_(likers.subquery()))
+         .update({cls.likes_count: cls.likes_count - 1},
+                 synchronize_session=False))
+
+    @classmethod
+    def reconcile_counters(cls):
+        """Recompute every user's counters from the source tables."""
+
+        def count(column, match):
+            return (db.session
+                    .query(db.func.count(column))
+                    .filter(match == cls.id)
+                    .correlate(cls)
+                    .as_scalar())
+
+        (cls.query
+         .update({
+             cls.messages_count: count(Message.id, Message.user_id),
+             cls.following_count: count(Follows.user_being_followed_id,
+                                        Follows.user_following_id),
+             cls.followers_count: count(Follows.user_following_id,
+                                        Follows.user_being_followed_id),
+             cls.likes_count: count(Likes.id, Likes.user_id),
+         }, synchronize_session=False))
+
+
+# Trigram indexes for user search (see search.py). Postgres only; other
+# databases fall back to unindexed LIKE.
+for statement in (
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+        "CREATE INDEX ix_users_username_trgm ON users "
+        "USING gin (username gin_trgm_ops)",
+        "CREATE INDEX ix_users_bio_trgm ON users "
+        "USING gin (bio gin_trgm_ops)",
+        "CREATE INDEX ix_users_location_trgm ON users "
+        "USING gin (location gin_trgm_ops)"):
+    db.event.listen(User.__table__, 'after_create',
+                    db.DDL(statement).execute_if(dialect='postgresql'))
+
+
+@db.event.listens_for(User.following, 'append')
+@db.event.listens_for(User.following, 'remove')
+@db.event.listens_for(User.followers, 'append')
+@db.event.listens_for(User.followers, 'remove')
+def forget_follow_ids(user, other_user, initiator):
+    """Drop cached follow id sets when a follow is added or removed."""
+
+    for each in (user, other_user):
+        each._following_ids = None
+        each._follower_ids = None
+
+
+# What message lists use of an author: the templates show id, username
+# and image_url, version keys the fragment cache and updated_at goes
+# into Last-Modified.
+AUTHOR_FIELDS = ('id', 'username', 'image_url', 'version', 'updated_at')
+
 
 class Message(db.Model):
     """An individual message ("warble")."""
 
     __tablename__ = 'messages'
+    __table_args__ = (
+        db.Index('ix_messages_user_id_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_messages_timestamp', 'timestamp', 'id'),
+    )
 
     id = db.Column(
         db.Integer,
@@ -221,7 +457,7 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
     )
 
     user_id = db.Column(
@@ -230,8 +466,147 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Denormalized like count, kept in step by the like routes like the
+    # User counters are.
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def with_authors(cls):
+        """Message query that loads the authors of all the rows it returns
+        with one more SELECT, instead of one per message on first use.
+
+        Authors are loaded with AUTHOR_FIELDS only; other columns load on
+        access.
+        """
+
+        return cls.query.options(
+            db.selectinload(cls.user).load_only(*AUTHOR_FIELDS))
+
+    @classmethod
+    def adjust_counters(cls, message_id, **deltas):
+        """Add `deltas` to counter columns of message `message_id`.
+
+        Message.adjust_counters(5, likes_count=1), as User.adjust_counters.
+        """
+
+        values = {getattr(cls, name): getattr(cls, name) + delta
+                  for name, delta in deltas.items()}
+        (cls.query
+         .filter(cls.id == message_id)
+         .update(values, synchronize_session=False))
+
+    @classmethod
+    def reconcile_counters(cls):
+        """Recompute every message's like count from the likes table."""
+
+        likes = (db.session
+                 .query(db.func.count(Likes.id))
+                 .filter(Likes.message_id == cls.id)
+                 .correlate(cls)
+                 .as_scalar())
+        cls.query.update({cls.likes_count: likes}, synchronize_session=False)
+
+
+class MessageTerm(db.Model):
+    """Posting in the inverted index over message text (see search.py)."""
+
+    __tablename__ = 'message_terms'
+    __table_args__ = (
+        db.Index('ix_message_terms_message_id', 'message_id'),
+        db.Index('ix_message_terms_term_timestamp',
+                 'term', 'timestamp', 'message_id'),
+    )
+
+    term = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    # copied from the message so ranking never has to touch messages
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+
+class TimelineEntry(db.Model):
+    """A message delivered to one user's home timeline (fan-out-on-write)."""
+
+    __tablename__ = 'timeline_entries'
+    __table_args__ = (
+        db.Index('ix_timeline_entries_owner_id_author_id',
+                 'owner_id', 'author_id'),
+        db.Index('ix_timeline_entries_message_id', 'message_id'),
+    )
+
+    owner_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+
+class Recommendation(db.Model):
+    """One of a user's precomputed "who to follow" accounts (see
+    recommend.py)."""
+
+    __tablename__ = 'recommendations'
+    __table_args__ = (
+        db.Index('ix_recommendations_recommended_id', 'recommended_id'),
+    )
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        primary_key=True,
+    )
+
+    rank = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    recommended_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete='cascade'),
+        nullable=False,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -243,9 +618,22 @@ def connect_db(app):
     db.init_app(app)
 
 
+@db.event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    """Have SQLite enforce foreign keys, and so their ON DELETE CASCADE.
+
+    SQLite leaves them off unless each connection turns them on.
+    """
+
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 def authenticateCurrent(check_pw, current_password):
 
-    check_auth = bcrypt.generate_password_hash(check_pw)
+    check_auth = hash_password(check_pw)
     
     if check_auth == current_password:
         return True
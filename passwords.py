@@ -0,0 +1,190 @@
+"""Password hashing off the request workers.
+
+bcrypt is slow on purpose: at cost 12 a hash or check is ~250ms of CPU.
+Run inline, a burst of logins stalls every worker thread. Instead, hashes
+and checks go to a small process pool:
+
+- PASSWORD_POOL_WORKERS processes (default: one per core; 0 runs bcrypt
+  inline, as before),
+- at most PASSWORD_QUEUE_DEPTH calls queued or running per app process;
+  past that, calls fail fast with PasswordBusy instead of piling up,
+- a call waits at most PASSWORD_TIMEOUT seconds, then PasswordBusy.
+
+BCRYPT_LOG_ROUNDS sets the cost of new hashes. Hashes made at another
+cost still verify, and `needs_rehash()` tells login to store a new one.
+
+Each app keeps its settings and its pool in app.extensions['passwords'],
+so apps created with different configs don't overwrite each other's.
+Outside an app context the most recently configured app's pool is used,
+the way Flask-SQLAlchemy falls back to `db.app`. A pool is started on
+first use in each process (and again after a fork), so preloading the
+app in a server master doesn't share it.
+"""
+
+import os
+import threading
+import weakref
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from flask import current_app, has_app_context
+
+DEFAULT_LOG_ROUNDS = 12
+DEFAULT_TIMEOUT = 5
+DEFAULT_QUEUE_PER_WORKER = 4
+
+
+class PasswordBusy(Exception):
+    """Too many password checks in flight; try again shortly."""
+
+
+def _hash(password, log_rounds):
+    return bcrypt.hashpw(password.encode('utf-8'),
+                         bcrypt.gensalt(log_rounds)).decode('utf-8')
+
+
+def _check(pw_hash, password):
+    return bcrypt.checkpw(password.encode('utf-8'), pw_hash.encode('utf-8'))
+
+
+class PasswordPool:
+    """One app's password settings, and the processes that run bcrypt."""
+
+    def __init__(self, log_rounds=DEFAULT_LOG_ROUNDS, workers=None,
+                 queue_depth=None, timeout=DEFAULT_TIMEOUT):
+        self.log_rounds = log_rounds
+        self.workers = os.cpu_count() if workers is None else workers
+        self.queue_depth = (DEFAULT_QUEUE_PER_WORKER * max(self.workers, 1)
+                            if queue_depth is None else queue_depth)
+        self.timeout = timeout
+
+        self._pool = self._pool_pid = self._slots = None
+        self._lock = threading.Lock()
+        _pools.add(self)
+
+    def shutdown(self):
+        """Stop this process's pool; the next call starts a new one."""
+
+        with self._lock:
+            if self._pool is not None and self._pool_pid == os.getpid():
+                self._pool.shutdown(wait=False)
+            self._pool = self._pool_pid = self._slots = None
+
+    def reset_after_fork(self):
+        # a child can't use the parent's pool, or a lock held at fork time
+        self._pool = self._pool_pid = self._slots = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool_pid != os.getpid():
+                self._pool = ProcessPoolExecutor(self.workers)
+                self._pool_pid = os.getpid()
+                self._slots = threading.BoundedSemaphore(self.queue_depth)
+            return self._pool, self._slots
+
+    def run(self, fn, *args):
+        """`fn(*args)` in the pool, or inline with no workers."""
+
+        if not self.workers:
+            return fn(*args)
+
+        pool, slots = self._get_pool()
+        if not slots.acquire(blocking=False):
+            raise PasswordBusy("password queue is full")
+
+        try:
+            future = pool.submit(fn, *args)
+        except BrokenProcessPool:
+            slots.release()
+            self.shutdown()
+            raise PasswordBusy("password pool restarted")
+
+        # the slot stays taken until the work is done, even if we time out
+        future.add_done_callback(lambda _: slots.release())
+
+        try:
+            return future.result(timeout=self.timeout)
+        except TimeoutError:
+            future.cancel()
+            raise PasswordBusy("password check timed out")
+        except BrokenProcessPool:
+            self.shutdown()
+            raise PasswordBusy("password pool restarted")
+
+
+_pools = weakref.WeakSet()
+_latest = PasswordPool()
+
+
+def _reset_after_fork():
+    for pool in list(_pools):
+        pool.reset_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def init_passwords(app):
+    """Give `app` a password pool configured from `app.config`."""
+
+    global _latest
+
+    old = app.extensions.get('passwords')
+    if old is not None:
+        old.shutdown()
+
+    pool = PasswordPool(
+        log_rounds=app.config.get('BCRYPT_LOG_ROUNDS', DEFAULT_LOG_ROUNDS),
+        workers=app.config.get('PASSWORD_POOL_WORKERS'),
+        queue_depth=app.config.get('PASSWORD_QUEUE_DEPTH'),
+        timeout=app.config.get('PASSWORD_TIMEOUT', DEFAULT_TIMEOUT),
+    )
+    app.extensions['passwords'] = _latest = pool
+    return pool
+
+
+def current_pool():
+    """The current app's PasswordPool, else the last one configured."""
+
+    if has_app_context():
+        pool = current_app.extensions.get('passwords')
+        if pool is not None:
+            return pool
+    return _latest
+
+
+def shutdown_pool():
+    """Stop the current app's pool; the next call starts a new one."""
+
+    current_pool().shutdown()
+
+
+def hash_password(password, log_rounds=None):
+    """bcrypt hash of `password`, at the configured cost unless
+    `log_rounds` is given."""
+
+    if not password:
+        raise ValueError('Password must be non-empty.')
+    pool = current_pool()
+    return pool.run(_hash, password,
+                    pool.log_rounds if log_rounds is None else log_rounds)
+
+
+def check_password(pw_hash, password):
+    """Does `password` match `pw_hash`?"""
+
+    if not pw_hash or not password:
+        return False
+    return current_pool().run(_check, pw_hash, password)
+
+
+def needs_rehash(pw_hash):
+    """Was `pw_hash` made at a cost other than the configured one?"""
+
+    try:
+        return int(pw_hash.split('$')[2]) != current_pool().log_rounds
+    except (IndexError, ValueError):
+        return True
@@ -0,0 +1,164 @@
+"""Per-request SQL statistics and query budgets.
+
+Every statement run through SQLAlchemy is counted, timed and reduced to
+its "shape" (the SQL text with IN-lists collapsed). For each request the
+totals go out in response headers and to the app log:
+
+    X-Query-Count        statements executed
+    X-Query-Time-Ms      time spent in the database
+    X-Query-Duplicates   statements whose shape already ran in this
+                         request -- a high number usually means an N+1
+
+Tests put a ceiling on a block of code with `query_budget`:
+
+    with query_budget(4):
+        client.get('/')
+"""
+
+import re
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DEFAULT_DUPLICATE_WARNING = 5
+
+_active = threading.local()
+
+PARAM = r"(?:\?|%\(\w+\)s|%s|\$\d+)"
+IN_LIST_RE = re.compile(rf"IN \({PARAM}(?:, {PARAM})*\)")
+SPACE_RE = re.compile(r"\s+")
+
+
+class QueryBudgetExceeded(AssertionError):
+    """A block ran more statements than its query budget allows."""
+
+
+class QueryStats:
+    """Statements seen while this collector was active."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.shapes = Counter()
+
+    @property
+    def duplicates(self):
+        """Statements that repeated an earlier shape."""
+
+        return self.count - len(self.shapes)
+
+    def record(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+        self.shapes[shape_of(statement)] += 1
+
+    def summary(self):
+        return (f"{self.count} queries, {self.seconds * 1000:.1f} ms, "
+                f"{self.duplicates} duplicate")
+
+
+def shape_of(statement):
+    """`statement` with whitespace normalized and IN-lists collapsed."""
+
+    return IN_LIST_RE.sub("IN (...)", SPACE_RE.sub(" ", statement).strip())
+
+
+def active_collectors():
+    if not hasattr(_active, 'stack'):
+        _active.stack = []
+    return _active.stack
+
+
+@contextmanager
+def collect_queries():
+    """Collect statements run on this thread inside the block."""
+
+    stats = QueryStats()
+    stack = active_collectors()
+    stack.append(stats)
+    try:
+        yield stats
+    finally:
+        stack.remove(stats)
+
+
+@contextmanager
+def query_budget(max_queries):
+    """Fail with QueryBudgetExceeded if the block runs > `max_queries`."""
+
+    with collect_queries() as stats:
+        yield stats
+
+    if stats.count > max_queries:
+        shapes = "\n".join(f"  {n} x {shape}"
+                           for shape, n in stats.shapes.most_common())
+        raise QueryBudgetExceeded(
+            f"{stats.count} queries, budget was {max_queries}:\n{shapes}")
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_timer(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's own execution context, so one that raises
+    # (and never reaches after_cursor_execute) leaves nothing behind
+    if context is not None:
+        context._query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_query_started', None)
+    seconds = time.perf_counter() - started if started is not None else 0.0
+    for stats in active_collectors():
+        stats.record(statement, seconds)
+
+
+def init_query_stats(app):
+    """Collect query stats for every request of `app`.
+
+    Call before registering other before_request handlers so their
+    queries are counted too.
+    """
+
+    warn_at = app.config.get('QUERY_STATS_DUPLICATE_WARNING',
+                             DEFAULT_DUPLICATE_WARNING)
+
+    @app.before_request
+    def start_query_stats():
+        g.query_stats = QueryStats()
+        active_collectors().append(g.query_stats)
+
+    @app.after_request
+    def report_query_stats(response):
+        stats = g.pop('query_stats', None)
+        if stats is None:
+            return response
+
+        stack = active_collectors()
+        if stats in stack:
+            stack.remove(stats)
+
+        response.headers['X-Query-Count'] = str(stats.count)
+        response.headers['X-Query-Time-Ms'] = f"{stats.seconds * 1000:.1f}"
+        response.headers['X-Query-Duplicates'] = str(stats.duplicates)
+
+        app.logger.info("%s %s: %s", request.method, request.path,
+                        stats.summary())
+        if stats.duplicates >= warn_at:
+            shape, n = stats.shapes.most_common(1)[0]
+            app.logger.warning("%s %s: possible N+1, %d x %s",
+                               request.method, request.path, n, shape)
+
+        return response
+
+    @app.teardown_request
+    def drop_query_stats(exc):
+        # after_request is skipped when a view raises
+        stats = g.pop('query_stats', None)
+        stack = active_collectors()
+        if stats in stack:
+            stack.remove(stats)
@@ -0,0 +1,286 @@
+"""Who-to-follow recommendations, precomputed from the follow graph.
+
+Candidates for user u are the accounts two steps away in the follow
+graph, scored by the paths that lead to them:
+
+    1    per account u follows that follows them (friends of friends),
+    0.5  per follower of u that follows them,
+
+plus POPULARITY_WEIGHT * log(1 + followers), so that among accounts
+equally close to u the popular ones come first. With A the follow
+matrix (A[x, y] = 1 if x follows y) the path scores are row u of
+A.A + 0.5 * A'.A. Accounts u already follows, and u, are left out. When
+the neighborhood has fewer than RECOMMENDATIONS_SIZE candidates, the
+most-followed accounts fill the rest.
+
+Each user's best RECOMMENDATIONS_SIZE are stored in `recommendations`,
+one row per rank, so serving them is a single range scan on the
+primary key (`recommended_users`).
+
+- `flask recommend` recomputes everyone: it reads follows once into
+  per-user id arrays and sums neighbors' rows, the sparse product above
+  one row at a time.
+- Every follow or unfollow recomputes the follower's own list in the
+  same transaction, from their neighborhood alone (see
+  actions.apply_follows). Other users' lists pick up the change at the
+  next `flask recommend`.
+
+Both paths score the same way, so they agree -- as long as the user
+follows and is followed by at most REFRESH_MAX_NEIGHBORS accounts.
+Past that, a refresh reads only the first REFRESH_MAX_NEIGHBORS of each
+(by id), so a follow by someone with a million followers costs the same
+as anyone else's; their list is approximate until the next `flask
+recommend`.
+"""
+
+import heapq
+import math
+from array import array
+from collections import Counter, defaultdict
+
+from models import db, Follows, Recommendation, User
+
+RECOMMENDATIONS_SIZE = 5
+
+# Path-score leaders per user that get popularity added and re-ranked
+CANDIDATES_PER_USER = 50
+
+FOLLOWER_PATH_WEIGHT = 0.5
+POPULARITY_WEIGHT = 0.25
+
+WRITE_CHUNK_SIZE = 5000
+
+# Follows and followers read per user by refresh_recommendations
+REFRESH_MAX_NEIGHBORS = 200
+
+
+def path_scores(user_id, following, followers, follows_of):
+    """{candidate: path score} for `user_id`.
+
+    `follows_of(x)` is the ids `x` follows.
+    """
+
+    paths = Counter()
+    for followed in following:
+        paths.update(follows_of(followed))
+
+    if followers:
+        from_followers = Counter()
+        for follower in followers:
+            from_followers.update(follows_of(follower))
+        for candidate, count in from_followers.items():
+            paths[candidate] += FOLLOWER_PATH_WEIGHT * count
+
+    paths.pop(user_id, None)
+    for followed in following:
+        paths.pop(followed, None)
+    return paths
+
+
+def leaders(paths):
+    """The CANDIDATES_PER_USER best (candidate, path score)s; ties go to
+    older accounts."""
+
+    return heapq.nlargest(CANDIDATES_PER_USER, paths.items(),
+                          key=lambda item: (item[1], -item[0]))
+
+
+def rank(user_id, following, candidates, popularity, popular):
+    """The best RECOMMENDATIONS_SIZE [(id, score)] for `user_id`.
+
+    `candidates` are (id, path score)s, `popularity` maps ids to follower
+    counts, and `popular` is the most-followed ids, most followed first.
+    """
+
+    scored = [(candidate, paths + POPULARITY_WEIGHT
+               * math.log1p(popularity.get(candidate, 0)))
+              for candidate, paths in candidates]
+    best = heapq.nlargest(RECOMMENDATIONS_SIZE, scored,
+                          key=lambda item: (item[1], -item[0]))
+
+    taken = {candidate for candidate, _ in best}
+    for candidate in popular:
+        if len(best) == RECOMMENDATIONS_SIZE:
+            break
+        if (candidate != user_id and candidate not in following
+                and candidate not in taken):
+            best.append((candidate, POPULARITY_WEIGHT
+                         * math.log1p(popularity.get(candidate, 0))))
+
+    return best
+
+
+def popular_accounts():
+    """{id: followers} of the most-followed accounts, as many as anyone
+    could need to top up a list."""
+
+    limit = RECOMMENDATIONS_SIZE + CANDIDATES_PER_USER
+    return dict(db.session
+                .query(User.id, User.followers_count)
+                .filter(User.followers_count > 0)
+                .order_by(User.followers_count.desc(), User.id)
+                .limit(limit))
+
+
+def store(ranked):
+    """Replace the stored lists of the users in {user_id: [(id, score)]}."""
+
+    (Recommendation
+     .query
+     .filter(Recommendation.user_id.in_(list(ranked)))
+     .delete(synchronize_session=False))
+    insert(ranked)
+
+
+def insert(ranked):
+    rows = [dict(user_id=user_id, rank=n, recommended_id=candidate,
+                 score=score)
+            for user_id, best in ranked.items()
+            for n, (candidate, score) in enumerate(best, 1)]
+    if rows:
+        db.session.execute(Recommendation.__table__.insert(), rows)
+
+
+def compute_recommendations():
+    """Recompute every user's list. Returns the number of rows written.
+
+    The caller commits.
+    """
+
+    follows_of = defaultdict(lambda: array('i'))
+    followers_of = defaultdict(lambda: array('i'))
+    for follower, followed in (db.session
+                               .query(Follows.user_following_id,
+                                      Follows.user_being_followed_id)
+                               .yield_per(WRITE_CHUNK_SIZE)):
+        follows_of[follower].append(followed)
+        followers_of[followed].append(follower)
+
+    popularity = {user_id: len(followers)
+                  for user_id, followers in followers_of.items()}
+    popular = sorted(popularity, key=lambda user_id: (-popularity[user_id], user_id))
+    popular = popular[:RECOMMENDATIONS_SIZE + CANDIDATES_PER_USER]
+
+    def outgoing(user_id):
+        return follows_of.get(user_id, ())
+
+    Recommendation.query.delete(synchronize_session=False)
+
+    written = 0
+    ranked = {}
+    for user_id, in db.session.query(User.id).order_by(User.id):
+        following = set(outgoing(user_id))
+        paths = path_scores(user_id, following,
+                            followers_of.get(user_id, ()), outgoing)
+        best = rank(user_id, following, leaders(paths), popularity, popular)
+        if best:
+            ranked[user_id] = best
+            written += len(best)
+
+        if len(ranked) * RECOMMENDATIONS_SIZE >= WRITE_CHUNK_SIZE:
+            insert(ranked)
+            ranked = {}
+
+    insert(ranked)
+    return written
+
+
+def first_ids(query, column, limit):
+    """The `limit` lowest `column`s of `query`, and whether there were more."""
+
+    ids = [id for id, in query.order_by(column).limit(limit + 1)]
+    return set(ids[:limit]), len(ids) > limit
+
+
+def refresh_recommendations(user_ids, max_neighbors=REFRESH_MAX_NEIGHBORS):
+    """Recompute the lists of `user_ids` from their neighborhoods.
+
+    A handful of queries per user, reading only the follows of at most
+    `max_neighbors` accounts they follow and `max_neighbors` followers.
+    The caller commits.
+    """
+
+    popular = None
+    ranked = {}
+
+    for user_id in user_ids:
+        following, more_following = first_ids(
+            db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id),
+            Follows.user_being_followed_id, max_neighbors)
+        followers, _ = first_ids(
+            db.session
+            .query(Follows.user_following_id)
+            .filter(Follows.user_being_followed_id == user_id),
+            Follows.user_following_id, max_neighbors)
+
+        follows_of = defaultdict(list)
+        neighbors = following | followers
+        if neighbors:
+            for follower, followed in (db.session
+                                       .query(Follows.user_following_id,
+                                              Follows.user_being_followed_id)
+                                       .filter(Follows.user_following_id
+                                               .in_(neighbors))):
+                follows_of[follower].append(followed)
+
+        candidates = leaders(path_scores(user_id, following, followers,
+                                         lambda user: follows_of.get(user, ())))
+
+        if more_following:
+            # path_scores only left out the follows we read; look up the
+            # rest among the ids that could end up on the list
+            if popular is None:
+                popular = popular_accounts()
+            maybe = [candidate for candidate, _ in candidates] + list(popular)
+            following |= {followed for followed, in (
+                db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == user_id)
+                .filter(Follows.user_being_followed_id.in_(maybe)))}
+            candidates = [(candidate, paths) for candidate, paths in candidates
+                          if candidate not in following]
+
+        popularity = {}
+        if candidates:
+            popularity = dict(db.session
+                              .query(User.id, User.followers_count)
+                              .filter(User.id.in_([candidate for candidate, _
+                                                   in candidates])))
+
+        if len(candidates) < RECOMMENDATIONS_SIZE:
+            if popular is None:
+                popular = popular_accounts()
+            popularity.update(popular)
+
+        ranked[user_id] = rank(user_id, following, candidates, popularity,
+                               popular or ())
+
+    store(ranked)
+
+
+def recommended_users(user_id, exclude=()):
+    """The users recommended to `user_id`, best first, minus `exclude`.
+
+    One query: a range scan on the recommendations primary key, joined
+    to users.
+    """
+
+    users = (User
+             .query
+             .join(Recommendation, Recommendation.recommended_id == User.id)
+             .filter(Recommendation.user_id == user_id)
+             .order_by(Recommendation.rank)
+             .all())
+    return [user for user in users if user.id not in exclude]
+
+
+def forget_user(user_id):
+    """Remove a deleted user's list and their place in other lists."""
+
+    (Recommendation
+     .query
+     .filter((Recommendation.user_id == user_id)
+             | (Recommendation.recommended_id == user_id))
+     .delete(synchronize_session=False))
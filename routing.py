@@ -0,0 +1,100 @@
+"""Send read-only requests to read replicas.
+
+Replicas are ordinary Flask-SQLAlchemy binds listed in REPLICA_BINDS:
+
+    SQLALCHEMY_BINDS = {'replica_1': 'postgresql:///warbler_replica'}
+    REPLICA_BINDS = ['replica_1']
+
+The session picks an engine per statement:
+
+- outside a request (CLI, seeding, tests driving models directly): the
+  primary,
+- in a GET or HEAD request: one replica, chosen at random when the
+  request first touches the database and kept for the whole request,
+- flushes and INSERT/UPDATE/DELETE statements: the primary. After the
+  first write, the rest of the request reads from the primary too.
+
+A request that wrote marks the browser session as sticky for
+REPLICA_STICKY_SECONDS, and its GETs read from the primary until then,
+so users see their own writes (the redirect after a POST, say) even if
+the replicas lag. Other users' writes show up as fast as replication
+allows.
+
+With no REPLICA_BINDS everything goes to the primary, as before.
+"""
+
+import random
+import time
+
+from flask import g, has_request_context, request, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm
+from sqlalchemy.sql.dml import UpdateBase
+
+STICKY_KEY = "db_primary_until"
+DEFAULT_STICKY_SECONDS = 5
+
+READ_METHODS = ('GET', 'HEAD')
+
+
+def replica_bind(app):
+    """Replica bind key for this request, or None for the primary."""
+
+    if not has_request_context():
+        return None
+
+    if 'db_replica' not in g:
+        binds = app.config.get('REPLICA_BINDS')
+        if (not binds or request.method not in READ_METHODS
+                or session.get(STICKY_KEY, 0) > time.time()):
+            g.db_replica = None
+        else:
+            g.db_replica = random.choice(binds)
+
+    return g.db_replica
+
+
+def note_write():
+    """Send the rest of this request, and this user's next ones, to the
+    primary."""
+
+    if has_request_context():
+        g.db_replica = None
+        g.db_wrote = True
+
+
+class RoutingSession(SignallingSession):
+    """Session that reads from a replica when `replica_bind()` says so."""
+
+    def __init__(self, db, **options):
+        self._db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing or isinstance(clause, UpdateBase):
+            note_write()
+        else:
+            bind = replica_bind(self.app)
+            if bind is not None:
+                return self._db.get_engine(self.app, bind=bind)
+
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy whose sessions route reads to replicas."""
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def init_routing(app):
+    """Make users who just wrote read from the primary for a while."""
+
+    sticky = app.config.get('REPLICA_STICKY_SECONDS', DEFAULT_STICKY_SECONDS)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if g.get('db_wrote') and app.config.get('REPLICA_BINDS'):
+            session[STICKY_KEY] = time.time() + sticky
+        return response
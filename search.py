@@ -0,0 +1,245 @@
+"""User and message search for Warbler.
+
+User search matches the query against username, bio and location and ranks results:
+
+    0  username is the query (case-insensitive)
+    1  username starts with the query
+    2  username contains the query
+    3  bio or location contains the query
+
+On Postgres the ILIKE filters are served by pg_trgm GIN indexes (created
+with the users table, see models.py) and ties within a rank are broken by
+trigram similarity to the username. Anywhere else -- SQLite in tests and
+local runs -- the same query runs as a plain LIKE scan.
+
+Message search uses an inverted index, the message_terms table: one row
+per (term, message). It is kept up to date as messages are added and
+deleted, and `flask index-messages` rebuilds it from scratch. A query
+reads only the postings of its own terms, never the messages table.
+Results are ranked by how many of the query's terms a message contains,
+then by recency. See benchmarks/bench_message_search.py.
+"""
+
+import re
+from datetime import datetime
+
+from sqlalchemy import case, func, or_, tuple_
+
+from models import db, User, Message, MessageTerm
+from timeline import pack_cursor, unpack_cursor
+
+USER_SEARCH_PAGE_SIZE = 30
+MESSAGE_SEARCH_PAGE_SIZE = 50
+MAX_QUERY_TERMS = 8
+INDEX_CHUNK_SIZE = 5000
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset("""
+    a an and are as at be but by for from has have i in is it its of on or
+    so that the this to was were will with you
+""".split())
+
+
+def like_pattern(text, prefix=False):
+    """LIKE pattern matching `text` literally (wildcards escaped)."""
+
+    escaped = (text
+               .replace("\\", "\\\\")
+               .replace("%", "\\%")
+               .replace("_", "\\_"))
+    return f"{escaped}%" if prefix else f"%{escaped}%"
+
+
+def search_users(q, page=1, per_page=USER_SEARCH_PAGE_SIZE):
+    """One page of users matching `q`, best matches first.
+
+    Returns (users, has_next).
+    """
+
+    q = q.strip()
+    contains = like_pattern(q)
+    starts = like_pattern(q, prefix=True)
+
+    rank = case([
+        (func.lower(User.username) == q.lower(), 0),
+        (User.username.ilike(starts, escape="\\"), 1),
+        (User.username.ilike(contains, escape="\\"), 2),
+    ], else_=3)
+
+    order = [rank]
+    if db.engine.dialect.name == 'postgresql':
+        order.append(func.similarity(User.username, q).desc())
+    order.append(User.username)
+
+    query = (User
+             .query
+             .filter(or_(User.username.ilike(contains, escape="\\"),
+                         User.bio.ilike(contains, escape="\\"),
+                         User.location.ilike(contains, escape="\\")))
+             .order_by(*order))
+
+    return page_of(query, page, per_page)
+
+
+def list_all_users(page=1, per_page=USER_SEARCH_PAGE_SIZE):
+    """One page of every user, oldest accounts first. Returns (users, has_next)."""
+
+    return page_of(User.query.order_by(User.id), page, per_page)
+
+
+def page_of(query, page, per_page):
+    users = query.offset((page - 1) * per_page).limit(per_page + 1).all()
+    return users[:per_page], len(users) > per_page
+
+
+##############################################################################
+# Message search
+
+
+def tokenize(text):
+    """Distinct index terms in `text`, in order of first appearance."""
+
+    terms = {}
+    for token in TOKEN_RE.findall(text.lower()):
+        if len(token) > 1 and token not in STOPWORDS:
+            terms.setdefault(token, None)
+    return list(terms)
+
+
+def index_message(msg):
+    """Add postings for a new message. The caller commits."""
+
+    rows = [dict(term=term, message_id=msg.id, timestamp=msg.timestamp)
+            for term in tokenize(msg.text)]
+    if rows:
+        db.session.execute(MessageTerm.__table__.insert(), rows)
+
+
+def unindex_message(message_id):
+    """Remove postings for a message that is being deleted."""
+
+    (MessageTerm
+     .query
+     .filter(MessageTerm.message_id == message_id)
+     .delete(synchronize_session=False))
+
+
+def build_message_index(chunk_size=INDEX_CHUNK_SIZE):
+    """Rebuild message_terms from the messages table.
+
+    Walks messages in id order, chunk_size at a time, and returns the
+    number of messages indexed. The caller commits.
+    """
+
+    MessageTerm.query.delete(synchronize_session=False)
+
+    indexed = 0
+    last_id = 0
+    while True:
+        chunk = (db.session
+                 .query(Message.id, Message.text, Message.timestamp)
+                 .filter(Message.id > last_id)
+                 .order_by(Message.id)
+                 .limit(chunk_size)
+                 .all())
+        if not chunk:
+            return indexed
+
+        rows = [dict(term=term, message_id=message_id, timestamp=timestamp)
+                for message_id, text, timestamp in chunk
+                for term in tokenize(text)]
+        if rows:
+            db.session.execute(MessageTerm.__table__.insert(), rows)
+
+        indexed += len(chunk)
+        last_id = chunk[-1].id
+
+
+def encode_search_cursor(matched, timestamp, message_id):
+    return pack_cursor(matched, timestamp, message_id)
+
+
+def decode_search_cursor(cursor):
+    """(matched, timestamp, id) from a cursor; raises ValueError if garbage."""
+
+    return unpack_cursor(cursor, int, datetime.fromisoformat, int)
+
+
+def single_term_hits(term, before, limit):
+    """(message_id, 1, timestamp) rows for one term, newest first.
+
+    Every hit matches equally well, so this is a plain range scan on
+    ix_message_terms_term_timestamp with no grouping.
+    """
+
+    query = (db.session
+             .query(MessageTerm.message_id, MessageTerm.timestamp)
+             .filter(MessageTerm.term == term))
+
+    if before:
+        _, timestamp, message_id = before
+        query = query.filter(tuple_(MessageTerm.timestamp, MessageTerm.message_id)
+                             < (timestamp, message_id))
+
+    rows = (query
+            .order_by(MessageTerm.timestamp.desc(),
+                      MessageTerm.message_id.desc())
+            .limit(limit))
+
+    return [(message_id, 1, timestamp) for message_id, timestamp in rows]
+
+
+def multi_term_hits(terms, before, limit):
+    """(message_id, matched, timestamp) rows, most terms matched first.
+
+    Groups every posting of every term, so the cost grows with how common
+    the terms are.
+    """
+
+    matched = func.count(MessageTerm.term)
+    newest = func.max(MessageTerm.timestamp)
+
+    query = (db.session
+             .query(MessageTerm.message_id, matched, newest)
+             .filter(MessageTerm.term.in_(terms))
+             .group_by(MessageTerm.message_id))
+
+    if before:
+        query = query.having(
+            tuple_(matched, newest, MessageTerm.message_id) < before)
+
+    return (query
+            .order_by(matched.desc(), newest.desc(),
+                      MessageTerm.message_id.desc())
+            .limit(limit)
+            .all())
+
+
+def search_messages(q, cursor=None, size=MESSAGE_SEARCH_PAGE_SIZE):
+    """One page of messages matching `q`, best and newest first.
+
+    Returns (messages, next_cursor); raises ValueError for a bad cursor.
+    """
+
+    terms = tokenize(q)[:MAX_QUERY_TERMS]
+    if not terms:
+        return [], None
+
+    before = decode_search_cursor(cursor) if cursor else None
+
+    if len(terms) == 1:
+        hits = single_term_hits(terms[0], before, size + 1)
+    else:
+        hits = multi_term_hits(terms, before, size + 1)
+
+    next_cursor = None
+    if len(hits) > size:
+        hits = hits[:size]
+        message_id, matched_terms, timestamp = hits[-1]
+        next_cursor = encode_search_cursor(matched_terms, timestamp, message_id)
+
+    positions = {message_id: i for i, (message_id, _, _) in enumerate(hits)}
+    messages = Message.with_authors().filter(Message.id.in_(positions)).all()
+    messages.sort(key=lambda msg: positions[msg.id])
+
+    return messages, next_cursor
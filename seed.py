@@ -1,20 +1,49 @@
 """Seed database with sample data from CSV Files."""
 
-from csv import DictReader
-from app import db
-from models import User, Message, Follows
+import os
 
-def seed_database():
-    db.drop_all()
-    db.create_all()
+from models import db, User, Message, Follows, Likes
+from loader import load_all, report_progress, DEFAULT_CHUNK_SIZE
+from recommend import compute_recommendations
+from search import build_message_index
 
-    with open('generator/users.csv') as users:
-        db.session.bulk_insert_mappings(User, DictReader(users))
+SEED_FILES = [
+    ('generator/users.csv', User),
+    ('generator/messages.csv', Message),
+    ('generator/follows.csv', Follows),
+]
 
-    with open('generator/messages.csv') as messages:
-        db.session.bulk_insert_mappings(Message, DictReader(messages))
+# only written by create_csvs.py when asked for --likes
+LIKES_FILE = ('generator/likes.csv', Likes)
 
-    with open('generator/follows.csv') as follows:
-        db.session.bulk_insert_mappings(Follows, DictReader(follows))
 
+def seed_sources():
+    """(csv path, model) pairs to load, in load order."""
+
+    sources = list(SEED_FILES)
+    if os.path.exists(LIKES_FILE[0]):
+        sources.append(LIKES_FILE)
+    return sources
+
+
+def seed_database(chunk_size=DEFAULT_CHUNK_SIZE, resume=False,
+                  progress=report_progress):
+    """Load the seed CSVs into a fresh database.
+
+    With resume=True, keep the tables and carry on from the last chunk
+    an interrupted seed committed (see loader.py). `progress` is called
+    after every chunk, as in `loader.load_csv`.
+    """
+
+    if not resume:
+        db.drop_all()
+        db.create_all()
+
+    load_all(seed_sources(), chunk_size=chunk_size, resume=resume,
+             progress=progress)
+
+    User.reconcile_counters()
+    Message.reconcile_counters()
+    build_message_index()
+    compute_recommendations()
     db.session.commit()
@@ -0,0 +1,201 @@
+"""Snapshots of the seeded database, for instant reseeding.
+
+Seeding drops the tables and loads the seed CSVs again, every time.
+`restore_or_seed()`, which `flask seed` uses, seeds once and keeps a
+copy of the result:
+
+- SQLite: a copy of the database file, next to it or in
+  SEED_SNAPSHOT_DIR, named <database>.seed-<fingerprint>.db,
+- Postgres: a template database, <database>_seed_<fingerprint>, cloned
+  with CREATE DATABASE ... TEMPLATE.
+
+Later runs put that copy in place of the database instead of seeding,
+which takes milliseconds. The fingerprint is a hash of the seed CSVs,
+the schema DDL (tables and indexes, as the database's dialect writes
+it) and SEED_VERSION, so changing any of them builds a new snapshot and
+removes the old ones. Bump SEED_VERSION when seed_database() changes
+what it writes without the CSVs or the schema changing.
+
+Restoring replaces the database, exactly like seeding does: local
+changes are lost. Other databases (and SQLite in memory) are just
+seeded, as before. SEED_SNAPSHOTS = False turns snapshots off.
+"""
+
+import glob
+import hashlib
+import os
+import shutil
+import time
+from collections import namedtuple
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from loader import DEFAULT_CHUNK_SIZE, report_progress
+from models import db
+from seed import seed_database, seed_sources
+
+SEED_VERSION = 1
+
+FINGERPRINT_LENGTH = 12
+
+# how: 'restored' from a snapshot, 'built' a new snapshot, or 'seeded'
+# without one; fingerprint is None when seeded
+SeedOutcome = namedtuple('SeedOutcome', 'how fingerprint seconds')
+
+
+def seed_fingerprint(engine, sources=None):
+    """Hash of everything a seeded database is built from."""
+
+    digest = hashlib.sha256(f"seed-version {SEED_VERSION}\n".encode())
+
+    for table in db.metadata.sorted_tables:
+        digest.update(str(CreateTable(table).compile(dialect=engine.dialect)).encode())
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            digest.update(str(CreateIndex(index).compile(dialect=engine.dialect)).encode())
+
+    for path, model in (seed_sources() if sources is None else sources):
+        digest.update(f"{model.__tablename__}\n".encode())
+        with open(path, 'rb') as source:
+            for block in iter(lambda: source.read(1 << 16), b''):
+                digest.update(block)
+
+    return digest.hexdigest()[:FINGERPRINT_LENGTH]
+
+
+def restore_or_seed(app, chunk_size=DEFAULT_CHUNK_SIZE,
+                    progress=report_progress):
+    """Give `app` a freshly seeded database, from a snapshot if we can.
+
+    Returns a SeedOutcome: how the database was made, from which
+    snapshot, and how long it took.
+    """
+
+    engine = db.get_engine(app)
+    started = time.perf_counter()
+
+    if engine.dialect.name == 'sqlite':
+        snapshots = SQLiteSnapshots(engine, app.config.get('SEED_SNAPSHOT_DIR'))
+    elif engine.dialect.name == 'postgresql':
+        snapshots = PostgresSnapshots(engine)
+    else:
+        snapshots = None
+
+    if (snapshots is None or not snapshots.supported()
+            or not app.config.get('SEED_SNAPSHOTS', True)):
+        seed_database(chunk_size=chunk_size, progress=progress)
+        return SeedOutcome('seeded', None, time.perf_counter() - started)
+
+    fingerprint = seed_fingerprint(engine)
+
+    if snapshots.exists(fingerprint):
+        db.session.remove()
+        engine.dispose()
+        snapshots.restore(fingerprint)
+        how = 'restored'
+    else:
+        seed_database(chunk_size=chunk_size, progress=progress)
+        db.session.remove()
+        engine.dispose()
+        snapshots.build(fingerprint)
+        how = 'built'
+
+    return SeedOutcome(how, fingerprint, time.perf_counter() - started)
+
+
+class SQLiteSnapshots:
+    """Snapshots as copies of the database file."""
+
+    def __init__(self, engine, directory=None):
+        self.path = engine.url.database
+        self.directory = directory or os.path.dirname(os.path.abspath(self.path))
+
+    def supported(self):
+        return bool(self.path) and self.path != ':memory:'
+
+    def snapshot_path(self, fingerprint):
+        name = os.path.basename(self.path)
+        return os.path.join(self.directory, f"{name}.seed-{fingerprint}.db")
+
+    def exists(self, fingerprint):
+        return os.path.exists(self.snapshot_path(fingerprint))
+
+    def restore(self, fingerprint):
+        copy_file(self.snapshot_path(fingerprint), self.path)
+
+    def build(self, fingerprint):
+        snapshot = self.snapshot_path(fingerprint)
+        os.makedirs(os.path.dirname(snapshot), exist_ok=True)
+        copy_file(self.path, snapshot)
+
+        for old in glob.glob(self.snapshot_path('*')):
+            if old != snapshot:
+                os.remove(old)
+
+
+def copy_file(source, target):
+    """Copy `source` over `target` in one step, so no reader sees half."""
+
+    partial = f"{target}.{os.getpid()}.tmp"
+    shutil.copyfile(source, partial)
+    os.replace(partial, target)
+
+
+class PostgresSnapshots:
+    """Snapshots as template databases on the same server."""
+
+    def __init__(self, engine):
+        self.name = engine.url.database
+        self.quote = engine.dialect.identifier_preparer.quote
+
+        admin_url = make_url(str(engine.url))
+        admin_url.database = 'postgres'
+        self.admin = create_engine(admin_url, poolclass=NullPool,
+                                   isolation_level='AUTOCOMMIT')
+
+    def supported(self):
+        return bool(self.name)
+
+    def template_name(self, fingerprint):
+        # Postgres truncates names at 63 bytes
+        return f"{self.name[:40]}_seed_{fingerprint}"
+
+    def exists(self, fingerprint):
+        with self.admin.connect() as conn:
+            found = conn.execute(
+                text("SELECT 1 FROM pg_database WHERE datname = :name"),
+                name=self.template_name(fingerprint))
+            return found.first() is not None
+
+    def restore(self, fingerprint):
+        with self.admin.connect() as conn:
+            self.disconnect(conn, self.name)
+            conn.execute(f"DROP DATABASE IF EXISTS {self.quote(self.name)}")
+            conn.execute(f"CREATE DATABASE {self.quote(self.name)} "
+                         f"TEMPLATE {self.quote(self.template_name(fingerprint))}")
+
+    def build(self, fingerprint):
+        template = self.template_name(fingerprint)
+        with self.admin.connect() as conn:
+            self.disconnect(conn, self.name)
+            conn.execute(f"CREATE DATABASE {self.quote(template)} "
+                         f"TEMPLATE {self.quote(self.name)}")
+
+            old = conn.execute(
+                text("SELECT datname FROM pg_database "
+                     "WHERE datname LIKE :pattern AND datname <> :template"),
+                pattern=self.template_name('%').replace('_', '\\_'),
+                template=template)
+            for name, in old.fetchall():
+                conn.execute(f"DROP DATABASE IF EXISTS {self.quote(name)}")
+
+    @staticmethod
+    def disconnect(conn, name):
+        """End other sessions on `name`; CREATE/DROP DATABASE need that."""
+
+        conn.execute(
+            text("SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+                 "WHERE datname = :name AND pid <> pg_backend_pid()"),
+            name=name)
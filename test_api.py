@@ -0,0 +1,156 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_api.py
+
+
+import gzip
+import json
+from datetime import datetime, timedelta
+
+from models import db, Follows, Likes, Message, User
+
+from app import create_app, CURR_USER_KEY
+from fixtures import TransactionalTestCase
+
+app = create_app('testing')
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_USERS = 5
+MESSAGES_PER_USER = 3
+
+
+class ApiTestCase(TransactionalTestCase):
+    """Test the JSON API."""
+
+    app = app
+
+    def setUp(self):
+        """Five users, each following user1, with three messages each."""
+
+        super().setUp()
+
+        start = datetime(2020, 1, 1)
+        db.session.execute(User.__table__.insert(), [
+            dict(id=n, username=f'user{n}', email=f'user{n}@test.com',
+                 password='x', bio=f'bio {n}')
+            for n in range(1, NUM_USERS + 1)])
+        db.session.execute(Message.__table__.insert(), [
+            dict(id=n, text=f'warble {n}', user_id=(n - 1) // MESSAGES_PER_USER + 1,
+                 timestamp=start + timedelta(minutes=n))
+            for n in range(1, NUM_USERS * MESSAGES_PER_USER + 1)])
+        db.session.execute(Follows.__table__.insert(), [
+            dict(user_following_id=n, user_being_followed_id=1)
+            for n in range(2, NUM_USERS + 1)] + [
+            dict(user_following_id=1, user_being_followed_id=2)])
+        db.session.execute(Likes.__table__.insert(), [
+            dict(user_id=1, message_id=4)])
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def log_in(self, user_id=1):
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user_id
+
+    def test_timeline(self):
+        '''Test the home feed pages through the followed users' messages.'''
+
+        self.log_in()
+
+        resp = self.client.get('/api/timeline?limit=2&fields=id,liked')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json['data'], [dict(id=6, liked=False),
+                                             dict(id=5, liked=False)])
+        cursor = resp.json['next']
+        self.assertEqual(resp.headers['X-Next-Cursor'], cursor)
+        self.assertIn('rel="next"', resp.headers['Link'])
+
+        resp = self.client.get(f'/api/timeline?limit=2&fields=id,liked&cursor={cursor}')
+        self.assertEqual(resp.json, dict(data=[dict(id=4, liked=True)], next=None))
+        self.assertNotIn('Link', resp.headers)
+
+    def test_timeline_needs_login(self):
+        '''Test the home feed is refused without a logged-in user.'''
+
+        resp = self.client.get('/api/timeline')
+        self.assertEqual(resp.status_code, 401)
+        self.assertIn('error', resp.json)
+
+    def test_user_messages(self):
+        '''Test a user's messages come newest first with all fields.'''
+
+        resp = self.client.get('/api/users/2/messages')
+        self.assertEqual([msg['id'] for msg in resp.json['data']], [6, 5, 4])
+        self.assertEqual(resp.json['data'][0]['text'], 'warble 6')
+        self.assertEqual(resp.json['data'][0]['user_id'], 2)
+
+        self.assertEqual(self.client.get('/api/users/999/messages').status_code, 404)
+
+    def test_bad_requests(self):
+        '''Test bad cursors, limits and fields are 400s.'''
+
+        for url in ('/api/users/1/messages?cursor=garbage',
+                    '/api/users/1/messages?limit=0',
+                    '/api/users/1/messages?fields=password',
+                    '/api/users/1/messages?fields=liked',
+                    '/api/users?fields=email',
+                    '/api/users?cursor=x'):
+            with self.subTest(url=url):
+                resp = self.client.get(url)
+                self.assertEqual(resp.status_code, 400)
+                self.assertIn('error', resp.json)
+
+    def test_followers_and_following(self):
+        '''Test follow lists page through users by id.'''
+
+        self.log_in()
+
+        resp = self.client.get('/api/users/1/followers?limit=3&fields=id,username')
+        self.assertEqual(resp.json['data'], [dict(id=n, username=f'user{n}')
+                                             for n in (2, 3, 4)])
+
+        resp = self.client.get(f"/api/users/1/followers?limit=3&cursor={resp.json['next']}")
+        self.assertEqual([user['id'] for user in resp.json['data']], [5])
+        self.assertIsNone(resp.json['next'])
+
+        resp = self.client.get('/api/users/1/following?fields=id')
+        self.assertEqual(resp.json['data'], [dict(id=2)])
+
+    def test_user_search(self):
+        '''Test user search and listing.'''
+
+        resp = self.client.get('/api/users?q=user3&fields=username')
+        self.assertEqual(resp.json['data'][0], dict(username='user3'))
+
+        resp = self.client.get('/api/users?limit=2&fields=id')
+        self.assertEqual(len(resp.json['data']), 2)
+        resp = self.client.get(f"/api/users?limit=2&fields=id&cursor={resp.json['next']}")
+        self.assertEqual(len(resp.json['data']), 2)
+
+    def test_ndjson(self):
+        '''Test NDJSON is one object per line.'''
+
+        resp = self.client.get('/api/users/1/messages?fields=id',
+                               headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in resp.data.splitlines()],
+                         [dict(id=3), dict(id=2), dict(id=1)])
+
+        resp = self.client.get('/api/users/1/messages?fields=id&format=ndjson')
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+
+    def test_gzip(self):
+        '''Test responses are gzipped when the client accepts it.'''
+
+        resp = self.client.get('/api/users/1/messages',
+                               headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', resp.headers['Vary'])
+        body = json.loads(gzip.decompress(resp.data))
+        self.assertEqual(len(body['data']), MESSAGES_PER_USER)
+
+        resp = self.client.get('/api/users/1/messages')
+        self.assertNotIn('Content-Encoding', resp.headers)
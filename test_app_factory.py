@@ -0,0 +1,89 @@
+"""App factory tests: required settings and fork hooks."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_app_factory.py
+
+
+import gc
+import os
+import weakref
+from unittest import TestCase, mock, skipUnless
+
+import forksafe
+from app import create_app
+from config import ProductionConfig, TestingConfig
+from models import db
+
+
+class ServicesConfig(TestingConfig):
+    WRITE_BUFFER_ENABLED = True
+    FOLLOW_GRAPH_ENABLED = True
+
+
+class NoSecretConfig(ProductionConfig):
+    SECRET_KEY = None
+
+
+class Service:
+    """Stands in for a service with per-process state."""
+
+    def __init__(self):
+        self.reset = False
+
+    def reset_after_fork(self):
+        self.reset = True
+
+
+class AppFactoryTestCase(TestCase):
+    """Test create_app's checks and what it registers."""
+
+    def setUp(self):
+        # every create_app() makes its app the default one (db.app)
+        self.addCleanup(setattr, db, 'app', db.app)
+
+    def test_missing_secret_key(self):
+        '''Test an app without SECRET_KEY refuses to start.'''
+
+        with self.assertRaises(RuntimeError):
+            create_app(NoSecretConfig)
+
+    def test_no_hooks_per_app(self):
+        '''Test creating apps registers no fork or exit hooks.'''
+
+        with mock.patch('os.register_at_fork') as at_fork, \
+                mock.patch('atexit.register') as at_exit:
+            for _ in range(3):
+                create_app(ServicesConfig)
+
+        at_fork.assert_not_called()
+        at_exit.assert_not_called()
+
+    def test_apps_released(self):
+        '''Test the fork hooks don't keep apps or services alive.'''
+
+        app = create_app(ServicesConfig)
+        self.assertIn(app, forksafe._apps)
+        refs = [weakref.ref(app), weakref.ref(app.extensions['write_buffer']),
+                weakref.ref(app.extensions['follow_graph'])]
+
+        del app
+        create_app('testing')  # replaces it as db.app
+        gc.collect()
+
+        self.assertEqual([ref() for ref in refs], [None, None, None])
+
+    @skipUnless(hasattr(os, 'fork'), "needs os.fork")
+    def test_fork_resets_services(self):
+        '''Test registered services are reset in the child only.'''
+
+        service = Service()
+        forksafe.reset_after_fork(service)
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if service.reset else 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+        self.assertFalse(service.reset)
@@ -0,0 +1,148 @@
+"""Denormalized counter tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_counters.py
+
+
+from models import db, Message, User
+
+from app import create_app, CURR_USER_KEY, reconcile_counters_command
+from fixtures import (TransactionalTestCase, make_follows, make_likes,
+                      make_message, make_users)
+
+app = create_app('testing')
+
+USER_COUNTERS = ('messages_count', 'following_count', 'followers_count',
+                 'likes_count')
+
+
+def counters(user):
+    """{counter: value} of `user`, read from the database."""
+
+    row = (db.session
+           .query(*(getattr(User, name) for name in USER_COUNTERS))
+           .filter(User.id == user.id)
+           .one())
+    return dict(zip(USER_COUNTERS, row))
+
+
+def like_count(msg):
+    return (db.session
+            .query(Message.likes_count)
+            .filter(Message.id == msg.id)
+            .scalar())
+
+
+class CounterTestCase(TransactionalTestCase):
+    """Test counters move with the rows they count."""
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.user, self.other, self.third = make_users(3)
+        db.session.commit()
+
+    def as_user(self, client, user):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def assertCounters(self, user, **expected):
+        self.assertEqual(counters(user),
+                         {name: expected.get(name, 0) for name in USER_COUNTERS})
+
+    def test_follow_unfollow(self):
+        '''Test a follow moves both users' counters, and an unfollow back.'''
+
+        with self.client as c:
+            self.as_user(c, self.user)
+            c.post(f'/users/follow/{self.other.id}')
+            self.assertCounters(self.user, following_count=1)
+            self.assertCounters(self.other, followers_count=1)
+
+            c.post(f'/users/stop-following/{self.other.id}')
+            self.assertCounters(self.user)
+            self.assertCounters(self.other)
+
+    def test_like_unlike(self):
+        '''Test a like moves the liker's and the message's counters.'''
+
+        msg = make_message(self.other)
+        db.session.commit()
+
+        with self.client as c:
+            self.as_user(c, self.user)
+            c.post(f'/messages/{msg.id}/like')
+            self.assertCounters(self.user, likes_count=1)
+            self.assertEqual(like_count(msg), 1)
+
+            c.post(f'/messages/{msg.id}/like')
+            self.assertCounters(self.user)
+            self.assertEqual(like_count(msg), 0)
+
+    def test_post_and_delete_message(self):
+        '''Test posting and deleting a message, and the likers' counters.'''
+
+        with self.client as c:
+            self.as_user(c, self.user)
+            c.post('/messages/new', data={'text': 'counted'})
+            self.assertCounters(self.user, messages_count=1)
+
+            msg = Message.query.filter_by(user_id=self.user.id).one()
+            make_likes([(self.other, msg)])
+            db.session.commit()
+            self.assertCounters(self.other, likes_count=1)
+
+            c.post(f'/messages/{msg.id}/delete')
+
+        self.assertCounters(self.user)
+        self.assertCounters(self.other)
+
+    def test_delete_user(self):
+        '''Test deleting a user releases the counters that included them.'''
+
+        msg = make_message(self.user)
+        theirs = make_message(self.other)
+        make_follows([(self.user, self.other), (self.third, self.user)])
+        make_likes([(self.other, msg), (self.user, theirs)])
+        db.session.commit()
+        msg_id = msg.id
+
+        with self.client as c:
+            self.as_user(c, self.user)
+            c.post('/users/delete')
+
+        self.assertCounters(self.other, messages_count=1)
+        self.assertCounters(self.third)
+        self.assertEqual(like_count(theirs), 0)
+        self.assertEqual(Message.query.filter_by(id=msg_id).count(), 0)
+
+        # the home page of someone who followed them shows no orphans
+        with self.client as c:
+            self.as_user(c, self.third)
+            self.assertEqual(c.get('/').status_code, 200)
+
+    def test_reconcile(self):
+        '''Test `flask reconcile-counters` repairs skewed rows.'''
+
+        msg = make_message(self.other)
+        make_follows([(self.user, self.other)])
+        make_likes([(self.user, msg)])
+        db.session.commit()
+        expected = {user.id: counters(user)
+                    for user in (self.user, self.other, self.third)}
+
+        User.adjust_counters(self.user.id, following_count=5, likes_count=-1)
+        User.adjust_counters(self.third.id, messages_count=3)
+        Message.adjust_counters(msg.id, likes_count=7)
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(reconcile_counters_command)
+        self.assertIn("Counters reconciled.", result.output)
+
+        self.assertEqual({user.id: counters(user)
+                          for user in (self.user, self.other, self.third)},
+                         expected)
+        self.assertEqual(like_count(msg), 1)
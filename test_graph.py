@@ -0,0 +1,202 @@
+"""Follow graph tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_graph.py
+
+
+import random
+import time
+from unittest import TestCase
+
+from models import db, Follows
+
+from app import create_app, CURR_USER_KEY
+from actions import FOLLOWS_CHANGED_KEY
+from config import TestingConfig
+from fixtures import TransactionalTestCase, make_follows, make_users
+from graph import FollowGraph, FollowGraphService
+from querystats import collect_queries
+
+
+class GraphConfig(TestingConfig):
+    FOLLOW_GRAPH_ENABLED = True
+    # tests reload by hand
+    FOLLOW_GRAPH_RELOAD_SECONDS = None
+
+
+app = create_app(GraphConfig)
+
+
+class FollowGraphTestCase(TestCase):
+    """Test the CSR arrays and their overlay against plain sets."""
+
+    def setUp(self):
+        rng = random.Random(25)
+        self.rng = rng
+        edges = {(rng.randrange(60), rng.randrange(60)) for _ in range(600)}
+        self.edges = {(a, b) for a, b in edges if a != b}
+        self.graph = FollowGraph.from_edges(self.edges)
+
+    def assertAgrees(self):
+        following = {user: {b for a, b in self.edges if a == user}
+                     for user in range(65)}
+        followers = {user: {a for a, b in self.edges if b == user}
+                     for user in range(65)}
+
+        for user in range(65):
+            self.assertEqual(self.graph.following_ids(user), following[user])
+            self.assertEqual(self.graph.follower_ids(user), followers[user])
+            self.assertEqual(self.graph.following_count(user),
+                             len(following[user]))
+            self.assertEqual(self.graph.followers_count(user),
+                             len(followers[user]))
+            self.assertEqual(self.graph.mutual_ids(user),
+                             following[user] & followers[user])
+            other = (user * 7) % 65
+            self.assertEqual(self.graph.common_following(user, other),
+                             following[user] & following[other])
+
+        for a in range(65):
+            for b in range(65):
+                self.assertEqual(self.graph.is_following(a, b),
+                                 (a, b) in self.edges)
+
+    def test_queries(self):
+        '''Test membership, degree and intersection answers.'''
+
+        self.assertAgrees()
+
+    def test_deltas(self):
+        '''Test applied follows and unfollows show in every answer.'''
+
+        for _ in range(300):
+            pair = (self.rng.randrange(65), self.rng.randrange(65))
+            if self.rng.random() < 0.5:
+                self.graph.apply(added=[pair])
+                self.edges.add(pair)
+            else:
+                self.graph.apply(removed=[pair])
+                self.edges.discard(pair)
+
+        self.assertAgrees()
+
+    def test_reload_floor(self):
+        '''Test a graph isn't reloaded sooner than RELOAD_COST_FACTOR
+        times its load took.'''
+
+        service = FollowGraphService(app, reload_seconds=1, max_deltas=1)
+        self.graph.loaded_at = time.time() - 5
+        self.graph.apply(added=[(61, 62)])
+
+        self.graph.load_seconds = 1
+        self.assertFalse(service._stale(self.graph))
+        self.graph.load_seconds = 0.1
+        self.assertTrue(service._stale(self.graph))
+
+    def test_deltas_cancel(self):
+        '''Test following and unfollowing again leaves no overlay.'''
+
+        pair = next(iter(self.edges))
+        self.graph.apply(removed=[pair])
+        self.assertEqual(self.graph.deltas, 1)
+        self.graph.apply(added=[pair])
+        self.assertEqual(self.graph.deltas, 0)
+
+
+class FollowGraphAppTestCase(TransactionalTestCase):
+    """Test the app answering follow checks from the graph."""
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.user, self.a, self.b = make_users(3)
+        make_follows([(self.user, self.a), (self.a, self.user)])
+        db.session.commit()
+
+        self.service = app.extensions['follow_graph']
+        self.service.reload()
+
+    def get_as(self, client, user):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+        return client.get(f'/users/{self.b.id}')
+
+    def test_loaded(self):
+        '''Test the graph holds the committed follows.'''
+
+        graph = self.service.graph
+        self.assertTrue(graph.is_following(self.user.id, self.a.id))
+        self.assertEqual(graph.mutual_ids(self.user.id), {self.a.id})
+        self.assertEqual(graph.followers_count(self.b.id), 0)
+
+    def test_loaded_both_directions(self):
+        '''Test the two reads agree with the follows, in each direction.'''
+
+        make_follows([(self.b, self.a), (self.b, self.user)])
+        db.session.commit()
+        edges = {(follower, followed) for follower, followed in (
+            db.session.query(Follows.user_following_id,
+                             Follows.user_being_followed_id))}
+
+        graph = self.service.reload()
+        expected = FollowGraph.from_edges(edges)
+        for user in (self.user, self.a, self.b):
+            self.assertEqual(graph.following_ids(user.id),
+                             expected.following_ids(user.id))
+            self.assertEqual(graph.follower_ids(user.id),
+                             expected.follower_ids(user.id))
+        self.assertEqual(graph.follower_ids(self.a.id),
+                         {self.user.id, self.b.id})
+        self.assertGreater(graph.load_seconds, 0)
+
+    def test_follow_applied(self):
+        '''Test a follow reaches the graph once committed, and the follow
+        button after it needs no query of follows.'''
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+            c.post(f'/users/follow/{self.b.id}')
+
+            self.assertTrue(self.service.graph.is_following(self.user.id,
+                                                            self.b.id))
+            with collect_queries() as stats:
+                resp = c.get(f'/users/{self.b.id}')
+
+        self.assertIn('Unfollow', resp.get_data(as_text=True))
+        self.assertFalse(any('FROM follows' in statement
+                             for statement in stats.shapes))
+
+    def test_stale_row_reread(self):
+        '''Test a follow made by another process shows once the session
+        says the user's follows changed.'''
+
+        db.session.execute(Follows.__table__.insert(), [
+            dict(user_following_id=self.user.id,
+                 user_being_followed_id=self.b.id)])
+        db.session.commit()
+
+        with self.client as c:
+            self.assertNotIn('Unfollow',
+                             self.get_as(c, self.user).get_data(as_text=True))
+
+            with c.session_transaction() as sess:
+                sess[FOLLOWS_CHANGED_KEY] = time.time()
+            self.assertIn('Unfollow',
+                          self.get_as(c, self.user).get_data(as_text=True))
+
+    def test_deleted_user_forgotten(self):
+        '''Test deleting a user drops their follows from the graph.'''
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.a.id
+            c.post('/users/delete')
+
+        graph = self.service.graph
+        self.assertFalse(graph.is_following(self.user.id, self.a.id))
+        self.assertEqual(graph.following_count(self.user.id), 0)
+        self.assertEqual(graph.followers_count(self.user.id), 0)
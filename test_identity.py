@@ -0,0 +1,133 @@
+"""Cached identity tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_identity.py
+
+
+from models import db, User
+
+from app import create_app, CURR_USER_KEY
+from fixtures import TransactionalTestCase, make_follows, make_user, make_users
+from identity import IdentityGone, forget_identity, load_identity
+
+app = create_app('testing')
+
+
+class IdentityTestCase(TransactionalTestCase):
+    """Test the per-process snapshot of the logged-in user."""
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.user = make_user(bio="old bio")
+        db.session.commit()
+
+        # ids come back after each test's rollback, so another test may
+        # have left a snapshot under this one
+        forget_identity(self.user.id)
+        self.addCleanup(forget_identity, self.user.id)
+
+        # two browsers logged in as the same user
+        self.browser = app.test_client()
+        self.other_browser = app.test_client()
+        for client in (self.browser, self.other_browser):
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+
+    def edit_elsewhere(self, **columns):
+        """Change the user the way a profile edit would, without telling
+        this process."""
+
+        (User.query
+         .filter_by(id=self.user.id)
+         .update(dict(columns, version=User.version + 1),
+                 synchronize_session=False))
+        db.session.commit()
+
+    def identity(self, method='GET'):
+        with app.test_request_context('/', method=method):
+            return load_identity(self.user.id)
+
+    def test_cached_for_reads(self):
+        '''Test GETs reuse the snapshot until IDENTITY_CACHE_TTL.'''
+
+        self.identity()
+        self.edit_elsewhere(bio="new bio")
+
+        self.assertEqual(self.identity().bio, "old bio")
+
+    def test_writes_reload(self):
+        '''Test a POST reads the user again, and recaches them.'''
+
+        self.identity()
+        self.edit_elsewhere(bio="new bio")
+
+        self.assertEqual(self.identity('POST').bio, "new bio")
+        self.assertEqual(self.identity().bio, "new bio")
+
+    def test_model_version_refreshes(self):
+        '''Test loading the full row replaces an older snapshot.'''
+
+        self.identity()
+        self.edit_elsewhere(bio="new bio")
+
+        with app.test_request_context('/'):
+            current = load_identity(self.user.id)
+            self.assertEqual(current.bio, "old bio")
+            current.model
+            self.assertEqual(current.bio, "new bio")
+
+        self.assertEqual(self.identity().bio, "new bio")
+
+    def test_deleted_in_other_browser(self):
+        '''Test a session whose user was deleted elsewhere is logged out.'''
+
+        with self.other_browser as c:
+            c.get('/')
+
+        with self.browser as c:
+            c.post('/users/delete')
+
+        with self.other_browser as c:
+            resp = c.post('/messages/new', data={'text': 'ghost'},
+                          follow_redirects=True)
+            self.assertIn("Access unauthorized", resp.get_data(as_text=True))
+            with c.session_transaction() as sess:
+                self.assertNotIn(CURR_USER_KEY, sess)
+
+    def test_deleted_model(self):
+        '''Test a cached snapshot of a deleted user can't load its row.'''
+
+        self.identity()
+        User.query.filter_by(id=self.user.id).delete()
+        db.session.commit()
+
+        with app.test_request_context('/'):
+            current = load_identity(self.user.id)
+            with self.assertRaises(IdentityGone):
+                current.model
+
+        self.assertIsNone(self.identity())
+
+    def test_follow_in_other_browser(self):
+        '''Test a follow in one browser changes the other's cached pages.'''
+
+        followed, celebrity = make_users(2)
+        make_follows([(followed, celebrity)])
+        db.session.commit()
+        page = f'/users/{celebrity.id}/followers'
+
+        with self.other_browser as c:
+            etag = c.get(page).headers['ETag']
+
+        with self.browser as c:
+            c.post(f'/users/follow/{followed.id}')
+
+        with self.other_browser as c:
+            resp = c.get(page, headers={'If-None-Match': etag})
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn(f'/users/stop-following/{followed.id}',
+                          resp.get_data(as_text=True))
@@ -0,0 +1,153 @@
+"""Bulk loader tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_loader.py
+#
+# They need no database server: the database is a SQLite file.
+
+
+import csv
+import os
+import tempfile
+from unittest import TestCase, mock
+
+from flask import Flask
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+import loader
+from models import db, User, Message
+from loader import checkpoints, load_all
+
+USERS = 3
+MESSAGES = 25
+CHUNK_SIZE = 10
+
+
+def make_app(uri):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+def write_csv(path, fieldnames, rows):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(fieldnames)
+        writer.writerows(rows)
+
+
+class Killed(Exception):
+    """Stands in for the process dying partway through a load."""
+
+
+class LoaderTestCase(TestCase):
+    """Chunked CSV loads, their retries and resuming them."""
+
+    def setUp(self):
+        db.session.remove()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.app = make_app(f"sqlite:///{directory.name}/warbler.db")
+        context = self.app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+        self.addCleanup(db.session.remove)
+        db.create_all()
+
+        users = os.path.join(directory.name, 'users.csv')
+        write_csv(users, ['email', 'username', 'password'],
+                  [(f'user{i}@test.com', f'user{i}', 'x') for i in range(USERS)])
+        messages = os.path.join(directory.name, 'messages.csv')
+        write_csv(messages, ['text', 'timestamp', 'user_id'],
+                  [(f'warble {i}', f'2020-01-01T00:{i:02d}:00', i % USERS + 1)
+                   for i in range(MESSAGES)])
+        self.sources = [(users, User), (messages, Message)]
+
+        self.chunks = []
+
+    def load(self, **options):
+        load_all(self.sources, chunk_size=CHUNK_SIZE,
+                 progress=lambda table, rows, seconds: None, **options)
+
+    def fail_chunks(self, *errors):
+        """Patch the chunk writer to raise `errors` in turn (None writes)."""
+
+        errors = iter(errors)
+        write = loader.insert_chunk
+
+        def insert_chunk(connection, table, fieldnames, rows):
+            self.chunks.append((table.name, len(rows)))
+            error = next(errors, None)
+            if error is not None:
+                raise error
+            write(connection, table, fieldnames, rows)
+
+        patcher = mock.patch('loader.insert_chunk', insert_chunk)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def message_indexes(self):
+        return {index['name'] for index in inspect(db.engine).get_indexes('messages')}
+
+    def test_load(self):
+        '''Test every row is loaded, and indexes and checkpoints tidied.'''
+
+        self.load()
+
+        self.assertEqual(User.query.count(), USERS)
+        self.assertEqual(Message.query.count(), MESSAGES)
+        self.assertEqual(self.message_indexes(),
+                         {index.name for index in Message.__table__.indexes})
+        self.assertFalse(db.engine.has_table('load_checkpoints'))
+
+    def test_resume(self):
+        '''Test a load killed partway resumes after its last checkpoint.'''
+
+        self.fail_chunks(None, None, None, Killed())
+        with self.assertRaises(Killed):
+            self.load()
+
+        # users, then two chunks of messages, committed before the kill
+        self.assertEqual(Message.query.count(), 2 * CHUNK_SIZE)
+        self.assertEqual(
+            db.engine.execute(checkpoints.select()).fetchall(),
+            [('users', USERS), ('messages', 2 * CHUNK_SIZE)])
+        self.assertEqual(self.message_indexes(), set())
+
+        self.chunks.clear()
+        self.load(resume=True)
+
+        self.assertEqual(self.chunks,
+                         [('messages', MESSAGES - 2 * CHUNK_SIZE)])
+        self.assertEqual([text for text, in db.session
+                          .query(Message.text).order_by(Message.id)],
+                         [f'warble {i}' for i in range(MESSAGES)])
+        self.assertEqual(len(self.message_indexes()), 2)
+        self.assertFalse(db.engine.has_table('load_checkpoints'))
+
+    def test_retry_transient(self):
+        '''Test a chunk is written again after a dropped connection.'''
+
+        dropped = OperationalError("INSERT", {}, Exception("disk I/O error"))
+        self.fail_chunks(None, dropped, dropped)
+        self.load()
+
+        self.assertEqual(self.chunks[:4], [('users', USERS)]
+                         + [('messages', CHUNK_SIZE)] * 3)
+        self.assertEqual(Message.query.count(), MESSAGES)
+
+    def test_no_retry(self):
+        '''Test other errors stop the load without retrying.'''
+
+        self.fail_chunks(None, IntegrityError("INSERT", {}, Exception("dup")))
+        with self.assertRaises(IntegrityError):
+            self.load()
+
+        self.assertEqual(self.chunks, [('users', USERS),
+                                       ('messages', CHUNK_SIZE)])
+        self.assertEqual(Message.query.count(), 0)
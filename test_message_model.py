@@ -1,21 +1,21 @@
 # to test use python - m unittest - v test_message_model.py
 
 import os
-from app import app
+from app import create_app
+from fixtures import TransactionalTestCase
 from models import db, Message, User, Follows, Likes
-from unittest import TestCase
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+app = create_app('testing')
 
-db.create_all()
 
-
-class UserModelTestCase(TestCase):
+class UserModelTestCase(TransactionalTestCase):
     """Test views for messages."""
+
+    app = app
+
     def setUp(self):
         """Create test client, add sample data."""
-        db.drop_all()
-        db.create_all()
+        super().setUp()
         
         user1 = User.signup(email='user1@gmail.com',
                             username='user1',
@@ -86,3 +86,19 @@ class UserModelTestCase(TestCase):
         likes = Likes.query.all()
         self.assertEqual(len(likes), 1)
         self.assertEqual(likes[0].message_id, message1.user_id)
+
+    def test_liked_ids(self):
+        '''Test looking up which messages of a page a user liked.'''
+        messages = [Message(text=f"test text {n}", user_id=self.id)
+                    for n in range(3)]
+        db.session.add_all(messages)
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.id, message_id=messages[1].id))
+        Message.adjust_counters(messages[1].id, likes_count=1)
+        db.session.commit()
+
+        page = [message.id for message in messages]
+        self.assertEqual(Likes.liked_ids(self.id, page), {messages[1].id})
+        self.assertEqual(Likes.liked_ids(self.id, []), set())
+        self.assertEqual(Message.query.get(messages[1].id).likes_count, 1)
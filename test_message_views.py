@@ -6,41 +6,36 @@
 
 
 import os
-from unittest import TestCase
 
 from models import Follows, db, connect_db, Message, User
 
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
+# The testing config uses a different database for tests
+# (TEST_DATABASE_URL, by default postgresql:///warbler-test)
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+import fragments
+from app import create_app, CURR_USER_KEY
+from fixtures import TransactionalTestCase, make_message, make_users
+from fragments import ACTIONS_SLOT, forget_message, render_message
 
+app = create_app('testing')
 
-# Now we can import app
-
-from app import app, CURR_USER_KEY
-
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
-
-db.create_all()
+# Tables are created once per test process, and each test runs in a
+# transaction that is rolled back afterwards (see fixtures.py)
 
 # Don't have WTForms use CSRF at all, since it's a pain to test
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class MessageViewTestCase(TestCase):
+class MessageViewTestCase(TransactionalTestCase):
     """Test views for messages."""
 
+    app = app
+
     def setUp(self):
         """Create test client, add sample data."""
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -117,6 +112,53 @@ class MessageViewTestCase(TestCase):
             self.assertTrue(response.status_code == 200)
             self.assertIn(m.text, str(response.data))
 
+    def test_message_show_after_profile_edit(self):
+        '''Test cached message items pick up the author's new profile.'''
+
+        m = Message(
+            id=11,
+            text="test message",
+            user_id=self.user1_id
+        )
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            c.get('/messages/11')
+
+            user = User.query.get(self.user1_id)
+            user.image_url = "/static/images/new-pic.png"
+            user.version = User.version + 1
+            db.session.commit()
+
+            response = c.get('/messages/11')
+            self.assertIn("/static/images/new-pic.png", str(response.data))
+
+    def test_message_show_not_modified(self):
+        '''Test a repeat visit to a message gets a 304.'''
+
+        m = Message(
+            id=11,
+            text="test message",
+            user_id=self.user1_id
+        )
+        db.session.add(m)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user1.id
+
+            response = c.get('/messages/11')
+            etag = response.headers['ETag']
+
+            response = c.get('/messages/11', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b'')
+
     def tearDown(self):
         res = super().tearDown()
         db.session.rollback()
@@ -200,4 +242,85 @@ class MessageViewTestCase(TestCase):
             self.assertIn("Access unauthorized", str(response.data))
 
             m = Message.query.get(11)
-            self.assertIsNotNone(m) 
+            self.assertIsNotNone(m)
+
+
+class FragmentCacheTestCase(TransactionalTestCase):
+    """Test the per-process cache of rendered message items."""
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        fragments._fragments.clear()
+        self.addCleanup(fragments._fragments.clear)
+        self.addCleanup(app.config.__setitem__, 'FRAGMENT_CACHE_SIZE',
+                        app.config['FRAGMENT_CACHE_SIZE'])
+
+        self.author, self.viewer = make_users(2)
+        self.messages = [make_message(self.author) for _ in range(3)]
+        db.session.commit()
+
+    def render(self, *messages, variant='timeline'):
+        with app.test_request_context():
+            for msg in messages:
+                render_message(msg, variant, actions="<b>mine</b>")
+
+    def cached_ids(self):
+        return [key[1] for key in fragments._fragments]
+
+    def test_lru_eviction(self):
+        '''Test the least recently used item goes past FRAGMENT_CACHE_SIZE.'''
+
+        app.config['FRAGMENT_CACHE_SIZE'] = 2
+        first, second, third = self.messages
+
+        self.render(first, second, first, third)
+
+        self.assertEqual(self.cached_ids(), [first.id, third.id])
+
+    def test_disabled(self):
+        '''Test FRAGMENT_CACHE_SIZE = 0 caches nothing.'''
+
+        app.config['FRAGMENT_CACHE_SIZE'] = 0
+
+        self.render(*self.messages)
+
+        self.assertEqual(self.cached_ids(), [])
+
+    def test_forget_message(self):
+        '''Test forget_message drops every variant of that message only.'''
+
+        gone, kept, _ = self.messages
+        self.render(gone, kept)
+        self.render(gone, variant='detail')
+
+        forget_message(gone.id)
+
+        self.assertEqual(self.cached_ids(), [kept.id])
+
+    def test_no_viewer_state_cached(self):
+        '''Test one viewer's buttons are neither cached nor shown to others.'''
+
+        msg = self.messages[0]
+        delete = f'/messages/{msg.id}/delete'
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+            self.assertIn(delete, c.get(f'/messages/{msg.id}')
+                          .get_data(as_text=True))
+
+        cached, = fragments._fragments.values()
+        self.assertIn(ACTIONS_SLOT, cached)
+        self.assertNotIn(delete, cached)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer.id
+            html = c.get(f'/messages/{msg.id}').get_data(as_text=True)
+
+        self.assertNotIn(delete, html)
+        self.assertIn(f'/users/follow/{self.author.id}', html)
+        self.assertEqual(len(fragments._fragments), 1)
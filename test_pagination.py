@@ -0,0 +1,110 @@
+"""Message list paging tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_pagination.py
+
+
+import base64
+import re
+
+from models import db
+
+from app import create_app, CURR_USER_KEY
+from fixtures import TransactionalTestCase, make_follows, make_messages, make_users
+from timeline import HOME_TIMELINE_SIZE
+
+app = create_app('testing')
+
+LOAD_MORE = re.compile(r'href="([^"]*\?before=[^"]+)"')
+MESSAGE_LINK = re.compile(r'href="/messages/(\d+)"')
+
+
+class PaginationTestCase(TransactionalTestCase):
+    """Test "Load more" links on message lists."""
+
+    app = app
+
+    def setUp(self):
+        """An author with one message more than a page, and a reader."""
+
+        super().setUp()
+
+        self.reader, self.author = make_users(2)
+        make_follows([(self.reader, self.author)])
+        self.messages = make_messages([self.author],
+                                      per_user=HOME_TIMELINE_SIZE + 1)
+        db.session.commit()
+
+    def get(self, client, url):
+        resp = client.get(url)
+        self.assertEqual(resp.status_code, 200)
+        html = resp.get_data(as_text=True)
+        more = LOAD_MORE.search(html)
+        return ([int(msg_id) for msg_id in MESSAGE_LINK.findall(html)],
+                more.group(1).replace('&amp;', '&') if more else None)
+
+    def assertPages(self, url):
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader.id
+
+            first, more = self.get(c, url)
+            self.assertEqual(len(first), HOME_TIMELINE_SIZE)
+            self.assertIsNotNone(more)
+
+            second, last = self.get(c, more)
+            self.assertIsNone(last)
+
+        newest_first = sorted((msg.id for msg in self.messages), reverse=True)
+        self.assertEqual(first + second, newest_first)
+
+    def test_home_pages(self):
+        '''Test the home timeline pages through every message once.'''
+
+        self.assertPages('/')
+
+    def test_user_pages(self):
+        '''Test a profile pages through every message once.'''
+
+        self.assertPages(f'/users/{self.author.id}')
+
+    def test_recent_pages(self):
+        '''Test the site-wide fallback for users who follow nobody pages.'''
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+
+            first, more = self.get(c, '/')
+            second, last = self.get(c, more)
+
+        self.assertEqual(len(first), HOME_TIMELINE_SIZE)
+        self.assertEqual(len(second), 1)
+        self.assertIsNone(last)
+
+    def test_no_link_on_last_page(self):
+        '''Test a list that fits on one page has no "Load more" link.'''
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader.id
+
+            messages, more = self.get(c, f'/users/{self.reader.id}')
+
+        self.assertEqual(messages, [])
+        self.assertIsNone(more)
+
+    def test_garbage_cursor(self):
+        '''Test a cursor that doesn't decode is a 400, not a 500.'''
+
+        wrong_fields = base64.urlsafe_b64encode(b"yesterday|x").decode()
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.reader.id
+
+            for cursor in ('!!!', 'bm9wZQ', wrong_fields):
+                for url in ('/', f'/users/{self.author.id}'):
+                    with self.subTest(url=url, cursor=cursor):
+                        resp = c.get(url, query_string={'before': cursor})
+                        self.assertEqual(resp.status_code, 400)
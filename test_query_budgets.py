@@ -0,0 +1,149 @@
+"""Query budget tests.
+
+Every page below may run at most ROUTE_BUDGETS[route] SQL statements.
+A template or route change that adds a query per message, per card or
+per counter (an N+1) pushes the page over its budget and fails here.
+"""
+
+# run these tests like:
+#
+#    python -m unittest -v test_query_budgets.py
+#
+# against the 'testing' config's database (TEST_DATABASE_URL, by default
+# postgresql:///warbler-test).
+
+
+from sqlalchemy.exc import DBAPIError
+
+from models import db, User
+
+from app import create_app, CURR_USER_KEY
+from fixtures import (TransactionalTestCase, make_follows, make_message,
+                      make_messages, make_user, make_users)
+from querystats import collect_queries, query_budget, shape_of, QueryBudgetExceeded
+
+app = create_app('testing')
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NUM_AUTHORS = 3
+MESSAGES_PER_AUTHOR = 4
+MORE_AUTHORS = 50
+
+# Statements per page, for a fresh request by a logged-in user. None
+# depends on NUM_AUTHORS or MESSAGES_PER_AUTHOR: message lists load all
+# their authors with one SELECT (see Message.with_authors).
+ROUTE_BUDGETS = {
+    '/': 4,
+    '/users': 2,
+    '/users?q=user': 2,
+    '/users/1': 2,
+    '/users/1/following': 3,
+    '/users/1/followers': 3,
+    '/messages/1': 2,
+    '/messages/search?q=warble': 4,
+}
+
+
+class QueryBudgetTestCase(TransactionalTestCase):
+    """Pages stay within their query budgets."""
+
+    app = app
+
+    def setUp(self):
+        """Create users who follow each other and post messages."""
+
+        super().setUp()
+
+        viewer = make_user()
+        authors = make_users(NUM_AUTHORS)
+        make_follows([(viewer, author) for author in authors]
+                     + [(author, viewer) for author in authors])
+        make_messages(authors, per_user=MESSAGES_PER_AUTHOR)
+        make_message(viewer, "my warble")
+        db.session.commit()
+
+        self.viewer_id = viewer.id
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_route_budgets(self):
+        '''Test each page runs no more queries than its budget.'''
+
+        for path, budget in ROUTE_BUDGETS.items():
+            with self.subTest(path=path), self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.viewer_id
+
+                with query_budget(budget):
+                    resp = c.get(path)
+
+                self.assertEqual(resp.status_code, 200)
+
+    def test_authors_loaded_in_one_query(self):
+        '''Test the home page runs as many queries for more authors.'''
+
+        def home_page_queries():
+            with self.client as c:
+                with c.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.viewer_id
+                with collect_queries() as stats:
+                    resp = c.get('/')
+            self.assertEqual(resp.status_code, 200)
+            return stats.count
+
+        home_page_queries()  # warm the identity cache
+        before = home_page_queries()
+
+        viewer = User.query.get(self.viewer_id)
+        authors = make_users(MORE_AUTHORS)
+        make_follows([(viewer, author) for author in authors])
+        make_messages(authors)
+        db.session.commit()
+
+        self.assertEqual(home_page_queries(), before)
+
+    def test_query_headers(self):
+        '''Test responses report their query count.'''
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.viewer_id
+
+            with query_budget(ROUTE_BUDGETS['/']) as stats:
+                resp = c.get('/')
+
+            self.assertEqual(int(resp.headers['X-Query-Count']), stats.count)
+            self.assertIn('X-Query-Time-Ms', resp.headers)
+            self.assertIn('X-Query-Duplicates', resp.headers)
+
+    def test_budget_exceeded(self):
+        '''Test going over budget fails and lists the statements.'''
+
+        with self.assertRaises(QueryBudgetExceeded) as cm:
+            with query_budget(1):
+                for user_id in range(1, 4):
+                    db.session.expire_all()
+                    User.query.get(user_id)
+
+        self.assertIn("3 x SELECT", str(cm.exception))
+
+    def test_shape_of(self):
+        '''Test IN-lists of any length share a shape.'''
+
+        self.assertEqual(
+            shape_of("SELECT * FROM users\n WHERE id IN (%(id_1)s, %(id_2)s)"),
+            shape_of("SELECT * FROM users WHERE id IN (%(id_1)s)"))
+
+    def test_failed_statement(self):
+        '''Test a statement that raises isn't counted and leaves no timer.'''
+
+        with db.engine.connect() as conn:
+            with collect_queries() as stats:
+                with self.assertRaises(DBAPIError):
+                    conn.execute("SELECT * FROM no_such_table")
+                conn.execute("SELECT 1")
+
+            self.assertEqual(stats.count, 1)
+            self.assertNotIn('query_started', conn.info)
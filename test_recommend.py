@@ -0,0 +1,132 @@
+"""Who-to-follow recommendation tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_recommend.py
+
+
+import random
+
+from models import db, Recommendation
+
+from app import create_app, CURR_USER_KEY
+from fixtures import TransactionalTestCase, make_follows, make_user, make_users
+from recommend import (RECOMMENDATIONS_SIZE, compute_recommendations,
+                       recommended_users, refresh_recommendations)
+
+app = create_app('testing')
+
+
+def stored(user_id):
+    return [recommended_id for recommended_id, in (
+        db.session
+        .query(Recommendation.recommended_id)
+        .filter(Recommendation.user_id == user_id)
+        .order_by(Recommendation.rank))]
+
+
+class RecommendTestCase(TransactionalTestCase):
+    """Test who-to-follow lists."""
+
+    app = app
+
+    def setUp(self):
+        """A user following two accounts that follow others."""
+
+        super().setUp()
+
+        self.user, self.a, self.b, self.c, self.d, self.e = make_users(6)
+        make_follows([(self.user, self.a), (self.user, self.b),
+                      (self.a, self.c), (self.b, self.c), (self.a, self.d),
+                      (self.a, self.user), (self.e, self.user)])
+        db.session.commit()
+
+    def test_friends_of_friends(self):
+        '''Test accounts followed by more of the user's follows rank higher.'''
+
+        compute_recommendations()
+        db.session.commit()
+
+        self.assertEqual(stored(self.user.id)[:2], [self.c.id, self.d.id])
+        self.assertNotIn(self.a.id, stored(self.user.id))
+        self.assertNotIn(self.user.id, stored(self.user.id))
+
+    def test_popular_fill(self):
+        '''Test users without a neighborhood get the most-followed accounts.'''
+
+        newcomer = make_user()
+        db.session.commit()
+
+        refresh_recommendations([newcomer.id])
+        db.session.commit()
+
+        self.assertEqual(stored(newcomer.id)[:2], [self.user.id, self.c.id])
+        self.assertLessEqual(len(stored(newcomer.id)), RECOMMENDATIONS_SIZE)
+
+    def test_refresh_agrees_with_batch(self):
+        '''Test one user's refresh writes what the batch job would.'''
+
+        rng = random.Random(24)
+        users = make_users(40)
+        make_follows({(rng.choice(users), rng.choice(users)) for _ in range(300)}
+                     - {(user, user) for user in users})
+        db.session.commit()
+
+        compute_recommendations()
+        db.session.commit()
+        batch = {user.id: stored(user.id) for user in users}
+
+        refresh_recommendations([user.id for user in users])
+        db.session.commit()
+
+        self.assertEqual({user.id: stored(user.id) for user in users}, batch)
+
+    def test_follow_refreshes(self):
+        '''Test following someone takes them off the list at once.'''
+
+        compute_recommendations()
+        db.session.commit()
+        self.assertEqual(stored(self.user.id)[0], self.c.id)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+
+            resp = c.get('/')
+            self.assertIn('Who to follow', resp.get_data(as_text=True))
+            self.assertIn(f'/users/follow/{self.c.id}', resp.get_data(as_text=True))
+
+            c.post(f'/users/follow/{self.c.id}')
+
+        self.assertNotIn(self.c.id, stored(self.user.id))
+        self.assertEqual([user.id for user in recommended_users(self.user.id)],
+                         stored(self.user.id))
+
+    def test_deleted_user_forgotten(self):
+        '''Test deleting a user removes their list and their place in others.'''
+
+        compute_recommendations()
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.c.id
+            c.post('/users/delete')
+
+        self.assertNotIn(self.c.id, stored(self.user.id))
+        self.assertEqual(stored(self.c.id), [])
+
+    def test_refresh_samples_neighbors(self):
+        '''Test a refresh reads at most max_neighbors follows and followers,
+        and still leaves out accounts the user follows.'''
+
+        # b: followed by the user, but past the sample; c: through a only
+        make_follows([(self.a, self.b), (self.c, self.user)])
+        db.session.commit()
+
+        refresh_recommendations([self.user.id], max_neighbors=1)
+        db.session.commit()
+
+        self.assertEqual(stored(self.user.id)[:2], [self.c.id, self.d.id])
+        self.assertNotIn(self.b.id, stored(self.user.id))
+        self.assertNotIn(self.a.id, stored(self.user.id))
@@ -0,0 +1,108 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_routing.py
+#
+# They need no database server: the primary and the replica are two
+# SQLite files, filled with different users so each test can tell which
+# one answered.
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from flask import Flask, jsonify
+
+from models import db, User
+from routing import init_routing, STICKY_KEY
+
+
+def make_app(directory):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        f"sqlite:///{os.path.join(directory, 'primary.db')}")
+    app.config['SQLALCHEMY_BINDS'] = {
+        'replica_1': f"sqlite:///{os.path.join(directory, 'replica.db')}"}
+    app.config['REPLICA_BINDS'] = ['replica_1']
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = 'test'
+    db.init_app(app)
+    init_routing(app)
+
+    @app.route('/users', methods=['GET', 'POST'])
+    def usernames():
+        return jsonify([user.username for user in User.query.order_by(User.id)])
+
+    @app.route('/users/<username>', methods=['GET', 'POST'])
+    def add_user(username):
+        db.session.add(User(username=username, email=f'{username}@test.com',
+                            password='x'))
+        db.session.commit()
+        return usernames()
+
+    return app
+
+
+class RoutingTestCase(TestCase):
+    """Reads go to the replica only when they safely can."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = make_app(self.directory.name)
+
+        # no app context stays pushed: each request needs its own `g`
+        with self.app.app_context():
+            for bind, username in ((None, 'on-primary'),
+                                   ('replica_1', 'on-replica')):
+                engine = db.get_engine(self.app, bind=bind)
+                db.Model.metadata.create_all(engine)
+                engine.execute(User.__table__.insert(), username=username,
+                               email=f'{username}@test.com', password='x')
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_get_reads_replica(self):
+        '''Test GET requests read from the replica.'''
+
+        self.assertEqual(self.client.get('/users').json, ['on-replica'])
+
+    def test_post_reads_primary(self):
+        '''Test other requests read from the primary.'''
+
+        self.assertEqual(self.client.post('/users').json, ['on-primary'])
+
+    def test_no_request_reads_primary(self):
+        '''Test code outside a request uses the primary.'''
+
+        with self.app.app_context():
+            self.assertEqual([user.username for user in User.query],
+                             ['on-primary'])
+            db.session.remove()
+
+    def test_writes_go_to_primary(self):
+        '''Test a write in a GET lands on the primary, and later reads too.'''
+
+        resp = self.client.get('/users/new')
+        self.assertEqual(resp.json, ['on-primary', 'new'])
+
+    def test_read_your_writes(self):
+        '''Test GETs stick to the primary for a while after a write.'''
+
+        self.client.post('/users/new')
+        self.assertEqual(self.client.get('/users').json, ['on-primary', 'new'])
+
+        with self.client.session_transaction() as sess:
+            sess[STICKY_KEY] = time.time() - 1
+        self.assertEqual(self.client.get('/users').json, ['on-replica'])
+
+    def test_no_replicas(self):
+        '''Test everything uses the primary without REPLICA_BINDS.'''
+
+        self.app.config['REPLICA_BINDS'] = []
+        self.assertEqual(self.client.get('/users').json, ['on-primary'])
@@ -0,0 +1,177 @@
+"""Message search tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_search.py
+
+
+import re
+from datetime import datetime, timedelta
+
+from models import db, MessageTerm
+
+from app import create_app, CURR_USER_KEY
+from fixtures import TransactionalTestCase, make_message, make_users
+from search import (build_message_index, decode_search_cursor,
+                    encode_search_cursor, search_messages, tokenize,
+                    unindex_message)
+from timeline import encode_cursor
+
+app = create_app('testing')
+
+START = datetime(2020, 1, 1)
+MESSAGE_LINK = re.compile(r'href="/messages/(\d+)"')
+
+
+def all_pages(q, size):
+    """Message ids of every page of `q`, one list per page."""
+
+    pages, cursor = [], None
+    while True:
+        messages, cursor = search_messages(q, cursor, size=size)
+        pages.append([msg.id for msg in messages])
+        if cursor is None:
+            return pages
+
+
+def postings(msg):
+    return (MessageTerm
+            .query
+            .filter(MessageTerm.message_id == msg.id)
+            .count())
+
+
+class SearchTestCase(TransactionalTestCase):
+    """Test the message_terms index and searches over it."""
+
+    app = app
+
+    def setUp(self):
+        super().setUp()
+
+        self.user, = make_users(1)
+        self.minutes = 0
+
+    def post(self, text):
+        """A message, a minute newer than the last one."""
+
+        self.minutes += 1
+        return make_message(self.user, text,
+                            timestamp=START + timedelta(minutes=self.minutes))
+
+    def test_tokenize(self):
+        '''Test stopwords, one-letter tokens and repeats aren't terms.'''
+
+        self.assertEqual(tokenize("The cat, the CAT and a dog: x"),
+                         ['cat', 'dog'])
+
+    def test_rank_by_terms_then_recency(self):
+        '''Test messages matching more terms come first, then newer ones.'''
+
+        both = self.post("cats and dogs")
+        cats = self.post("just cats")
+        dogs = self.post("only dogs")
+        self.post("birds")
+        db.session.commit()
+
+        self.assertEqual(all_pages("dogs cats", size=10),
+                         [[both.id, dogs.id, cats.id]])
+
+    def test_single_term_pages(self):
+        '''Test one-term results page newest first, without overlap.'''
+
+        messages = [self.post(f"cats {i}") for i in range(5)]
+        db.session.commit()
+
+        newest_first = [msg.id for msg in reversed(messages)]
+        self.assertEqual(all_pages("cats", size=2),
+                         [newest_first[:2], newest_first[2:4],
+                          newest_first[4:]])
+
+    def test_multi_term_pages(self):
+        '''Test many-term results page across a change in terms matched.'''
+
+        one = [self.post("cats"), self.post("dogs")]
+        both = [self.post("cats dogs"), self.post("dogs cats")]
+        db.session.commit()
+
+        expected = [both[1].id, both[0].id, one[1].id, one[0].id]
+        self.assertEqual(all_pages("cats dogs", size=3),
+                         [expected[:3], expected[3:]])
+        self.assertEqual(all_pages("cats dogs", size=1),
+                         [[msg_id] for msg_id in expected])
+
+    def test_no_terms(self):
+        '''Test empty and stopword-only queries match nothing.'''
+
+        self.post("the and of")
+        db.session.commit()
+
+        for q in ("", "   ", "the and of", "a"):
+            with self.subTest(q=q):
+                self.assertEqual(search_messages(q), ([], None))
+
+    def test_cursors(self):
+        '''Test cursors round-trip, and other cursors are rejected.'''
+
+        cursor = encode_search_cursor(2, START, 7)
+        self.assertEqual(decode_search_cursor(cursor), (2, START, 7))
+
+        msg = self.post("cats")
+        for garbage in ('!!!', 'bm9wZQ', encode_cursor(msg)):
+            with self.subTest(cursor=garbage):
+                with self.assertRaises(ValueError):
+                    search_messages("cats", garbage)
+
+    def test_unindex(self):
+        '''Test a deleted message's postings go with it.'''
+
+        msg = self.post("cats")
+        kept = self.post("cats")
+        db.session.commit()
+        self.assertEqual(postings(msg), 1)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.user.id
+            c.post(f'/messages/{msg.id}/delete')
+
+        self.assertEqual(postings(msg), 0)
+        self.assertEqual(all_pages("cats", size=10), [[kept.id]])
+
+        unindex_message(kept.id)
+        self.assertEqual(all_pages("cats", size=10), [[]])
+
+    def test_build_index(self):
+        '''Test rebuilding the index in chunks restores every posting.'''
+
+        messages = [self.post(f"cats dogs {i}") for i in range(5)]
+        db.session.commit()
+        MessageTerm.query.delete()
+        self.assertEqual(all_pages("cats", size=10), [[]])
+
+        self.assertEqual(build_message_index(chunk_size=2), 5)
+
+        self.assertEqual(all_pages("cats", size=10),
+                         [[msg.id for msg in reversed(messages)]])
+        self.assertEqual(postings(messages[0]), 2)
+
+    def test_search_page(self):
+        '''Test /messages/search shows matches and rejects bad cursors.'''
+
+        cats = self.post("cats")
+        self.post("dogs")
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get('/messages/search', query_string={'q': 'cats'})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(MESSAGE_LINK.findall(resp.get_data(as_text=True)),
+                             [str(cats.id)])
+
+            resp = c.get('/messages/search', query_string={'q': 'fish'})
+            self.assertIn("Sorry, no warbles found", resp.get_data(as_text=True))
+
+            resp = c.get('/messages/search',
+                         query_string={'q': 'cats', 'before': '!!!'})
+            self.assertEqual(resp.status_code, 400)
@@ -0,0 +1,110 @@
+"""Seed snapshot tests."""
+
+# run these tests from the repo root (they load the seed CSVs) like:
+#
+#    python -m unittest -v test_snapshot.py
+#
+# They need no database server: the database is a SQLite file.
+
+
+import os
+import shutil
+import tempfile
+from unittest import TestCase, mock
+
+from flask import Flask
+
+import snapshot
+from models import db, User, Message
+from seed import seed_sources
+from snapshot import restore_or_seed, seed_fingerprint
+
+
+def make_app(uri):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    db.init_app(app)
+    return app
+
+
+class SnapshotTestCase(TestCase):
+    """Seeded databases restored from a snapshot file."""
+
+    def setUp(self):
+        db.session.remove()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'warbler.db')
+        self.app = make_app(f"sqlite:///{self.path}")
+        self.context = self.app.app_context()
+        self.context.push()
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+        self.directory.cleanup()
+
+    def snapshots(self):
+        return sorted(name for name in os.listdir(self.directory.name)
+                      if '.seed-' in name)
+
+    def test_build_then_restore(self):
+        '''Test the first start builds a snapshot and later ones restore it.'''
+
+        outcome = restore_or_seed(self.app)
+        self.assertEqual(outcome.how, 'built')
+        users = User.query.count()
+        self.assertGreater(users, 0)
+        fingerprint = seed_fingerprint(db.get_engine())
+        self.assertEqual(outcome.fingerprint, fingerprint)
+        self.assertGreater(outcome.seconds, 0)
+        self.assertEqual(self.snapshots(),
+                         [f'warbler.db.seed-{fingerprint}.db'])
+
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+        db.session.remove()
+
+        self.assertEqual(restore_or_seed(self.app),
+                         ('restored', fingerprint, mock.ANY))
+        self.assertEqual(User.query.count(), users)
+
+    def test_changed_inputs_rebuild(self):
+        '''Test a new fingerprint builds a new snapshot and drops the old.'''
+
+        restore_or_seed(self.app)
+        old = self.snapshots()
+
+        with mock.patch.object(snapshot, 'SEED_VERSION', snapshot.SEED_VERSION + 1):
+            self.assertEqual(restore_or_seed(self.app).how, 'built')
+
+        self.assertEqual(len(self.snapshots()), 1)
+        self.assertNotEqual(self.snapshots(), old)
+
+    def test_fingerprint_covers_csvs(self):
+        '''Test editing a seed CSV changes the fingerprint.'''
+
+        engine = db.get_engine()
+        sources = []
+        for path, model in seed_sources():
+            copy = os.path.join(self.directory.name, os.path.basename(path))
+            shutil.copyfile(path, copy)
+            sources.append((copy, model))
+
+        before = seed_fingerprint(engine, sources)
+        self.assertEqual(before, seed_fingerprint(engine))
+
+        with open(sources[0][0], 'a') as csv:
+            csv.write('\n')
+        self.assertNotEqual(seed_fingerprint(engine, sources), before)
+
+    def test_disabled(self):
+        '''Test SEED_SNAPSHOTS = False just seeds.'''
+
+        self.app.config['SEED_SNAPSHOTS'] = False
+
+        self.assertEqual(restore_or_seed(self.app)[:2], ('seeded', None))
+        self.assertEqual(self.snapshots(), [])
+        self.assertGreater(User.query.count(), 0)
@@ -0,0 +1,178 @@
+"""Fan-out-on-write timeline tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_timeline.py
+
+
+from datetime import datetime, timedelta
+
+from models import db, TimelineEntry, User
+
+from app import create_app, CURR_USER_KEY
+from actions import apply_follows
+from config import TestingConfig
+from fixtures import TransactionalTestCase, make_follows, make_message, make_users
+from timeline import (home_timeline, paginate, rebuild_timelines,
+                      retract_message, retract_user)
+
+
+class FanoutConfig(TestingConfig):
+    TIMELINE_FANOUT = True
+    TIMELINE_FANOUT_MAX_FOLLOWERS = 2
+
+
+app = create_app(FanoutConfig)
+
+START = datetime(2020, 1, 1)
+
+
+def inbox(owner):
+    return [message_id for message_id, in (
+        db.session
+        .query(TimelineEntry.message_id)
+        .filter(TimelineEntry.owner_id == owner.id)
+        .order_by(TimelineEntry.timestamp.desc(),
+                  TimelineEntry.message_id.desc()))]
+
+
+class FanoutTestCase(TransactionalTestCase):
+    """Test inboxes in timeline_entries, kept by writes."""
+
+    app = app
+
+    def setUp(self):
+        """A reader following one author, who has written two messages."""
+
+        super().setUp()
+
+        context = app.app_context()
+        context.push()
+        self.addCleanup(context.pop)
+
+        self.reader, self.author, self.other = make_users(3)
+        self.minutes = 0
+        self.old = self.post(self.author)
+        self.new = self.post(self.author)
+        make_follows([(self.reader, self.author)])
+        db.session.commit()
+
+    def post(self, author):
+        """A message by `author`, a minute newer than the last one."""
+
+        self.minutes += 1
+        return make_message(author,
+                            timestamp=START + timedelta(minutes=self.minutes))
+
+    def test_deliver(self):
+        '''Test a new message is pushed to its author's followers only.'''
+
+        msg = self.post(self.author)
+        db.session.commit()
+
+        self.assertEqual(inbox(self.reader)[0], msg.id)
+        self.assertEqual(inbox(self.other), [])
+        self.assertEqual(home_timeline(self.reader.id)[0].id, msg.id)
+
+    def test_backfill_and_purge(self):
+        '''Test a follow copies the author's messages in, an unfollow takes
+        them out.'''
+
+        self.assertEqual(inbox(self.reader), [self.new.id, self.old.id])
+
+        apply_follows({(self.reader.id, self.author.id): False})
+        db.session.commit()
+        self.assertEqual(inbox(self.reader), [])
+
+    def test_backfill_newest_only(self):
+        '''Test a follow copies no more than TIMELINE_BACKFILL_SIZE messages.'''
+
+        app.config['TIMELINE_BACKFILL_SIZE'] = 1
+        self.addCleanup(app.config.pop, 'TIMELINE_BACKFILL_SIZE')
+
+        make_follows([(self.other, self.author)])
+        db.session.commit()
+
+        self.assertEqual(inbox(self.other), [self.new.id])
+
+    def test_retract_message(self):
+        '''Test deleting a message removes it from every inbox.'''
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.author.id
+            c.post(f'/messages/{self.new.id}/delete')
+
+        self.assertEqual(inbox(self.reader), [self.old.id])
+
+        retract_message(self.old.id)
+        self.assertEqual(inbox(self.reader), [])
+
+    def test_retract_user(self):
+        '''Test a deleted user's inbox and their messages elsewhere go.'''
+
+        make_follows([(self.author, self.other)])
+        self.post(self.other)
+        db.session.commit()
+        self.assertEqual(len(inbox(self.author)), 1)
+
+        retract_user(self.author.id)
+
+        self.assertEqual(inbox(self.reader), [])
+        self.assertEqual(inbox(self.author), [])
+
+    def test_rebuild(self):
+        '''Test rebuilding refills inboxes from follows and messages.'''
+
+        make_follows([(self.other, self.author)])
+        db.session.commit()
+        TimelineEntry.query.delete()
+
+        self.assertEqual(rebuild_timelines([self.reader.id]), 2)
+        self.assertEqual(inbox(self.reader), [self.new.id, self.old.id])
+        self.assertEqual(inbox(self.other), [])
+
+        self.assertEqual(rebuild_timelines(), 4)
+        self.assertEqual(inbox(self.other), [self.new.id, self.old.id])
+
+    def test_rebuild_skips_pull_authors(self):
+        '''Test authors over the follower limit are left out of inboxes.'''
+
+        make_follows([(self.other, self.author)])
+        User.adjust_counters(self.author.id, followers_count=1)
+        db.session.commit()
+
+        self.assertEqual(rebuild_timelines(), 0)
+        self.assertEqual(home_timeline(self.reader.id)[0].id, self.new.id)
+
+    def test_merge_pull_author(self):
+        '''Test messages pushed before their author crossed the follower
+        limit show once, in order, across pages.'''
+
+        pushed = self.post(self.author)
+        others = [self.post(self.other) for _ in range(2)]
+        make_follows([(self.reader, self.other)])
+
+        # over the limit: from now on the author's messages are pulled,
+        # and the ones already in the inbox come back from both sides
+        followers = make_users(2)
+        make_follows([(follower, self.author) for follower in followers])
+        pulled = self.post(self.author)
+        db.session.commit()
+
+        expected = [pulled.id, others[1].id, others[0].id, pushed.id,
+                    self.new.id, self.old.id]
+        self.assertNotIn(pulled.id, inbox(self.reader))
+        self.assertIn(pushed.id, inbox(self.reader))
+
+        pages, cursor = [], None
+        while True:
+            page, cursor = paginate(
+                lambda before, limit: home_timeline(self.reader.id, before,
+                                                    limit),
+                cursor, size=4)
+            pages.append([msg.id for msg in page])
+            if cursor is None:
+                break
+
+        self.assertEqual(pages, [expected[:4], expected[4:]])
@@ -6,41 +6,33 @@
 
 
 import os
-from unittest import TestCase
 
-from models import db, User, Message, Follows
-from flask_bcrypt import Bcrypt, check_password_hash, generate_password_hash
-
-bcrypt = Bcrypt()
-
-# BEFORE we import our app, let's set an environmental variable
-# to use a different database for tests (we need to do this
-# before we import our app, since that will have already
-# connected to the database
-
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+from flask import Flask
 
+from models import db, User, Message, Follows
+from passwords import hash_password, init_passwords
 
-# Now we can import app
+# The testing config uses a different database for tests
+# (TEST_DATABASE_URL, by default postgresql:///warbler-test)
 
-from app import app
+from app import create_app
+from fixtures import TransactionalTestCase
 
-# Create our tables (we do this here, so we only create the tables
-# once for all tests --- in each test, we'll delete the data
-# and create fresh new clean test data
+app = create_app('testing')
 
-db.create_all()
+# Tables are created once per test process, and each test runs in a
+# transaction that is rolled back afterwards (see fixtures.py)
 
 
-class UserModelTestCase(TestCase):
+class UserModelTestCase(TransactionalTestCase):
     """Test views for messages."""
 
+    app = app
+
     def setUp(self):
         """Create test client, add sample data."""
 
-        User.query.delete()
-        Message.query.delete()
-        Follows.query.delete()
+        super().setUp()
 
         self.client = app.test_client()
 
@@ -53,7 +45,7 @@ class UserModelTestCase(TestCase):
                                  header_image_url="/static/images/warbler-hero.jpg",
                                  password='password1')
 
-        self.user1_id = 1,
+        self.user1_id = 1
         self.user1.id = self.user1_id
         # test user 2
         self.user2 = User.signup(email='user2@gmail.com',
@@ -134,3 +126,28 @@ class UserModelTestCase(TestCase):
  
 
 
+
+    def test_rehash_on_login(self):
+        '''Test a hash made at an old cost is replaced on login'''
+        user = User.query.filter_by(username='user2').first()
+        user.password = hash_password('password2', log_rounds=4)
+        db.session.commit()
+
+        self.assertTrue(User.authenticate('user2', 'password2'))
+        db.session.commit()
+
+        user = User.query.filter_by(username='user2').first()
+        self.assertFalse(user.password.startswith('$2b$04$'))
+        self.assertTrue(User.authenticate('user2', 'password2'))
+
+    def test_password_settings_per_app(self):
+        '''Test another app's bcrypt cost doesn't change this app's'''
+        other = Flask(__name__)
+        other.config['BCRYPT_LOG_ROUNDS'] = 6
+        other.config['PASSWORD_POOL_WORKERS'] = 0
+        init_passwords(other)
+
+        with other.app_context():
+            self.assertTrue(hash_password('password').startswith('$2b$06$'))
+        with app.app_context():
+            self.assertTrue(hash_password('password').startswith('$2b$05$'))
@@ -1,24 +1,23 @@
 # test by using: python - m unittest - v test_message_views.py
 
-from app import app, CURR_USER_KEY
+from app import create_app, CURR_USER_KEY
+from fixtures import TransactionalTestCase
 import os
-from unittest import TestCase
 
 from models import db, connect_db, Message, User, Likes, Follows
 
-os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
-
-db.create_all()
+app = create_app('testing')
 
 app.config['WTF_CSRF_ENABLED'] = False
 
 
-class user1Views(TestCase):
+class user1Views(TransactionalTestCase):
+
+    app = app
 
     def setUp(self):
 
-        db.drop_all()
-        db.create_all()
+        super().setUp()
 
         self.client = app.test_client()
         #test user 1
@@ -30,7 +29,7 @@ class user1Views(TestCase):
                                     header_image_url = "/static/images/warbler-hero.jpg",
                                     password = 'password1')
 
-        self.user1_id = 1,
+        self.user1_id = 1
         self.user1.id = self.user1_id
         # test user 2
         self.user2 = User.signup(email='user2@gmail.com',
@@ -90,6 +89,26 @@ class user1Views(TestCase):
             self.assertNotIn("@user3", str(resp.data))
             self.assertEqual(resp.status_code, 302)
 
+    def test_users_search_ranking(self):
+        '''Test exact and prefix username matches rank above bio matches.'''
+        user4 = User.signup(email='user4@gmail.com',
+                            username='fan',
+                            image_url="/static/images/default-pic.png",
+                            location='Phoenix',
+                            bio="big fan of user1",
+                            header_image_url="/static/images/warbler-hero.jpg",
+                            password='password4')
+        db.session.add(user4)
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get("/users?q=user1")
+            html = str(resp.data)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn("@fan", html)
+            self.assertLess(html.index("@user1"), html.index("@fan"))
+
     def test_user_show(self):
         '''Test if search is included in rendered content.'''
         with self.client as c:
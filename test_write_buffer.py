@@ -0,0 +1,290 @@
+"""Write buffer tests."""
+
+# run these tests like:
+#
+#    python -m unittest -v test_write_buffer.py
+#
+# They need no database server: the app runs on a SQLite file. The flush
+# interval is long enough that the background thread never flushes on
+# its own; tests flush by hand.
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+from flask import Flask, jsonify
+
+import actions
+from app import create_app, CURR_USER_KEY
+from config import TestingConfig
+from models import db, User, Message, Follows, Likes
+from writebuffer import init_write_buffer
+
+
+def make_app(directory, buffered=True):
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = (
+        f"sqlite:///{os.path.join(directory, 'warbler.db')}")
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['SECRET_KEY'] = 'test'
+    app.config['WRITE_BUFFER_ENABLED'] = buffered
+    app.config['WRITE_BUFFER_INTERVAL'] = 60
+    db.init_app(app)
+    init_write_buffer(app)
+
+    @app.route('/as/<int:user_id>/like/<int:msg_id>/<int:state>',
+               methods=['POST'])
+    def like(user_id, msg_id, state):
+        actions.set_like(user_id, msg_id, bool(state))
+        return ''
+
+    @app.route('/as/<int:user_id>/follow/<int:other_id>/<int:state>',
+               methods=['POST'])
+    def follow(user_id, other_id, state):
+        actions.set_follow(user_id, other_id, bool(state))
+        return ''
+
+    @app.route('/as/<int:user_id>')
+    def seen_by(user_id):
+        user = User.query.get(user_id)
+        liked, counts = actions.like_counts(user_id, Message.query.all())
+        return jsonify(following=sorted(actions.following_ids(user)),
+                       liked=sorted(liked), counts=counts)
+
+    return app
+
+
+class WriteBufferTestCase(TestCase):
+    """Likes and follows written later, in batches."""
+
+    def setUp(self):
+        # a session left open by another test module is bound to its app
+        db.session.remove()
+
+        self.directory = tempfile.TemporaryDirectory()
+        self.app = make_app(self.directory.name)
+        self.buffer = self.app.extensions['write_buffer']
+
+        with self.app.app_context():
+            db.create_all()
+            db.session.execute(User.__table__.insert(), [
+                dict(id=n, username=f'user{n}', email=f'user{n}@test.com',
+                     password='x') for n in (1, 2, 3)])
+            db.session.execute(Message.__table__.insert(), [
+                dict(id=10, text='hello', user_id=3)])
+            db.session.commit()
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        # nothing left for the exit-time flush once the database is gone
+        self.buffer.flush()
+        self.directory.cleanup()
+
+    def counters(self):
+        with self.app.app_context():
+            users = {user.id: (user.following_count, user.followers_count,
+                               user.likes_count)
+                     for user in User.query}
+            return users, Message.query.get(10).likes_count
+
+    def test_actions_wait_for_flush(self):
+        '''Test buffered actions are written only when flushed.'''
+
+        self.client.post('/as/1/like/10/1')
+        self.client.post('/as/1/follow/3/1')
+
+        with self.app.app_context():
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+
+        self.assertEqual(self.buffer.flush(), 2)
+
+        with self.app.app_context():
+            self.assertEqual(Likes.query.count(), 1)
+            self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(self.counters(), ({1: (1, 0, 1), 2: (0, 0, 0),
+                                            3: (0, 1, 0)}, 1))
+
+    def test_coalesce(self):
+        '''Test only the latest state per (user, target) is written.'''
+
+        for state in (1, 0, 1):
+            self.client.post(f'/as/1/like/10/{state}')
+        self.client.post('/as/2/like/10/1')
+        self.client.post('/as/2/like/10/0')
+
+        self.assertEqual(len(self.buffer), 2)
+        self.buffer.flush()
+
+        with self.app.app_context():
+            self.assertEqual(Likes.liked_ids(1, [10]), {10})
+            self.assertEqual(Likes.liked_ids(2, [10]), set())
+        self.assertEqual(self.counters()[1], 1)
+
+    def test_replay_is_harmless(self):
+        '''Test writing a state the database already has changes nothing.'''
+
+        self.client.post('/as/1/follow/2/1')
+        self.buffer.flush()
+        self.client.post('/as/1/follow/2/1')
+        self.client.post('/as/1/follow/3/0')
+        self.buffer.flush()
+
+        with self.app.app_context():
+            self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(self.counters()[0][1], (1, 0, 0))
+
+    def test_unlike_and_unfollow(self):
+        '''Test removals delete rows and move counters back.'''
+
+        self.client.post('/as/1/like/10/1')
+        self.client.post('/as/1/follow/3/1')
+        self.buffer.flush()
+        self.client.post('/as/1/like/10/0')
+        self.client.post('/as/1/follow/3/0')
+        self.buffer.flush()
+
+        with self.app.app_context():
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(Follows.query.count(), 0)
+        self.assertEqual(self.counters(), ({1: (0, 0, 0), 2: (0, 0, 0),
+                                            3: (0, 0, 0)}, 0))
+
+    def test_deleted_target_dropped(self):
+        '''Test actions on rows deleted before the flush are skipped.'''
+
+        self.client.post('/as/1/like/10/1')
+        self.client.post('/as/1/follow/2/1')
+        with self.app.app_context():
+            Message.query.filter_by(id=10).delete()
+            db.session.commit()
+
+        self.assertEqual(self.buffer.flush(), 2)
+
+        with self.app.app_context():
+            self.assertEqual(Likes.query.count(), 0)
+            self.assertEqual(Follows.query.count(), 1)
+
+    def test_own_actions_visible_before_flush(self):
+        '''Test the acting user sees their pending actions at once.'''
+
+        self.client.post('/as/1/like/10/1')
+        self.client.post('/as/1/follow/3/1')
+
+        self.assertEqual(self.client.get('/as/1').json,
+                         dict(following=[3], liked=[10], counts={'10': 1}))
+
+        # no double counting once flushed
+        self.buffer.flush()
+        self.assertEqual(self.client.get('/as/1').json,
+                         dict(following=[3], liked=[10], counts={'10': 1}))
+
+        # other users see it only after the flush
+        other = self.app.test_client()
+        self.assertEqual(other.get('/as/2').json['counts'], {'10': 1})
+
+    def test_pending_expires(self):
+        '''Test the session overlay forgets actions after the window.'''
+
+        self.app.config['WRITE_BUFFER_PENDING_SECONDS'] = 0
+        self.client.post('/as/1/follow/3/1')
+
+        self.assertEqual(self.client.get('/as/1').json['following'], [])
+        with self.client.session_transaction() as sess:
+            self.assertEqual(sess[actions.PENDING_KEY], [])
+
+    def test_failed_flush_requeues(self):
+        '''Test a failed flush keeps its actions for the next one.'''
+
+        self.client.post('/as/1/follow/2/1')
+        with self.app.app_context():
+            db.drop_all()
+
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(len(self.buffer), 1)
+
+        with self.app.app_context():
+            db.create_all()
+            db.session.execute(User.__table__.insert(), [
+                dict(id=n, username=f'user{n}', email=f'user{n}@test.com',
+                     password='x') for n in (1, 2)])
+            db.session.commit()
+
+        self.assertEqual(self.buffer.flush(), 1)
+        with self.app.app_context():
+            self.assertEqual(Follows.query.count(), 1)
+
+    def test_unbuffered(self):
+        '''Test actions commit at once with the buffer off.'''
+
+        app = make_app(self.directory.name, buffered=False)
+        self.assertNotIn('write_buffer', app.extensions)
+
+        app.test_client().post('/as/1/like/10/1')
+        with app.app_context():
+            self.assertEqual(Likes.liked_ids(1, [10]), {10})
+            self.assertEqual(Message.query.get(10).likes_count, 1)
+
+
+class FollowingPageTestCase(TestCase):
+    """The following page of a user whose follows are still buffered."""
+
+    def setUp(self):
+        db.session.remove()
+        # create_app() makes its app the default one (db.app)
+        self.addCleanup(setattr, db, 'app', db.app)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        class BufferedConfig(TestingConfig):
+            SQLALCHEMY_DATABASE_URI = (
+                f"sqlite:///{os.path.join(directory.name, 'warbler.db')}")
+            WRITE_BUFFER_ENABLED = True
+            WRITE_BUFFER_INTERVAL = 60
+
+        self.app = create_app(BufferedConfig)
+        buffer = self.app.extensions['write_buffer']
+        self.addCleanup(buffer.flush)
+
+        with self.app.app_context():
+            db.create_all()
+            db.session.execute(User.__table__.insert(), [
+                dict(id=n, username=f'user{n}', email=f'user{n}@test.com',
+                     password='x') for n in (1, 2, 3)])
+            db.session.execute(Follows.__table__.insert(), [
+                dict(user_following_id=1, user_being_followed_id=3)])
+            User.query.filter_by(id=1).update({'following_count': 1})
+            db.session.commit()
+
+        self.client = self.app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 1
+
+    def following(self, resp):
+        html = resp.get_data(as_text=True)
+        cards = {n for n in (2, 3) if f'@user{n}<' in html}
+        return cards, html
+
+    def test_pending_follows_shown(self):
+        '''Test the redirect after a follow shows it before the flush.'''
+
+        resp = self.client.post('/users/follow/2', follow_redirects=True)
+        cards, html = self.following(resp)
+        self.assertEqual(cards, {2, 3})
+        self.assertIn('/users/1/following">2<', html)
+
+        resp = self.client.post('/users/stop-following/3',
+                                follow_redirects=True)
+        cards, html = self.following(resp)
+        self.assertEqual(cards, {2})
+        self.assertIn('/users/1/following">1<', html)
+
+        # others see the database until the flush
+        other = self.app.test_client()
+        with other.session_transaction() as sess:
+            sess[CURR_USER_KEY] = 2
+        cards, _ = self.following(other.get('/users/1/following'))
+        self.assertEqual(cards, {3})
@@ -0,0 +1,362 @@
+"""Home timeline queries for Warbler.
+
+Timelines are read one of two ways:
+
+- fan-out-on-read (default): join follows -> messages at request time,
+  see `home_timeline`.
+- fan-out-on-write (TIMELINE_FANOUT = True): new messages are pushed into
+  each follower's inbox in the `timeline_entries` table, so reading a
+  timeline is one range scan on (owner_id, timestamp).
+
+With fan-out-on-write on, authors with more than
+TIMELINE_FANOUT_MAX_FOLLOWERS followers are still read at request time;
+pushing their messages would mean one insert per follower per warble.
+
+An author whose follower count drops back under the limit only gets
+their *new* messages pushed; run `flask rebuild-timelines` after
+changing the limit, or periodically, to refill inboxes.
+
+A follow copies only the author's newest TIMELINE_BACKFILL_SIZE
+messages into the follower's inbox, so the follow request does a
+bounded amount of work however much the author has written. Scrolling
+past them shows nothing older from that author; `flask
+rebuild-timelines` copies everything.
+
+All timeline reads are keyset-paginated on (timestamp, id): `before` is
+the (timestamp, id) of the last message on the previous page, and pages
+are handed to clients as opaque cursors (see `paginate`). Every page is
+an index range scan, so page 50 costs the same as page 1.
+"""
+
+import base64
+import heapq
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import literal, tuple_
+
+from models import db, Follows, Message, TimelineEntry, User
+
+HOME_TIMELINE_SIZE = 100
+DEFAULT_FANOUT_MAX_FOLLOWERS = 1000
+DEFAULT_BACKFILL_SIZE = 10 * HOME_TIMELINE_SIZE
+
+
+def pack_cursor(*fields):
+    """Opaque, URL-safe cursor holding `fields` (ints and datetimes)."""
+
+    raw = "|".join(field.isoformat() if isinstance(field, datetime)
+                   else str(field) for field in fields)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def unpack_cursor(cursor, *parsers):
+    """Fields of a `pack_cursor` cursor, each read by its parser.
+
+    Raises ValueError if the cursor is garbage or has the wrong number of
+    fields.
+    """
+
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        raw = base64.urlsafe_b64decode(padded.encode()).decode()
+        fields = raw.split("|")
+        if len(fields) != len(parsers):
+            raise ValueError(f"expected {len(parsers)} fields")
+        return tuple(parse(field) for parse, field in zip(parsers, fields))
+    except (TypeError, UnicodeError, ValueError) as exc:
+        raise ValueError(f"Invalid cursor: {cursor!r}") from exc
+
+
+def encode_cursor(msg):
+    """Opaque cursor pointing just past `msg`."""
+
+    return pack_cursor(msg.timestamp, msg.id)
+
+
+def decode_cursor(cursor):
+    """(timestamp, id) from a cursor; raises ValueError if it is garbage."""
+
+    return unpack_cursor(cursor, datetime.fromisoformat, int)
+
+
+def paginate(fetch, cursor=None, size=HOME_TIMELINE_SIZE):
+    """One page from `fetch(before, limit)`.
+
+    Returns (messages, next_cursor); next_cursor is None on the last page.
+    """
+
+    before = decode_cursor(cursor) if cursor else None
+    messages = fetch(before, size + 1)
+
+    if len(messages) > size:
+        messages = messages[:size]
+        return messages, encode_cursor(messages[-1])
+
+    return messages, None
+
+
+def _before(query, timestamp_column, id_column, before):
+    if before is not None:
+        query = query.filter(tuple_(timestamp_column, id_column) < before)
+    return query.order_by(timestamp_column.desc(), id_column.desc())
+
+
+def home_timeline(user_id, before=None, limit=HOME_TIMELINE_SIZE):
+    """Newest `limit` messages written by users that `user_id` follows."""
+
+    if fanout_enabled():
+        return inbox_timeline(user_id, before, limit)
+
+    return joined_timeline(user_id, before, limit)
+
+
+def joined_timeline(user_id, before=None, limit=HOME_TIMELINE_SIZE):
+    """Fan-out-on-read timeline for `user_id`.
+
+    This is one join of follows -> messages, so the work done depends on
+    how much the followed users have written, not on the size of the
+    messages table. It relies on two indexes declared in models.py:
+
+    - ix_follows_user_following_id  (user_following_id, user_being_followed_id)
+    - ix_messages_user_id_timestamp (user_id, timestamp, id)
+
+    Query plan on Postgres (EXPLAIN, 10M messages):
+
+        Limit
+          ->  Sort  (top-N heapsort, key: messages.timestamp DESC, messages.id DESC)
+                ->  Nested Loop
+                      ->  Index Only Scan using ix_follows_user_following_id
+                            on follows
+                            Index Cond: (user_following_id = $1)
+                      ->  Index Scan using ix_messages_user_id_timestamp
+                            on messages
+                            Index Cond: (user_id = follows.user_being_followed_id)
+
+    Query plan on SQLite (EXPLAIN QUERY PLAN):
+
+        SEARCH follows USING COVERING INDEX ix_follows_user_following_id
+            (user_following_id=?)
+        SEARCH messages USING INDEX ix_messages_user_id_timestamp (user_id=?)
+        USE TEMP B-TREE FOR ORDER BY
+
+    See benchmarks/bench_timeline.py for timings.
+    """
+
+    query = (Message
+             .with_authors()
+             .join(Follows, Follows.user_being_followed_id == Message.user_id)
+             .filter(Follows.user_following_id == user_id))
+
+    return _before(query, Message.timestamp, Message.id, before).limit(limit).all()
+
+
+def inbox_timeline(user_id, before=None, limit=HOME_TIMELINE_SIZE):
+    """Fan-out-on-write timeline for `user_id`.
+
+    Reads the user's inbox (one range scan on the timeline_entries primary
+    key) and merges in messages from followed authors that are too popular
+    to fan out.
+    """
+
+    inbox = (db.session
+             .query(TimelineEntry.timestamp, TimelineEntry.message_id)
+             .filter(TimelineEntry.owner_id == user_id))
+    inbox = _before(inbox, TimelineEntry.timestamp, TimelineEntry.message_id,
+                    before).limit(limit).all()
+
+    pulled = (db.session
+              .query(Message.timestamp, Message.id)
+              .join(Follows, Follows.user_being_followed_id == Message.user_id)
+              .filter(Follows.user_following_id == user_id)
+              .filter(Message.user_id.in_(pull_authors())))
+    pulled = _before(pulled, Message.timestamp, Message.id,
+                     before).limit(limit).all()
+
+    # an author can cross the follower limit after their messages were
+    # pushed, so the same message may come back from both sides
+    positions = {}
+    for _, message_id in heapq.merge(inbox, pulled, reverse=True):
+        positions.setdefault(message_id, len(positions))
+        if len(positions) == limit:
+            break
+
+    if not positions:
+        return []
+
+    messages = Message.with_authors().filter(Message.id.in_(positions)).all()
+    messages.sort(key=lambda msg: positions[msg.id])
+    return messages
+
+
+def user_messages(user_id, before=None, limit=HOME_TIMELINE_SIZE):
+    """Newest `limit` messages written by `user_id`.
+
+    Authors aren't batch-loaded here: they are all the same user, whom
+    the caller has already loaded.
+    """
+
+    query = Message.query.filter(Message.user_id == user_id)
+    return _before(query, Message.timestamp, Message.id, before).limit(limit).all()
+
+
+def recent_messages(before=None, limit=HOME_TIMELINE_SIZE):
+    """Newest `limit` messages site-wide (uses ix_messages_timestamp)."""
+
+    return _before(Message.with_authors(), Message.timestamp, Message.id,
+                   before).limit(limit).all()
+
+
+def follows_anyone(user_id):
+    """Does `user_id` follow at least one user?"""
+
+    query = Follows.query.filter_by(user_following_id=user_id)
+    return db.session.query(query.exists()).scalar()
+
+
+##############################################################################
+# Fan-out-on-write
+
+
+def fanout_enabled():
+    """Are timelines materialized into timeline_entries?"""
+
+    return current_app.config.get('TIMELINE_FANOUT', False)
+
+
+def fanout_max_followers():
+    return current_app.config.get('TIMELINE_FANOUT_MAX_FOLLOWERS',
+                                  DEFAULT_FANOUT_MAX_FOLLOWERS)
+
+
+def push_authors():
+    """Query of user ids whose messages are pushed to follower inboxes."""
+
+    return (db.session
+            .query(User.id)
+            .filter(User.followers_count <= fanout_max_followers()))
+
+
+def pull_authors():
+    """Query of user ids whose messages are read at request time."""
+
+    return (db.session
+            .query(User.id)
+            .filter(User.followers_count > fanout_max_followers()))
+
+
+def is_push_author(user_id):
+    """Should messages by `user_id` be pushed to follower inboxes?"""
+
+    followers = (db.session
+                 .query(User.followers_count)
+                 .filter(User.id == user_id)
+                 .scalar())
+    return (followers or 0) <= fanout_max_followers()
+
+
+def _insert_entries(select):
+    columns = ['owner_id', 'timestamp', 'message_id', 'author_id']
+    db.session.execute(
+        TimelineEntry.__table__.insert().from_select(columns, select))
+
+
+def deliver_message(msg):
+    """Push a new message into its author's followers' inboxes."""
+
+    if not fanout_enabled() or not is_push_author(msg.user_id):
+        return
+
+    _insert_entries(
+        db.session
+        .query(Follows.user_following_id,
+               literal(msg.timestamp),
+               literal(msg.id),
+               literal(msg.user_id))
+        .filter(Follows.user_being_followed_id == msg.user_id)
+        .statement)
+
+
+def backfill(owner_id, author_id):
+    """Copy `author_id`'s newest TIMELINE_BACKFILL_SIZE messages into
+    `owner_id`'s inbox after a follow."""
+
+    if not fanout_enabled() or not is_push_author(author_id):
+        return
+
+    size = current_app.config.get('TIMELINE_BACKFILL_SIZE',
+                                  DEFAULT_BACKFILL_SIZE)
+    _insert_entries(
+        db.session
+        .query(literal(owner_id), Message.timestamp, Message.id, Message.user_id)
+        .filter(Message.user_id == author_id)
+        .order_by(Message.timestamp.desc(), Message.id.desc())
+        .limit(size)
+        .statement)
+
+
+def purge(owner_id, author_id):
+    """Remove `author_id`'s messages from `owner_id`'s inbox after an unfollow."""
+
+    if not fanout_enabled():
+        return
+
+    (TimelineEntry
+     .query
+     .filter_by(owner_id=owner_id, author_id=author_id)
+     .delete(synchronize_session=False))
+
+
+def retract_message(message_id):
+    """Remove a deleted message from every inbox."""
+
+    if not fanout_enabled():
+        return
+
+    (TimelineEntry
+     .query
+     .filter_by(message_id=message_id)
+     .delete(synchronize_session=False))
+
+
+def retract_user(user_id):
+    """Remove a deleted user's inbox and their messages in other inboxes."""
+
+    if not fanout_enabled():
+        return
+
+    (TimelineEntry
+     .query
+     .filter((TimelineEntry.owner_id == user_id)
+             | (TimelineEntry.author_id == user_id))
+     .delete(synchronize_session=False))
+
+
+def rebuild_timelines(owner_ids=None):
+    """Rebuild inboxes from follows and messages.
+
+    Rebuilds every inbox, or only those of `owner_ids`. Returns the number
+    of entries written. The caller commits.
+    """
+
+    entries = TimelineEntry.query
+    if owner_ids is not None:
+        entries = entries.filter(TimelineEntry.owner_id.in_(owner_ids))
+    entries.delete(synchronize_session=False)
+
+    select = (db.session
+              .query(Follows.user_following_id,
+                     Message.timestamp,
+                     Message.id,
+                     Message.user_id)
+              .join(Message, Message.user_id == Follows.user_being_followed_id)
+              .filter(Follows.user_being_followed_id.in_(push_authors())))
+    if owner_ids is not None:
+        select = select.filter(Follows.user_following_id.in_(owner_ids))
+
+    _insert_entries(select.statement)
+
+    written = TimelineEntry.query
+    if owner_ids is not None:
+        written = written.filter(TimelineEntry.owner_id.in_(owner_ids))
+    return written.count()
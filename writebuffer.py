@@ -0,0 +1,195 @@
+"""Write-behind buffer for likes and follows.
+
+Every like, unlike, follow and unfollow used to commit on its own, so a
+burst of likes on one popular message meant a burst of single-row
+transactions all updating that message's like counter. With
+WRITE_BUFFER_ENABLED, routes hand those actions to a per-process buffer
+instead (see actions.py), which:
+
+- keeps only the latest state per (kind, user, target): like, unlike,
+  like again within one flush writes a single like,
+- flushes every WRITE_BUFFER_INTERVAL seconds, or as soon as
+  WRITE_BUFFER_MAX_ACTIONS distinct actions are waiting, in one
+  transaction: one bulk INSERT and one bulk DELETE per table and one
+  counter UPDATE per distinct delta, rather than a commit per click.
+
+Durability: an action is only in this process's memory until its flush
+commits. The buffer flushes at normal interpreter exit, but a crash or
+SIGKILL loses whatever was waiting, i.e. at most WRITE_BUFFER_INTERVAL
+seconds or WRITE_BUFFER_MAX_ACTIONS actions per process. A failed flush
+is rolled back and retried on the next tick (newer actions for the same
+key win); after MAX_ATTEMPTS failures in a row the batch is dropped and
+logged. Use it only for writes that are fine to lose like that; messages,
+signups and profile edits always commit straight away.
+
+Ordering: buffers are per process. Actions queued in one process are
+written in click order; if one user's clicks on the same target are
+served by two workers within one interval, they land in flush order, so
+the last click may lose. Counters always move by what a flush actually
+changed, so they stay consistent with the Likes and Follows rows;
+`flask reconcile-counters` recomputes them anyway.
+
+Until a flush, the user who acted sees their action through the session
+overlay in actions.py; everyone else sees it after the flush. The
+counts on their own profile card follow once the flush has dropped the
+cached identity (see identity.py): at once in the flushing process,
+within IDENTITY_CACHE_TTL in the others.
+"""
+
+import atexit
+import os
+import threading
+import weakref
+
+from actions import FOLLOW, apply_actions
+from forksafe import reset_after_fork
+from identity import forget_identity
+from models import db
+
+DEFAULT_INTERVAL = 0.5
+DEFAULT_MAX_ACTIONS = 500
+MAX_ATTEMPTS = 3
+
+
+def touched_users(actions):
+    """Ids of users whose counters `actions` may change."""
+
+    users = set()
+    for kind, user_id, target_id in actions:
+        users.add(user_id)
+        if kind == FOLLOW:
+            users.add(target_id)
+    return users
+
+
+class WriteBuffer:
+    """Pending like/follow actions of one app, flushed by a background
+    thread."""
+
+    def __init__(self, app, interval=DEFAULT_INTERVAL,
+                 max_actions=DEFAULT_MAX_ACTIONS):
+        self.app = app
+        self.interval = interval
+        self.max_actions = max_actions
+
+        self._actions = {}
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def __len__(self):
+        return len(self._actions)
+
+    def reset_after_fork(self):
+        """Start over in a forked child: the parent flushes what it had."""
+
+        self._actions = {}
+        self._failures = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def add(self, kind, user_id, target_id, state):
+        """Queue `state` for (kind, user, target), replacing any queued one."""
+
+        with self._lock:
+            self._actions[kind, user_id, target_id] = state
+            full = len(self._actions) >= self.max_actions
+
+        self._ensure_thread()
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        """Write everything queued so far; returns how many actions."""
+
+        with self._flush_lock:
+            with self._lock:
+                batch, self._actions = self._actions, {}
+            if not batch:
+                return 0
+
+            with self.app.app_context():
+                try:
+                    apply_actions(batch)
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    self._failed(batch)
+                    return 0
+                finally:
+                    db.session.remove()
+
+            self._failures = 0
+            for user_id in touched_users(batch):
+                forget_identity(user_id)
+            return len(batch)
+
+    def _failed(self, batch):
+        self._failures += 1
+        if self._failures >= MAX_ATTEMPTS:
+            self.app.logger.exception(
+                "write buffer: dropping %d actions after %d failed flushes",
+                len(batch), self._failures)
+            self._failures = 0
+            return
+
+        self.app.logger.exception(
+            "write buffer: flush of %d actions failed, will retry",
+            len(batch))
+        with self._lock:
+            for key, state in batch.items():
+                self._actions.setdefault(key, state)
+
+    def _ensure_thread(self):
+        # a forked worker inherits the buffer but not the thread
+        if self._thread is not None and self._pid == os.getpid():
+            return
+
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(
+                    target=self._run, name="write-buffer", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("write buffer: flush crashed")
+
+
+_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_all():
+    for buffer in list(_buffers):
+        buffer.flush()
+
+
+def init_write_buffer(app):
+    """Buffer like/follow writes when WRITE_BUFFER_ENABLED is set."""
+
+    if not app.config.get('WRITE_BUFFER_ENABLED'):
+        app.extensions.pop('write_buffer', None)
+        return None
+
+    buffer = WriteBuffer(
+        app,
+        interval=app.config.get('WRITE_BUFFER_INTERVAL', DEFAULT_INTERVAL),
+        max_actions=app.config.get('WRITE_BUFFER_MAX_ACTIONS',
+                                   DEFAULT_MAX_ACTIONS))
+    app.extensions['write_buffer'] = buffer
+    _buffers.add(buffer)
+    reset_after_fork(buffer)
+    return buffer